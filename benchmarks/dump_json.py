@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+
+# Set up logging before the other modules are imported, as some of them log on import.
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logger = logging.getLogger('data')
+
+import argparse
+import codecs
+import datetime
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+from dump.dump import run_and_dump_json, open_dump_file
+
+
+'''
+Compare how fast JSON dumps are written by our writer and by the writer we used to use.
+The records are like the ones dumped by `dump node_post_stats`.
+
+Run this from the root directory of the repository:
+
+    python -m benchmarks.dump_json [--rows 1000000]
+'''
+
+
+CHUNK_SIZE = 1000
+
+
+def run_and_dump_json_with_copies(harvest_func, dump_file, *args, **kwargs):
+    '''
+    The writer that dump.dump used before it encoded records with `encode_json`.
+    It copies each record to convert its dates, and then encodes it with `json.dumps`.
+    '''
+    dump_file.write('[\n')
+    first_record = True
+
+    for value_list in harvest_func(*args, **kwargs):
+        for record in value_list:
+
+            if not first_record:
+                dump_file.write(',\n')
+
+            cleaned_record = {}
+            for field, value in record.items():
+                if isinstance(value, datetime.datetime):
+                    cleaned_record[field] = value.isoformat()
+                else:
+                    cleaned_record[field] = value
+
+            dump_file.write(json.dumps(cleaned_record))
+            first_record = False
+
+    dump_file.write('\n]')
+
+
+def make_harvest_func(rows):
+
+    # The same chunk of records is yielded over and over, so that the time it takes to
+    # make the records isn't counted in the time it takes to write them.
+    chunk = [{
+        'tag_name': 'node.js',
+        'title': "How do I read a file line by line in Node.js? (post " + str(i) + ")",
+        'creation_date': datetime.datetime(2016, 1, 1) + datetime.timedelta(seconds=i),
+        'answer_count': i % 7,
+        'comment_count': i % 11,
+        'favorite_count': i % 5,
+        'score': i % 101,
+        'view_count': i * 13,
+    } for i in range(CHUNK_SIZE)]
+
+    def harvest():
+        for _ in range(rows // CHUNK_SIZE):
+            yield chunk
+        yield chunk[:rows % CHUNK_SIZE]
+
+    return harvest
+
+
+def benchmark(dump_func, open_file, dump_path, rows):
+    start_time = time.time()
+    with open_file(dump_path) as dump_file:
+        dump_func(make_harvest_func(rows), dump_file)
+    return time.time() - start_time, os.path.getsize(dump_path)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark writing of JSON dumps.")
+    parser.add_argument(
+        '--rows',
+        type=int,
+        default=1000000,
+        help="Number of records to dump (default: %(default)s)."
+    )
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        baseline_path = os.path.join(temp_dir, 'baseline.json')
+        baseline_time, baseline_size = benchmark(
+            run_and_dump_json_with_copies,
+            lambda path: codecs.open(path, 'w', encoding='utf-8'),
+            baseline_path,
+            args.rows,
+        )
+        dump_path = os.path.join(temp_dir, 'dump.json')
+        dump_time, dump_size = benchmark(run_and_dump_json, open_dump_file, dump_path, args.rows)
+
+        # Check that both writers wrote the same records, comparing a sample of them.
+        with open(baseline_path) as baseline_file, open(dump_path) as dump_file:
+            baseline_lines = [next(baseline_file) for _ in range(min(args.rows, 1000) + 1)]
+            dump_lines = [next(dump_file) for _ in range(min(args.rows, 1000) + 1)]
+        if [json.loads(line.rstrip(',\n')) for line in baseline_lines[1:]] !=\
+                [json.loads(line.rstrip(',\n')) for line in dump_lines[1:]]:
+            logger.error("The writers disagree on the records they wrote.")
+    finally:
+        shutil.rmtree(temp_dir)
+
+    megabyte = 1024.0 * 1024.0
+    logger.info("Dumped %d records.", args.rows)
+    logger.info(
+        "Copies and json.dumps: %.1f s, %.1f MB, %.1f MB/s",
+        baseline_time, baseline_size / megabyte, baseline_size / megabyte / baseline_time)
+    logger.info(
+        "encode_json:           %.1f s, %.1f MB, %.1f MB/s",
+        dump_time, dump_size / megabyte, dump_size / megabyte / dump_time)
+    logger.info("Speedup: %.1fx", baseline_time / dump_time)
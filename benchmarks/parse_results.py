@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+
+# Set up logging before the other modules are imported, as some of them log on import.
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logger = logging.getLogger('data')
+
+import argparse
+import datetime
+import re
+import time
+from bs4 import BeautifulSoup
+
+from fetch.api import ResponseCassette
+from fetch.results import parse_results
+from tests.fetch.test_fetch_results import make_atom_response
+
+
+'''
+Compare the time it takes to parse search results from the Custom Search API with
+our parser and with the BeautifulSoup parser we used to use.  The responses to parse can
+be read from a cassette recorded with `python data.py fetch results --cassette <file>`.
+Otherwise, a corpus of generated responses is parsed.
+
+Run this from the root directory of the repository:
+
+    python -m benchmarks.parse_results [--cassette results.cassette]
+'''
+
+
+def parse_results_with_beautiful_soup(content):
+    ''' The parser that fetch.results used before it parsed the Atom feed with ElementTree. '''
+
+    soup = BeautifulSoup(content, 'html.parser')
+    entry_count = len(soup.find_all('entry'))
+    page = {
+        'estimated_results_count': soup.find('cse:searchinformation').find('cse:totalresults').text,
+        'entries': [],
+    }
+    entry = soup.entry
+    for _ in range(entry_count):
+        updated_datetime_without_milliseconds = re.sub('\.\d\d\dZ', 'Z', entry.updated.text)
+        page['entries'].append({
+            'updated_date': datetime.datetime.strptime(
+                updated_datetime_without_milliseconds,
+                "%Y-%m-%dT%H:%M:%SZ"
+            ),
+            'link': entry.link['href'],
+            'snippet': entry.summary.string,
+            'title': entry.title.text,
+            'url': entry.id.text,
+        })
+        entry = entry.find_next('entry')
+    return page
+
+
+def load_corpus(cassette_filename, size):
+
+    if cassette_filename is None:
+        return [
+            make_atom_response([
+                'http://example.com/page/' + str(page_index) + '/' + str(i) for i in range(10)])
+            .encode('utf-8')
+            for page_index in range(size)
+        ]
+
+    cassette = ResponseCassette(cassette_filename, 'replay')
+    corpus = []
+    for key in cassette.offsets.keys():
+        response = cassette.get(key)
+        if 'customsearch' in response.url and response.status_code == 200:
+            corpus.append(response.content)
+    cassette.close()
+    return corpus
+
+
+def benchmark(parse, corpus, repeat):
+    start_time = time.time()
+    for _ in range(repeat):
+        pages = [parse(content) for content in corpus]
+    return (time.time() - start_time) / repeat, pages
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark parsing of search results.")
+    parser.add_argument(
+        '--cassette',
+        help="A cassette of recorded responses from the search API to parse."
+    )
+    parser.add_argument(
+        '--size',
+        type=int,
+        default=500,
+        help="Number of responses to generate if no cassette is given (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help="Number of times to parse the corpus with each parser (default: %(default)s)."
+    )
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.cassette, args.size)
+    baseline_time, baseline_pages = benchmark(
+        parse_results_with_beautiful_soup, corpus, args.repeat)
+    parse_time, pages = benchmark(parse_results, corpus, args.repeat)
+
+    if pages != baseline_pages:
+        logger.error("The parsers disagree on the results for some responses.")
+    logger.info("Parsed %d responses.", len(corpus))
+    logger.info("BeautifulSoup: %.3f ms / response", baseline_time * 1000 / len(corpus))
+    logger.info("ElementTree:   %.3f ms / response", parse_time * 1000 / len(corpus))
+    logger.info("Speedup: %.1fx", baseline_time / parse_time)
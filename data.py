@@ -20,11 +20,13 @@ data_logger.addHandler(log_handler)
 data_logger.propagate = False
 
 from models import create_tables, init_database
+from fetch.api import use_cassette, ResponseCassette
 from fetch import queries, results, results_content, histories, stack_overflow_questions, issues,\
     issue_comments, issue_events, slant_topics, slant_pros_and_cons
 from import_ import stackoverflow
 from compute import code, npm_packages, post_tags, python_snippets, tasks
 from migrate import run_migration
+from dump.dump import COMPRESSION_FILE_EXTENSIONS
 from dump import node_post_stats, package_top_queries, pattern_snippets, popular_tag_post_stats,\
     slant_community_pros_and_cons
 
@@ -101,6 +103,40 @@ if __name__ == '__main__':
                 help="Name of file containing database configuration."
             )
 
+            # Fetchers can record and replay their requests with a cassette
+            if command == 'fetch':
+                module_parser.add_argument(
+                    '--cassette',
+                    help="Name of a file to record HTTP responses to and replay them from."
+                )
+                module_parser.add_argument(
+                    '--cassette-mode',
+                    choices=ResponseCassette.MODES,
+                    default='record',
+                    help="How to use the cassette.  'record' replays recorded responses " +
+                         "and records the rest.  'replay' never goes to the network.  " +
+                         "'refresh' re-records every response.  (default: %(default)s)"
+                )
+
+            # Dumps can be compressed, or streamed to another program through standard output
+            if command == 'dump':
+                module_parser.add_argument(
+                    '--output',
+                    help="Name of the file to write the dump to, or '-' to write it to " +
+                         "standard output.  (default: a file in data/ named by the time)"
+                )
+                module_parser.add_argument(
+                    '--compress',
+                    dest='compression',
+                    choices=sorted(COMPRESSION_FILE_EXTENSIONS.keys()),
+                    help="Compress the dump as it is written.  'zstd' needs the zstandard package."
+                )
+                module_parser.add_argument(
+                    '--json-lines',
+                    action='store_true',
+                    help="Write JSON dumps with one record on each line, instead of as an array."
+                )
+
             # Each module defines additional arguments
             module.configure_parser(module_parser)
             module_parser.set_defaults(func=module.main)
@@ -117,6 +153,9 @@ if __name__ == '__main__':
         init_database(args.db, config_filename=args.db_config)
         create_tables()
 
+    if getattr(args, 'cassette', None) is not None:
+        use_cassette(args.cassette, args.cassette_mode)
+
     # Invoke the main program that was specified by the submodule
     if args.func is not None:
         args.func(**vars(args))
@@ -7,11 +7,33 @@ import functools
 from datetime import datetime
 import json
 import codecs
+import io
+import sys
 import time
 import os.path
+import threading
+import zlib
+import Queue
+import types
+import uuid
+from peewee import SelectQuery, PostgresqlDatabase, Proxy
 
 
 logger = logging.getLogger('data')
+STREAM_CHUNK_SIZE = 1000
+WRITE_BUFFER_SIZE = 1024 * 1024
+ROW_GROUP_SIZE = 100000
+COLUMNAR_FILE_EXTENSIONS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+COMPRESSION_FILE_EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+COMPRESSION_QUEUE_SIZE = 8
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
 
 
 '''
@@ -28,17 +50,45 @@ def my_func(*args, **kwargs):
 Will run my_func as a generator.  With each invokation of the generator, it will
 collect a JSON record or a list of records, and then dump those to a file
 with the basename "json-data".
+
+If the generator yields a peewee query instead of a list, the query's rows are
+streamed to the file a chunk at a time (see `stream_query`), so the size of a
+query's result doesn't affect how much memory a dump needs.
+
+The decorated function also takes these optional keyword arguments, which are set
+by the command line options for all dumps:
+* `output`: the path of the file to write, or '-' to write to standard output
+* `compression`: 'gzip' or 'zstd' to compress the dump as it is written
+* `json_lines`: for JSON dumps, whether to write one record per line instead of an array
 '''
 
 
 def dump_json(dest_basename):
     ''' Iterate over a generator function and dump its JSON records to file. '''
-    return functools.partial(
-        _wrap_harvest_func_with_dump_func,
-        dump_func=run_and_dump_json,
-        dest_basename=dest_basename,
-        file_extension='.json',
-    )
+    def wrap_harvest_func(harvest_func):
+
+        dump_json_array = _wrap_harvest_func_with_dump_func(
+            harvest_func,
+            dump_func=run_and_dump_json,
+            dest_basename=dest_basename,
+            file_extension='.json',
+        )
+        dump_json_lines = _wrap_harvest_func_with_dump_func(
+            harvest_func,
+            dump_func=functools.partial(run_and_dump_json, json_lines=True),
+            dest_basename=dest_basename,
+            file_extension='.jsonl',
+        )
+
+        @functools.wraps(harvest_func)
+        def harvest_and_dump(*args, **kwargs):
+            if kwargs.pop('json_lines', False):
+                return dump_json_lines(*args, **kwargs)
+            return dump_json_array(*args, **kwargs)
+
+        return harvest_and_dump
+
+    return wrap_harvest_func
 
 
 def dump_text(dest_basename):
@@ -65,35 +115,251 @@ def dump_csv(dest_basename, column_names, delimiter=','):
     )
 
 
+def dump_columnar(dest_basename, column_names, file_format='parquet',
+                  row_group_size=ROW_GROUP_SIZE):
+    '''
+    Iterate over a generator function to dump the records it yields to a columnar file.
+    The file format is either 'parquet' or 'arrow' (an Arrow IPC file, which can be read
+    with a memory map).  Records can be dicts, or lists of values in the order of
+    `column_names`.  This decorator needs the optional pyarrow package.
+    '''
+    def wrap_harvest_func(harvest_func):
+
+        harvest_and_dump = _wrap_harvest_func_with_dump_func(
+            harvest_func,
+            dump_func=functools.partial(
+                run_and_dump_columnar,
+                column_names=column_names,
+                file_format=file_format,
+                row_group_size=row_group_size,
+            ),
+            dest_basename=dest_basename,
+            file_extension=COLUMNAR_FILE_EXTENSIONS[file_format],
+        )
+
+        @functools.wraps(harvest_func)
+        def check_pyarrow_and_dump(*args, **kwargs):
+            # Make sure pyarrow can be imported before any file is made for the dump.
+            _import_pyarrow()
+            if kwargs.get('compression') is not None:
+                raise ValueError(
+                    "Columnar dumps are compressed already, and can't be compressed again.")
+            return harvest_and_dump(*args, **kwargs)
+
+        return check_pyarrow_and_dump
+
+    return wrap_harvest_func
+
+
 def _wrap_harvest_func_with_dump_func(harvest_func, dump_func, dest_basename, file_extension):
 
     @functools.wraps(harvest_func)
     def harvest_and_dump(*args, **kwargs):
 
-        full_filename = dest_basename + '-' + time.strftime("%Y-%m-%d_%H:%M:%S") + file_extension
-        if not os.path.exists('data'):
-            os.makedirs('data')
-        dump_path = os.path.join('data', full_filename)
+        dump_path = kwargs.pop('output', None)
+        compression = kwargs.pop('compression', None)
 
-        with codecs.open(dump_path, 'w', encoding='utf-8') as dump_file:
+        if dump_path is None:
+            full_filename = (
+                dest_basename + '-' + time.strftime("%Y-%m-%d_%H:%M:%S") + file_extension +
+                COMPRESSION_FILE_EXTENSIONS.get(compression, '')
+            )
+            if not os.path.exists('data'):
+                os.makedirs('data')
+            dump_path = os.path.join('data', full_filename)
+
+        with open_dump_file(dump_path, compression) as dump_file:
             dump_func(harvest_func, dump_file, *args, **kwargs)
 
     return harvest_and_dump
 
 
+def open_dump_file(dump_path, compression=None):
+    '''
+    Open a file for writing a dump, in binary mode.  The file has a large buffer, so that
+    the many small writes made for records get collected into a few big ones.
+    If `dump_path` is '-', the dump is written to standard output.  If a `compression`
+    is given, the dump is compressed in another thread as it's written.
+    '''
+    # Make the compressor first, so no file is made if its library is missing.
+    compressor = _make_compressor(compression) if compression is not None else None
+
+    if dump_path == '-':
+        dump_file = io.open(sys.stdout.fileno(), 'wb', buffering=WRITE_BUFFER_SIZE, closefd=False)
+    else:
+        dump_file = io.open(dump_path, 'wb', buffering=WRITE_BUFFER_SIZE)
+
+    if compressor is not None:
+        return CompressingWriter(dump_file, compressor)
+    return dump_file
+
+
+def _make_compressor(compression):
+    ''' Make an object with `compress` and `flush` methods for compressing a stream. '''
+
+    if compression == 'gzip':
+        # The window bits tell zlib to write a gzip header and trailer.
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "zstd compression needs the zstandard package.  " +
+                "Install it with `pip install zstandard`.")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError("Unknown compression: " + compression)
+
+
+class CompressingWriter(object):
+    '''
+    A file-like object that compresses what's written to it in a separate thread, so that
+    the dump can go on harvesting and encoding records while earlier ones are compressed.
+    Writes are collected into chunks of `chunk_size` bytes before they're handed over.
+    Closing the writer also closes the file that it writes to.
+    '''
+
+    def __init__(self, dest_file, compressor, chunk_size=WRITE_BUFFER_SIZE):
+        self.dest_file = dest_file
+        self.compressor = compressor
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.buffered_size = 0
+        self.error = None
+        self.queue = Queue.Queue(maxsize=COMPRESSION_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._compress_chunks)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.buffered_size += len(data)
+        if self.buffered_size >= self.chunk_size:
+            self._hand_off_chunk()
+
+    def _hand_off_chunk(self):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(b''.join(self.chunks))
+        self.chunks = []
+        self.buffered_size = 0
+
+    def _compress_chunks(self):
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is None:
+                    break
+                self.dest_file.write(self.compressor.compress(chunk))
+            self.dest_file.write(self.compressor.flush())
+        except Exception as error:
+            self.error = error
+            # Keep taking chunks, so that the writing thread doesn't block on a full queue.
+            while self.queue.get() is not None:
+                pass
+
+    def close(self):
+        try:
+            if self.chunks:
+                self._hand_off_chunk()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.dest_file.close()
+        if self.error is not None:
+            raise self.error
+
+
+def _encode_json_default(value):
+    ''' Convert values that the JSON encoder can't encode into values that it can. '''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(repr(value) + " is not JSON serializable")
+
+
+# The function for encoding records for JSON dumps.  Reusing one encoder saves making
+# a new one for each record, as `json.dumps` does.  Replace this to use another encoder.
+encode_json = json.JSONEncoder(separators=(',', ':'), default=_encode_json_default).encode
+
+
+def stream_query(query, chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    Iterate over the rows of a select query without holding the whole result in memory.
+    On Postgres, the rows are read through a named (server-side) cursor, which would otherwise
+    send the whole result to the client at once.  Elsewhere (e.g., SQLite), they are read
+    from a normal cursor.  Either way, `chunk_size` rows are fetched at a time, and peewee
+    doesn't cache the rows it has returned.
+    '''
+    database = query.database
+    if isinstance(database, Proxy):
+        database = database.obj
+
+    sql, params = query.sql()
+    if isinstance(database, PostgresqlDatabase):
+        # Named cursors only live as long as the transaction they were opened in.
+        with database.transaction():
+            cursor = database.get_conn().cursor(name='dump_' + uuid.uuid4().hex)
+            cursor.execute(sql, params)
+            for row in _iterate_cursor(query, cursor, chunk_size):
+                yield row
+            cursor.close()
+    else:
+        cursor = database.execute_sql(sql, params, require_commit=False)
+        for row in _iterate_cursor(query, cursor, chunk_size):
+            yield row
+        cursor.close()
+
+
+def _iterate_cursor(query, cursor, chunk_size):
+
+    # The query's own result wrapper converts rows into models, dicts, or tuples.
+    ResultWrapper = query._get_result_wrapper()
+    result_wrapper = ResultWrapper(query.model_class, cursor, query.get_query_meta())
+
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        # A named cursor only describes its columns once rows have been fetched.
+        if not result_wrapper._initialized:
+            result_wrapper.initialize(cursor.description)
+            result_wrapper._initialized = True
+        for row in rows:
+            yield result_wrapper.process_row(row)
+
+
+def _iterate_records(records):
+    # A query that has already been run (e.g., to modify its rows before they're dumped)
+    # is read from peewee's cache, rather than being run again.
+    if isinstance(records, SelectQuery) and records._qr is None:
+        return stream_query(records)
+    return records
+
+
 def run_and_dump_text(harvest_func, dump_file, *args, **kwargs):
 
+    dump_file = codecs.getwriter('utf-8')(dump_file)
     for line_list in harvest_func(*args, **kwargs):
-        for line in line_list:
+        for line in _iterate_records(line_list):
             dump_file.write(line + '\n')
 
 
 def run_and_dump_csv(harvest_func, dump_file, column_names, delimiter, *args, **kwargs):
 
+    dump_file = codecs.getwriter('utf-8')(dump_file)
+
     def make_csv_line(record):
         # Convert all elements of the record into good CSV:
         # encapsulate all strings within double quotes, and
         # convert all other data types to writable strings.
+        # Rows from queries are tuples, so the record is copied into a list.
+        record = list(record)
         for index, item in enumerate(record):
             if type(item) == str or type(item) == unicode:
                 escaped_string = item.replace('\r\n', "<newline>")
@@ -109,30 +375,156 @@ def run_and_dump_csv(harvest_func, dump_file, column_names, delimiter, *args, **
     dump_file.write(make_csv_line(column_names))
 
     for line_list in harvest_func(*args, **kwargs):
-        for line in line_list:
+        for line in _iterate_records(line_list):
             dump_file.write(make_csv_line(line))
 
 
-def run_and_dump_json(harvest_func, dump_file, *args, **kwargs):
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            "Columnar dumps need the pyarrow package.  Install it with `pip install pyarrow`.")
+    return pyarrow
+
+
+class ColumnarWriter(object):
+    '''
+    Writes records to a Parquet or Arrow file a row group at a time.  Values are collected
+    into columns until there are `row_group_size` rows, and then the row group is written.
+    The type of each column is inferred from the values in the first row group.
+    '''
+
+    def __init__(self, dump_file, column_names, file_format, row_group_size=ROW_GROUP_SIZE):
+        self.pyarrow = _import_pyarrow()
+        self.dump_file = dump_file
+        self.column_names = column_names
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.columns = [[] for _ in column_names]
+        self.row_count = 0
+        self.schema = None
+        self.writer = None
+
+    def write(self, record):
+        if isinstance(record, dict):
+            values = [record[column_name] for column_name in self.column_names]
+        else:
+            values = record
+        for column, value in zip(self.columns, values):
+            column.append(value)
+        self.row_count += 1
+        if self.row_count >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+
+        if self.row_count == 0:
+            return
+
+        arrays = [
+            self.pyarrow.array(
+                column, type=self.schema.field(index).type if self.schema else None)
+            for index, column in enumerate(self.columns)
+        ]
+        table = self.pyarrow.Table.from_arrays(arrays, names=self.column_names)
+
+        if self.writer is None:
+            self.schema = table.schema
+            if self.file_format == 'parquet':
+                self.writer = self.pyarrow.parquet.ParquetWriter(
+                    self.dump_file, self.schema, compression='snappy')
+            else:
+                self.writer = self.pyarrow.ipc.new_file(self.dump_file, self.schema)
 
-    dump_file.write('[\n')
-    first_record = True
+        if self.file_format == 'parquet':
+            self.writer.write_table(table, row_group_size=self.row_group_size)
+        else:
+            self.writer.write_table(table)
+
+        self.columns = [[] for _ in self.column_names]
+        self.row_count = 0
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            logger.warn("No records were dumped, so no columnar file could be written.")
 
+
+def run_and_dump_columnar(harvest_func, dump_file, column_names, file_format, row_group_size,
+                          *args, **kwargs):
+
+    columnar_writer = ColumnarWriter(dump_file, column_names, file_format, row_group_size)
     for value_list in harvest_func(*args, **kwargs):
-        for record in value_list:
+        for record in _iterate_records(value_list):
+            columnar_writer.write(record)
+    columnar_writer.close()
 
-            if not first_record:
-                dump_file.write(',\n')
 
-            # Convert non-JSON data to JSON
-            cleaned_record = {}
-            for field, value in record.items():
-                if isinstance(value, datetime):
-                    cleaned_record[field] = value.isoformat()
-                else:
-                    cleaned_record[field] = value
+def run_and_dump_json(harvest_func, dump_file, json_lines=False, *args, **kwargs):
+
+    # Records are encoded as they are, rather than as copies with their dates converted.
+    # The encoder converts dates itself, and writes bytes that go straight to file.
+    encode = encode_json
+    write = dump_file.write
 
-            dump_file.write(json.dumps(cleaned_record))
+    # In JSON Lines, each record is on its own line, instead of being an item in an array.
+    if json_lines:
+        start, separator, end = b'', b'\n', b'\n'
+    else:
+        start, separator, end = b'[\n', b',\n', b'\n]'
+
+    write(start)
+    first_record = True
+
+    for value_list in harvest_func(*args, **kwargs):
+        for record in _iterate_records(value_list):
+
+            if not first_record:
+                write(separator)
             first_record = False
 
-    dump_file.write('\n]')
+            try:
+                encoded_record = encode(record)
+            except TypeError:
+                # The encoder can't encode generators, so records with generator
+                # values are written a field at a time.  Records are only checked
+                # for generators here, as checking every record slows dumps down.
+                if not _has_generator_values(record):
+                    raise
+                _write_streamed_json_record(dump_file, record)
+            else:
+                write(encoded_record)
+
+    # An empty JSON Lines file has no lines at all.
+    if not (json_lines and first_record):
+        write(end)
+
+
+def _has_generator_values(record):
+    return isinstance(record, dict) and any(
+        isinstance(value, types.GeneratorType) for value in record.values())
+
+
+def _write_streamed_json_record(dump_file, record):
+    ''' Write a record to JSON, writing each generator value as a list of the items it yields. '''
+
+    dump_file.write(b'{')
+    for field_index, (field, value) in enumerate(record.items()):
+        if field_index > 0:
+            dump_file.write(b',')
+        dump_file.write(encode_json(field) + b':')
+        if isinstance(value, types.GeneratorType):
+            dump_file.write(b'[')
+            for item_index, item in enumerate(value):
+                if item_index > 0:
+                    dump_file.write(b',')
+                dump_file.write(encode_json(item))
+            dump_file.write(b']')
+        else:
+            dump_file.write(encode_json(value))
+    dump_file.write(b'}')
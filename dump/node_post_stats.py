@@ -5,7 +5,7 @@ from __future__ import unicode_literals
 import logging
 from progressbar import ProgressBar, Percentage, Bar, ETA, Counter, RotatingMarker
 
-from dump import dump_json
+from dump import dump_json, dump_columnar
 from models import Post, Tag, PostTag
 
 
@@ -46,10 +46,21 @@ PACKAGES = [
     "node-mysql",
     "nodemon",
 ]
+COLUMN_NAMES = [
+    'tag_name', 'title', 'creation_date', 'answer_count', 'comment_count', 'favorite_count',
+    'score', 'view_count',
+]
+
+
+def main(output_format, *args, **kwargs):
+    if output_format == 'json':
+        dump = dump_json(__name__)
+    else:
+        dump = dump_columnar(__name__, COLUMN_NAMES, file_format=output_format)
+    dump(harvest_post_stats)(*args, **kwargs)
 
 
-@dump_json(__name__)
-def main(show_progress, *args, **kwargs):
+def harvest_post_stats(show_progress, *args, **kwargs):
 
     # Set up progress bar.
     if show_progress:
@@ -91,3 +102,11 @@ def configure_parser(parser):
         action='store_true',
         help="Show progress in loading content from the file."
     )
+    parser.add_argument(
+        '--format',
+        dest='output_format',
+        choices=['json', 'parquet', 'arrow'],
+        default='json',
+        help="Format of the dump file.  'parquet' and 'arrow' write columnar files, " +
+             "which need the pyarrow package.  (default: %(default)s)"
+    )
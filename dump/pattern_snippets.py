@@ -4,7 +4,7 @@
 from __future__ import unicode_literals
 import logging
 
-from dump import dump_json
+from dump import dump_json, stream_query
 from models import SnippetPattern, PostSnippet
 
 
@@ -23,15 +23,16 @@ def main(patterns, *args, **kwargs):
 
         snippets = (
             PostSnippet
-            .select()
+            .select(PostSnippet.snippet)
             .join(SnippetPattern)
             .where(SnippetPattern.pattern == pattern)
+            .tuples()
         )
 
-        snippet_texts = [s.snippet for s in snippets]
+        # The snippets are written to file as they're read, instead of being collected first.
         record = {
             'pattern': pattern,
-            'snippets': snippet_texts,
+            'snippets': (snippet for (snippet,) in stream_query(snippets)),
         }
         yield [record]
 
@@ -3,14 +3,24 @@
 
 from __future__ import unicode_literals
 import logging
-from progressbar import ProgressBar, Percentage, Bar, ETA, Counter, RotatingMarker
+import random
 import numpy as np
+from peewee import fn, Clause, SQL
+from playhouse.shortcuts import case
 
-from dump import dump_json
+from dump import dump_json, dump_columnar, stream_query
 from models import Post, Tag, PostTag
 
 
 logger = logging.getLogger('data')
+# A multiplicative hash (Knuth's) that maps post IDs to pseudo-random 32-bit numbers
+HASH_MULTIPLIER = 2654435761
+HASH_MASK = 2 ** 32 - 1
+# Seeds are kept below this, so that (post ID + seed) * multiplier fits in a 64-bit integer.
+MAX_SEED = 2 ** 31 - 1
+# How many more posts than the sample size to fetch for each tag, as a ratio.  The number of
+# posts that pass the hash threshold varies, so this leaves room to still fill the sample.
+OVERSAMPLING = 1.2
 TAGS = [
     "javascript",
     "java",
@@ -47,59 +57,96 @@ TAGS = [
     "node.js",
     "database",
 ]
+COLUMN_NAMES = [
+    'tag_name', 'title', 'creation_date', 'answer_count', 'comment_count', 'favorite_count',
+    'score', 'view_count',
+]
 
 
-@dump_json(__name__)
-def main(sample_size, show_progress, *args, **kwargs):
-
-    # Set up progress bar.
-    if show_progress:
-        progress_bar = ProgressBar(maxval=len(TAGS), widgets=[
-            'Progress: ', Percentage(),
-            ' ', Bar(marker=RotatingMarker()),
-            ' ', ETA(),
-            ' Fetched posts for ', Counter(), ' / ' + str(len(TAGS)) + ' tags.'
-        ])
-        progress_bar.start()
-
-    # Fetch statistics for posts related to each tag
-    for tag_count, tag in enumerate(TAGS, start=1):
-
-        # As it turns out, we can make the selection of random posts tractable if we
-        # don't do a random ordering in SQL but instead do a random selection
-        # in Python.  So we start by fetching all of the post IDs for a tag,
-        # make the random choice locally, and then query for the posts in this subset.
-        post_id_tuples = (
-            PostTag.select()
-            .join(Tag, on=(PostTag.tag_id == Tag.id))
-            .where(Tag.tag_name == tag)
-            .select(PostTag.post_id)
-            .tuples()
-        )
-
-        # We convert this from a 2D Nx1 matrix to a 1D N-length matrix by taking its
-        # transpose and then getting the "first row" of the transpose.
-        post_ids = np.array(post_id_tuples).T[0]
-        sample_post_ids = np.random.choice(post_ids, sample_size, replace=False).tolist()
-
-        post_records = (
-            Post.select(Post.title, Post.creation_date, Post.answer_count, Post.comment_count,
-                        Post.favorite_count, Post.score, Post.view_count)
-            .where(Post.id << sample_post_ids)
-            .dicts()
-        )
-
-        # Store which tag this record is associated with
-        for record in post_records:
-            record['tag_name'] = tag
+def main(output_format, *args, **kwargs):
+    if output_format == 'json':
+        dump = dump_json(__name__)
+    else:
+        dump = dump_columnar(__name__, COLUMN_NAMES, file_format=output_format)
+    dump(harvest_post_stats)(*args, **kwargs)
 
-        yield post_records
 
-        if show_progress:
-            progress_bar.update(tag_count)
+def harvest_post_stats(sample_size, random_seed=None, *args, **kwargs):
 
-    if show_progress:
-        progress_bar.finish()
+    tags = list(
+        Tag.select(Tag.id, Tag.tag_name)
+        .where(Tag.tag_name << TAGS)
+    )
+    tag_indexes = {tag.id: TAGS.index(tag.tag_name) for tag in tags}
+    found_tag_names = set([tag.tag_name for tag in tags])
+    missing_tags = [tag_name for tag_name in TAGS if tag_name not in found_tag_names]
+    if missing_tags:
+        logger.warn("No posts will be dumped for these missing tags: %s", ', '.join(missing_tags))
+    if not tag_indexes:
+        raise StopIteration
+
+    # The thresholds for sampling are set from the number of posts each tag has in this
+    # database (rather than its count on Stack Overflow), counted in one grouped query.
+    tag_counts = dict(
+        PostTag.select(PostTag.tag_id, fn.COUNT(PostTag.id))
+        .where(PostTag.tag_id << tag_indexes.keys())
+        .group_by(PostTag.tag_id)
+        .tuples()
+    )
+    if not tag_counts:
+        raise StopIteration
+
+    # Posts are sampled in the database by hashing their IDs to pseudo-random numbers, and
+    # keeping the posts whose numbers fall below a threshold chosen for each tag, so that the
+    # same predicate works for both Postgres and SQLite.  The threshold lets through a few
+    # more posts than the sample size (if the tag has them), and the extra posts are dropped
+    # below.  The posts for all tags are fetched in a single query.
+    if random_seed is None:
+        random_seed = random.randint(0, MAX_SEED)
+    # Post IDs are cast to 64-bit integers first.  Otherwise, Postgres would add the seed to
+    # the ID as a 32-bit integer, which overflows for large IDs and seeds.
+    post_id = fn.CAST(Clause(PostTag.post_id, SQL('AS BIGINT')))
+    sample_hash = ((post_id + random_seed % MAX_SEED) * HASH_MULTIPLIER).bin_and(HASH_MASK)
+    thresholds = [
+        (tag_id, int(HASH_MASK * min(1.0, OVERSAMPLING * sample_size / max(count, 1))) + 1)
+        for tag_id, count in tag_counts.items()
+    ]
+    post_rows = (
+        PostTag.select(
+            PostTag.tag_id, sample_hash.alias('sample_hash'),
+            Post.title, Post.creation_date, Post.answer_count, Post.comment_count,
+            Post.favorite_count, Post.score, Post.view_count,
+        )
+        .join(Post, on=(Post.id == PostTag.post_id))
+        .where(
+            PostTag.tag_id << tag_indexes.keys(),
+            sample_hash < case(PostTag.tag_id, thresholds),
+        )
+        .tuples()
+    )
+    columns = zip(*stream_query(post_rows))
+    if not columns:
+        raise StopIteration
+
+    # Order the posts by the position of their tag in the list of tags, and then by their
+    # hashes.  The sample for each tag is the posts with the lowest hashes.
+    tag_id_list = sorted(tag_indexes.keys())
+    tag_positions = np.array([tag_indexes[tag_id] for tag_id in tag_id_list])[
+        np.searchsorted(tag_id_list, np.array(columns[0]))]
+    hashes = np.array(columns[1], dtype=np.int64)
+    order = np.lexsort((hashes, tag_positions))
+    sorted_positions = tag_positions[order]
+    ranks = np.arange(len(order)) - np.searchsorted(sorted_positions, sorted_positions)
+    sample = order[ranks < sample_size]
+
+    # Assemble the records from the sampled rows of each column.
+    record_columns = [np.array(TAGS, dtype=object)[tag_positions[sample]]] + [
+        np.array(column, dtype=object)[sample] for column in columns[2:]
+    ]
+    yield [
+        dict(zip(COLUMN_NAMES, values))
+        for values in zip(*[column.tolist() for column in record_columns])
+    ]
 
     raise StopIteration
 
@@ -110,11 +157,20 @@ def configure_parser(parser):
         '--sample-size',
         type=int,
         default=2000,
-        help="The maximum number of random posts to fetch for a tag." +
+        help="The maximum number of random posts to fetch for a tag.  " +
              "Performance should be pretty invariant to this number."
     )
     parser.add_argument(
-        '--show-progress',
-        action='store_true',
-        help="Show progress in loading content from the file."
+        '--random-seed',
+        type=int,
+        help="Seed for choosing the random posts.  Dumps with the same seed sample the " +
+             "same posts.  (default: a new seed for each dump)"
+    )
+    parser.add_argument(
+        '--format',
+        dest='output_format',
+        choices=['json', 'parquet', 'arrow'],
+        default='json',
+        help="Format of the dump file.  'parquet' and 'arrow' write columnar files, " +
+             "which need the pyarrow package.  (default: %(default)s)"
     )
@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import datetime
+
+from fetch.api import github_get, github_request
+from models import GitHubSyncCursor
+
+
+logger = logging.getLogger('data')
+
+
+'''
+Helpers for incremental syncs of GitHub data.  After each fetch of a type of data
+(a "resource", like "issues") for a project, we save a cursor describing what we have seen.
+The next incremental fetch asks GitHub only for data that has changed since then, and copies
+("carries forward") everything else from the last snapshot into the new fetch index.
+'''
+
+
+def get_sync_cursors(resource):
+    ''' Get a map from (owner, repo) to the sync cursor for a resource. '''
+    cursors = GitHubSyncCursor.select().where(GitHubSyncCursor.resource == resource)
+    return {(cursor.owner, cursor.repo): cursor for cursor in cursors}
+
+
+def save_sync_cursor(owner, repo, resource, fetch_index, since=None, last_id=None, etag=None):
+    ''' Create or update the sync cursor for a resource of a project. '''
+
+    cursor, _ = GitHubSyncCursor.get_or_create(
+        owner=owner,
+        repo=repo,
+        resource=resource,
+        defaults={'fetch_index': fetch_index},
+    )
+    cursor.date = datetime.datetime.now()
+    cursor.fetch_index = fetch_index
+    cursor.since = since
+    cursor.last_id = last_id
+    cursor.etag = etag
+    cursor.save()
+    return cursor
+
+
+def make_conditional_request_args(cursor, params):
+    '''
+    Make the keyword arguments for a request for data that has changed since a cursor.
+    The 'since' parameter is only added to a copy of `params` if the cursor has one.
+    '''
+    params = params.copy()
+    headers = {}
+    if cursor is not None:
+        if cursor.since is not None:
+            params['since'] = cursor.since
+        if cursor.etag is not None:
+            headers['If-None-Match'] = cursor.etag
+    return {'params': params, 'headers': headers}
+
+
+def fetch_changes(url, cursor, params, results_callback, incremental):
+    '''
+    Fetch all pages of data that has changed since a cursor, from an endpoint that takes a
+    'since' parameter.  `results_callback` is called with the results of each page.
+    Returns a tuple of the first response (None if any page failed), the latest 'updated_at'
+    time seen, and the ETag to send with the first request of the next incremental sync.
+    '''
+    request_args = make_conditional_request_args(cursor, params)
+    since = request_args['params'].get('since')
+    latest_update = {'since': since}
+
+    def track_latest_update(results):
+        for result in results:
+            # Timestamps from the GitHub API are all in the same ISO 8601 format,
+            # so they can be compared as strings.
+            if latest_update['since'] is None or result['updated_at'] > latest_update['since']:
+                latest_update['since'] = result['updated_at']
+        return results_callback(results)
+
+    response = github_get(start_url=url, results_callback=track_latest_update, **request_args)
+    if response is None or not incremental:
+        return response, latest_update['since'], None
+
+    # The ETag of the response is only good for a request with the same 'since'.  If we have
+    # seen changes, the next sync will ask for the changes since a later time, so we get the
+    # ETag for that request now.  Otherwise, the next sync couldn't get a "304 Not Modified"
+    # until the sync after it.
+    etag = response.headers.get('ETag')
+    if latest_update['since'] != since:
+        etag = _get_etag(url, dict(params, since=latest_update['since']))
+    return response, latest_update['since'], etag
+
+
+def _get_etag(url, params):
+    '''
+    Get the ETag of a request for data that changed since params['since'].  If the data has
+    changed since then, None is returned, as a "304 Not Modified" to that request would cause
+    the next sync to skip those changes.
+    '''
+    response = github_request(url, params=params)
+    if response is None or response.status_code != 200:
+        return None
+    if 'rel="next"' in response.headers.get('Link', ''):
+        return None
+    if any(result['updated_at'] > params['since'] for result in response.json()):
+        return None
+    return response.headers.get('ETag')
@@ -9,6 +9,12 @@ import ConfigParser
 import os
 import base64
 import re
+import threading
+import Queue
+import json
+import hashlib
+import urlparse
+from requests.structures import CaseInsensitiveDict
 
 
 logger = logging.getLogger('data')
@@ -18,6 +24,7 @@ USER_AGENT = "Andrew Head (for academic research) <andrewhead@eecs.berekeley.edu
 default_requests_session = requests.Session()
 default_requests_session.headers['User-Agent'] = USER_AGENT
 GITHUB_PAGE_SIZE = 100  # the maximum page size for many GitHub queries
+QUEUE_POLL_INTERVAL = 0.5
 
 
 def make_request(method, *args, **kwargs):
@@ -41,7 +48,7 @@ def make_request(method, *args, **kwargs):
     while try_again and attempts < max_attempts:
 
         try:
-            res = method(*args, **kwargs)
+            res = _send_request(method, *args, **kwargs)
             if hasattr(res, 'status_code') and res.status_code not in [200]:
                 log_error(str(res.status_code))
                 res = None
@@ -59,28 +66,483 @@ def make_request(method, *args, **kwargs):
     return res
 
 
+class ResponseCassette(object):
+    '''
+    An on-disk store of HTTP responses, so that fetchers can be re-run without the network.
+
+    Responses are keyed by the request method, URL, query parameters, and the headers of
+    conditional requests (so that a "304 Not Modified" recorded for a conditional request is
+    never replayed for an unconditional one, or vice versa).  In "record" mode,
+    a recorded response is returned if there is one, and otherwise the request is sent and
+    its response recorded.  In "replay" mode, requests are never sent; a request without a
+    recorded response fails.  In "refresh" mode, every request is sent, and its response
+    replaces the recorded one.  Only successful (200 and 304) responses are recorded.
+
+    The cassette is a file with one line per response, made of the key, a tab, and the
+    response as JSON.  Responses are only appended, so a refreshed response leaves a stale
+    copy behind in the file.  Stale copies are removed by `compact`, which is run
+    automatically when opening a cassette where most lines are stale.
+    This class is safe to use from several threads at once.
+    '''
+
+    MODES = ['record', 'replay', 'refresh']
+    CONDITIONAL_HEADERS = ['If-None-Match', 'If-Modified-Since']
+
+    def __init__(self, filename, mode='record'):
+        self.filename = filename
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.offsets = {}  # map from key to the position of its latest response in the file
+        self.line_count = 0
+        if os.path.exists(filename):
+            self._load_offsets()
+            if self.line_count > 2 * len(self.offsets):
+                self.compact()
+        self.file = open(filename, 'a+b')
+
+    @staticmethod
+    def make_key(method, url, params=None, headers=None):
+        params = sorted([(unicode(k), unicode(v)) for k, v in (params or {}).items()])
+        key_parts = [method.upper(), url, params]
+        # Keys for unconditional requests don't change, so existing cassettes stay valid.
+        headers = CaseInsensitiveDict(headers or {})
+        conditions = [
+            [header, unicode(headers[header])]
+            for header in ResponseCassette.CONDITIONAL_HEADERS if header in headers
+        ]
+        if len(conditions) > 0:
+            key_parts.append(conditions)
+        key = json.dumps(key_parts)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        ''' Get the recorded response for a key, or None if there isn't one. '''
+
+        with self.lock:
+            if key not in self.offsets:
+                return None
+            self.file.seek(self.offsets[key])
+            line = self.file.readline()
+
+        record = json.loads(line.split(b'\t', 1)[1])
+        response = requests.Response()
+        response.status_code = record['status_code']
+        response.headers = CaseInsensitiveDict(record['headers'])
+        response.url = record['url']
+        response.encoding = record['encoding']
+        response._content = base64.b64decode(record['content'])
+        response.from_cassette = True
+        return response
+
+    def put(self, key, response):
+        ''' Record a response for a key, replacing any response recorded before. '''
+
+        record = json.dumps({
+            'status_code': response.status_code,
+            'headers': dict(response.headers),
+            'url': response.url,
+            'encoding': response.encoding,
+            'content': base64.b64encode(response.content),
+        })
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            self.offsets[key] = self.file.tell()
+            self.file.write(key.encode('utf-8') + b'\t' + record.encode('utf-8') + b'\n')
+            self.file.flush()
+            self.line_count += 1
+
+    def compact(self):
+        ''' Rewrite the cassette so that it only holds the latest response for each key. '''
+
+        with self.lock:
+            logger.info(
+                "Compacting cassette %s from %d to %d responses.",
+                self.filename, self.line_count, len(self.offsets)
+            )
+            compact_filename = self.filename + '.compact'
+            offsets = {}
+            with open(self.filename, 'rb') as cassette_file:
+                with open(compact_filename, 'wb') as compact_file:
+                    for key, offset in sorted(self.offsets.items(), key=lambda item: item[1]):
+                        cassette_file.seek(offset)
+                        offsets[key] = compact_file.tell()
+                        compact_file.write(cassette_file.readline())
+            os.rename(compact_filename, self.filename)
+            self.offsets = offsets
+            self.line_count = len(offsets)
+            if hasattr(self, 'file'):
+                self.file.close()
+                self.file = open(self.filename, 'a+b')
+
+    def close(self):
+        self.file.close()
+
+    def _load_offsets(self):
+        offset = 0
+        with open(self.filename, 'rb') as cassette_file:
+            for line in cassette_file:
+                # Skip a partial line left by a run that was interrupted while writing.
+                if line.endswith(b'\n'):
+                    key = line.split(b'\t', 1)[0].decode('utf-8')
+                    self.offsets[key] = offset
+                    self.line_count += 1
+                offset += len(line)
+
+
+# The cassette that all requests are made through, if one is in use.
+cassette = None
+
+
+def use_cassette(filename, mode='record'):
+    ''' Make all requests from the fetchers through a cassette stored at `filename`. '''
+    global cassette
+    if cassette is not None:
+        cassette.close()
+    cassette = ResponseCassette(filename, mode) if filename is not None else None
+
+
+def _send_request(method, *args, **kwargs):
+
+    if cassette is None:
+        return method(*args, **kwargs)
+
+    url = args[0] if len(args) > 0 else kwargs.get('url')
+    key = ResponseCassette.make_key(
+        method.__name__, url, kwargs.get('params'), kwargs.get('headers'))
+
+    if cassette.mode != 'refresh':
+        response = cassette.get(key)
+        if response is not None:
+            return response
+    if cassette.mode == 'replay':
+        logger.warn("No recorded response for %s (params: %s)", url, str(kwargs.get('params')))
+        return None
+
+    response = method(*args, **kwargs)
+    if response.status_code in [200, 304]:
+        cassette.put(key, response)
+    return response
+
+
+def pause(seconds):
+    '''
+    Wait between requests so that we don't bombard a server.
+    There is no need to wait when responses are only being replayed from a cassette.
+    '''
+    if cassette is not None and cassette.mode == 'replay':
+        return
+    time.sleep(seconds)
+
+
+class RateLimiter(object):
+    '''
+    Spaces out requests made from any number of threads, so that at most
+    `rate` requests are made per second.  Call `wait` before making each request.
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_request_time = 0
+
+    def wait(self):
+        if cassette is not None and cassette.mode == 'replay':
+            return
+        with self.lock:
+            now = time.time()
+            request_time = max(now, self.next_request_time)
+            self.next_request_time = request_time + self.interval
+        if request_time > now:
+            time.sleep(request_time - now)
+
+
+class HostRateLimiter(object):
+    '''
+    Spaces out requests to each host, so that at most `rate` requests are made to any
+    one host per second.  Requests to different hosts don't wait for each other.
+    Call `wait` with the URL of each request before making it.
+    '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.rate_limiters = {}
+
+    def wait(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.rate_limiters:
+                self.rate_limiters[host] = RateLimiter(self.rate)
+            rate_limiter = self.rate_limiters[host]
+        rate_limiter.wait()
+
+
+class WorkerPool(object):
+    '''
+    Runs jobs (e.g., fetching data for one project) on a pool of worker threads.
+
+    Each job is run by calling `work_func(job, emit)` on a worker thread.  The work function
+    calls `emit(result)` for each result it gets for the job (e.g., each page of results).
+    All results are handed back to the thread that calls `run`, so that every database
+    write can be made from one thread.  Jobs are started in the order they were added.
+    '''
+
+    def __init__(self, work_func, num_workers):
+        self.work_func = work_func
+        self.num_workers = num_workers
+        self.job_queue = Queue.Queue()
+        # The result queue is bounded so that workers can't fetch far ahead of the
+        # thread that saves their results.
+        self.result_queue = Queue.Queue(maxsize=num_workers * 4)
+        self.pending_jobs = 0
+        self.stopped = False
+
+    def add_job(self, job):
+        ''' Add a job.  This can also be called from the callbacks passed to `run`. '''
+        self.job_queue.put(job)
+        self.pending_jobs += 1
+
+    def stop(self):
+        ''' Skip all jobs that haven't yet been started. '''
+        self.stopped = True
+
+    def run(self, results_callback=None, done_callback=None):
+        '''
+        Run all jobs, returning once they are finished.  `results_callback(job, result)` is
+        called for each result a job emits, and `done_callback(job)` after a job's last result.
+        '''
+
+        workers = [threading.Thread(target=self._work) for _ in range(self.num_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        while self.pending_jobs > 0:
+
+            # We poll the queue with a timeout as a blocking 'get' can't be interrupted.
+            try:
+                message, job, result = self.result_queue.get(timeout=QUEUE_POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+
+            if message == 'result' and results_callback is not None:
+                results_callback(job, result)
+            elif message == 'done':
+                self.pending_jobs -= 1
+                if done_callback is not None:
+                    done_callback(job)
+            elif message == 'skipped':
+                self.pending_jobs -= 1
+
+        # Signal to all workers that there are no more jobs
+        for _ in workers:
+            self.job_queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def _work(self):
+
+        while True:
+
+            job = self.job_queue.get()
+            if job is None:
+                break
+            if self.stopped:
+                self.result_queue.put(('skipped', job, None))
+                continue
+
+            emit = lambda result, job=job: self.result_queue.put(('result', job, result))
+            try:
+                self.work_func(job, emit)
+            except Exception:
+                logger.exception("Error running job %s", str(job))
+            self.result_queue.put(('done', job, None))
+
+
 '''
 A class for connecting to the GitHub API.
-Users mus have their GitHub API credentials stored at ~/.github/github.cfg
+Users must have their GitHub API credentials stored at ~/.github/github.cfg.
+The "auth" section of this file can have a "username" and "password", and / or
+a "tokens" option with a whitespace-separated list of personal access tokens.
+When several credentials are listed, requests are spread across all of them.
 '''
 github_config = ConfigParser.ConfigParser()
 github_config.read(os.path.expanduser(os.path.join('~', '.github', 'github.cfg')))
-github_username = github_config.get('auth', 'username')
-github_password = github_config.get('auth', 'password')
+
+
+def _read_github_authorizations(config):
+
+    authorizations = []
+    if not config.has_section('auth'):
+        logger.warn("No GitHub credentials found.  Requests will be made without authentication.")
+        return [None]
+
+    if config.has_option('auth', 'username') and config.has_option('auth', 'password'):
+        username = config.get('auth', 'username')
+        password = config.get('auth', 'password')
+        authorizations.append("Basic " + base64.b64encode(username + ':' + password))
+
+    if config.has_option('auth', 'tokens'):
+        for token in config.get('auth', 'tokens').replace(',', ' ').split():
+            authorizations.append("token " + token)
+
+    return authorizations if len(authorizations) > 0 else [None]
+
 
 # Define a unique session for each GitHub API calls, for
 # which we can set parameters like the page size.
 GITHUB_API_URL = 'https://api.github.com'
-GITHUB_DELAY = 1  # Max request rate: 5000 / hour -> (1 request / .72s)
+GITHUB_DELAY = 0  # Requests are paced by the rate limit headers the API returns
+GITHUB_SECONDARY_LIMIT_DELAY = 60  # Default wait when a secondary rate limit gives no Retry-After
+GITHUB_RATE_LIMIT_ATTEMPTS = 10  # How many rate-limited responses to wait out for one request
+GITHUB_MAX_ATTEMPTS = 2  # How many times to try a request that fails because of a network error
+GITHUB_RETRY_DELAY = 10
 github_session = requests.Session()
 github_session.headers['User-Agent'] = USER_AGENT
-github_session.headers['Authorization'] =\
-    "Basic " + base64.b64encode(github_username + ':' + github_password)
 github_session.params = {
     'per_page': GITHUB_PAGE_SIZE
 }
 
 
+class GitHubRateLimiter(object):
+    '''
+    Tracks the remaining request quota for each GitHub credential.
+
+    The GitHub API reports the quota left for a credential in the `X-RateLimit-Remaining`
+    header, and when that quota will be refreshed (in epoch seconds) in `X-RateLimit-Reset`.
+    Requests are sent as fast as the caller makes them while some credential has quota left.
+    When all of them have run out, `acquire` sleeps until the earliest reset time.
+    This class is safe to use from several threads at once.
+    '''
+
+    def __init__(self, authorizations):
+        self.lock = threading.Lock()
+        self.remaining = {auth: None for auth in authorizations}
+        self.resets = {auth: 0 for auth in authorizations}
+        self.pause_until = 0
+
+    def acquire(self):
+        ''' Get the credential with the most remaining quota, waiting for a reset if needed. '''
+
+        while True:
+            with self.lock:
+                now = time.time()
+
+                # Quota is replenished for all credentials that have passed their reset time.
+                for auth, reset in self.resets.items():
+                    if self.remaining[auth] is not None and reset <= now:
+                        self.remaining[auth] = None
+
+                # Credentials we haven't heard from yet are assumed to have quota left.
+                available = [
+                    auth for auth, remaining in self.remaining.items()
+                    if remaining is None or remaining > 0
+                ]
+                if now >= self.pause_until and len(available) > 0:
+                    auth = max(
+                        available,
+                        key=lambda a: self.remaining[a] if self.remaining[a] is not None else
+                        float('inf')
+                    )
+                    # Reserve one request from this credential's quota so that other
+                    # threads don't all pick the same credential with one request left.
+                    if self.remaining[auth] is not None:
+                        self.remaining[auth] -= 1
+                    return auth
+
+                if len(available) > 0:
+                    wait_until = self.pause_until
+                else:
+                    wait_until = max(self.pause_until, min(self.resets.values()))
+                delay = max(wait_until - now, 0) + 1
+
+            logger.info("GitHub rate limit reached.  Waiting %d seconds to resume.", int(delay))
+            time.sleep(delay)
+
+    def update(self, auth, response):
+        ''' Record the quota that the API reports after a response for a credential. '''
+
+        if 'X-RateLimit-Remaining' not in response.headers:
+            return
+
+        with self.lock:
+            self.remaining[auth] = int(response.headers['X-RateLimit-Remaining'])
+            if 'X-RateLimit-Reset' in response.headers:
+                self.resets[auth] = int(response.headers['X-RateLimit-Reset'])
+
+    def pause(self, seconds):
+        ''' Stop all requests for some number of seconds (e.g., for a secondary rate limit). '''
+        with self.lock:
+            self.pause_until = max(self.pause_until, time.time() + seconds)
+
+
+github_rate_limiter = GitHubRateLimiter(_read_github_authorizations(github_config))
+
+
+def _is_rate_limited(response):
+
+    if response.status_code not in [403, 429]:
+        return False
+    if 'Retry-After' in response.headers:
+        return True
+    if response.headers.get('X-RateLimit-Remaining') == '0':
+        return True
+    # Secondary rate limits (formerly "abuse detection") are only reported in the message body.
+    return 'rate limit' in response.text.lower()
+
+
+def github_request(url, *args, **kwargs):
+    '''
+    Make a GET request to the GitHub API, waiting out any rate limits.
+    Returns the response, or None if the request failed.  A "304 Not Modified" response to
+    a conditional request (with an 'If-None-Match' header) is returned like any other response.
+    '''
+
+    failed_attempts = 0
+
+    for _ in range(GITHUB_RATE_LIMIT_ATTEMPTS):
+
+        auth = github_rate_limiter.acquire()
+        headers = kwargs.pop('headers', {}).copy()
+        if auth is not None:
+            headers['Authorization'] = auth
+        kwargs['headers'] = headers
+
+        try:
+            response = _send_request(github_session.get, url, *args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as error:
+            logger.warn("Error (%s) for GitHub API call %s", error.__class__.__name__, url)
+            failed_attempts += 1
+            if failed_attempts >= GITHUB_MAX_ATTEMPTS:
+                return None
+            logger.warn("Waiting %d seconds for before retrying.", GITHUB_RETRY_DELAY)
+            time.sleep(GITHUB_RETRY_DELAY)
+            continue
+
+        if response is None:
+            return None
+        # The quota reported in a recorded response is long out of date.
+        if not getattr(response, 'from_cassette', False):
+            github_rate_limiter.update(auth, response)
+
+        if _is_rate_limited(response):
+            if 'Retry-After' in response.headers:
+                github_rate_limiter.pause(int(response.headers['Retry-After']))
+            elif response.headers.get('X-RateLimit-Remaining') != '0':
+                github_rate_limiter.pause(GITHUB_SECONDARY_LIMIT_DELAY)
+            logger.warn("Rate limited by GitHub for API call %s.  Retrying.", url)
+            continue
+
+        if response.status_code not in [200, 304]:
+            logger.warn("Error (%d) for GitHub API call %s", response.status_code, url)
+            return None
+
+        return response
+
+    logger.warn("Giving up on GitHub API call %s after repeated failures.", url)
+    return None
+
+
 def _get_next_page_url(response):
 
     # If there is no "Link" header, then there is no next page
@@ -96,21 +558,136 @@ def _get_next_page_url(response):
 
 
 def github_get(start_url, results_callback, delay=GITHUB_DELAY, *args, **kwargs):
+    '''
+    Fetch all pages of results starting at a GitHub API URL.  `results_callback` is called
+    with the results of each page.  If it returns False, no more pages are fetched.
+    Extra arguments are passed to the request for the first page.
+    The response for the first page is returned so that callers can read its headers
+    (e.g., its ETag).  None is returned instead if the request for any page failed.
+    If the first response is "304 Not Modified", no results are passed to the callback.
+    '''
 
     # Make the first request to the GitHub API
-    response = make_request(github_session.get, start_url, *args, **kwargs)
+    first_response = response = github_request(start_url, *args, **kwargs)
 
     # Notify the calling routine via a callback that results have been returned
-    if response is not None:
-        results_callback(response.json())
+    if response is not None and response.status_code != 304:
+        keep_going = results_callback(response.json()) is not False
 
         # While there is another page to visit, continue to query the GitHub API
         # until there are no more links to follow.  After each round of results,
         # notify the caller of the partial results from that page.
         next_url = _get_next_page_url(response)
-        while response is not None and next_url is not None:
-            response = make_request(github_session.get, next_url)
-            if response is not None:
-                results_callback(response.json())
-                next_url = _get_next_page_url(response)
-                time.sleep(delay)
+        while keep_going and next_url is not None:
+            response = github_request(next_url)
+            if response is None:
+                return None
+            keep_going = results_callback(response.json()) is not False
+            next_url = _get_next_page_url(response)
+            if delay:
+                pause(delay)
+
+    return first_response
+
+
+'''
+A client for the Stack Exchange API.  The API asks that clients make no more than 30
+requests per second.  It can also ask a client to wait before calling a method again by
+including a 'backoff' field (in seconds) in a response, and it reports how many requests
+are left in the client's daily quota in the 'quota_remaining' field.
+See https://api.stackexchange.com/docs/throttle.
+'''
+STACK_EXCHANGE_REQUESTS_PER_SECOND = 30
+STACK_EXCHANGE_MAX_ATTEMPTS = 3  # How many times to try a request that fails
+STACK_EXCHANGE_RETRY_DELAY = 10
+STACK_EXCHANGE_THROTTLE_DELAY = 30  # Default wait when throttled without being told how long
+
+
+class StackExchangeThrottle(object):
+    '''
+    Paces requests to the Stack Exchange API, across any number of threads.
+    Call `wait` before each request, and `update` with the data of each response.
+    '''
+
+    def __init__(self, requests_per_second=STACK_EXCHANGE_REQUESTS_PER_SECOND):
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.lock = threading.Lock()
+        self.pause_until = 0
+        self.quota_remaining = None
+
+    def wait(self):
+        with self.lock:
+            delay = self.pause_until - time.time()
+        if delay > 0:
+            logger.info("Backing off from the Stack Exchange API for %d seconds.", int(delay))
+            pause(delay)
+        self.rate_limiter.wait()
+
+    def update(self, response_data):
+        with self.lock:
+            if 'quota_remaining' in response_data:
+                self.quota_remaining = response_data['quota_remaining']
+            if 'backoff' in response_data:
+                self.pause_until = max(self.pause_until, time.time() + response_data['backoff'])
+
+    def pause(self, seconds):
+        with self.lock:
+            self.pause_until = max(self.pause_until, time.time() + seconds)
+
+    def is_out_of_quota(self):
+        return self.quota_remaining is not None and self.quota_remaining <= 0
+
+
+stack_exchange_throttle = StackExchangeThrottle()
+
+
+def stack_exchange_request(url, params):
+    '''
+    Make a GET request to the Stack Exchange API, obeying any requests to back off.
+    Returns the data from the response, or None if the request failed after
+    several attempts or the daily quota has run out.
+    '''
+
+    for attempt in range(STACK_EXCHANGE_MAX_ATTEMPTS):
+
+        if attempt > 0:
+            logger.warn("Waiting %d seconds for before retrying.", STACK_EXCHANGE_RETRY_DELAY)
+            pause(STACK_EXCHANGE_RETRY_DELAY)
+
+        if stack_exchange_throttle.is_out_of_quota():
+            logger.error("The daily quota for the Stack Exchange API has run out.")
+            return None
+
+        stack_exchange_throttle.wait()
+        try:
+            response = _send_request(default_requests_session.get, url, params=params)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as error:
+            logger.warn("Error (%s) for Stack Exchange API call %s", error.__class__.__name__, url)
+            continue
+
+        if response is None:
+            return None
+        try:
+            data = response.json()
+        except ValueError:
+            logger.warn("Error (%d) for Stack Exchange API call %s", response.status_code, url)
+            continue
+
+        stack_exchange_throttle.update(data)
+        if response.status_code == 200:
+            return data
+
+        # A throttle violation means we have to stop making requests for a while.
+        # The error message says how long to wait, e.g.,
+        # "too many requests from this IP, more requests available in 59 seconds"
+        logger.warn(
+            "Error (%d: %s) for Stack Exchange API call %s",
+            response.status_code, data.get('error_message'), url
+        )
+        if data.get('error_name') == 'throttle_violation':
+            match = re.search(r'(\d+) seconds', data.get('error_message', ''))
+            stack_exchange_throttle.pause(
+                int(match.group(1)) if match else STACK_EXCHANGE_THROTTLE_DELAY)
+
+    logger.warn("Giving up on Stack Exchange API call %s after repeated failures.", url)
+    return None
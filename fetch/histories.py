@@ -4,29 +4,73 @@
 from __future__ import unicode_literals
 import logging
 from peewee import fn
-import time
 import datetime
 
-from fetch.api import make_request, default_requests_session
+from fetch.api import make_request, default_requests_session, RateLimiter, WorkerPool
 from lock import lock_method
-from models import SearchResult, WebPageVersion
+from models import SearchResult, WebPageVersion, BatchInserter, max_batch_size
 
 
 logger = logging.getLogger('data')
 ARCHIVE_URL = 'http://web.archive.org/cdx/search/cdx'
+PAGE_SIZE = 1000
 DEFAULT_PARAMS = {
-    'limit': 50,  # default page size for CDX pagination
+    'limit': PAGE_SIZE,  # page size for CDX pagination
     'output': 'json',
     'showResumeKey': 'true',  # lightweight pagination of results
 }
 REQUEST_DELAY = 1.5
+REQUESTS_PER_SECOND = 1 / REQUEST_DELAY
+DEFAULT_WORKERS = 4
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
 LOCK_FILENAME = '/tmp/histories-fetcher.lock'
 
 
-def get_history(url, fetch_index):
+def get_histories(urls, fetch_index, workers=DEFAULT_WORKERS,
+                  requests_per_second=REQUESTS_PER_SECOND, incremental=False):
+
+    # Histories for several URLs are fetched at once.  The rate limiter is shared by all
+    # workers, so that together they don't bombard the server with requests.
+    # Every page of records is saved from this thread, as it is handed back by a worker.
+    rate_limiter = RateLimiter(requests_per_second)
+
+    # In an incremental refresh, we only ask for the captures of each URL that were made
+    # at or after the newest capture we already have.  All older captures stay where they
+    # are: a version is only ever stored once, so each fetch index only holds the versions
+    # that were new when it was fetched.
+    latest_timestamps = load_latest_timestamps() if incremental else {}
+
+    def fetch_history(url, emit):
+        get_history(url, emit, rate_limiter, since=latest_timestamps.get(url))
+
+    # The timestamps of the versions already stored for each URL are loaded once, when the
+    # first page of its history arrives, so that we don't have to look up each new record.
+    saved_timestamps = {}
+
+    def save_records_callback(url, records):
+        if url not in saved_timestamps:
+            saved_timestamps[url] = load_saved_timestamps(url)
+        save_records(url, records, fetch_index, saved_timestamps[url])
+
+    def finish_url(url):
+        saved_timestamps.pop(url, None)
+
+    worker_pool = WorkerPool(fetch_history, workers)
+    for url in urls:
+        worker_pool.add_job(url)
+    worker_pool.run(results_callback=save_records_callback, done_callback=finish_url)
+
+
+def get_history(url, results_callback, rate_limiter, since=None):
+    '''
+    Fetch all versions of a URL from the Wayback Machine, one page of records at a time.
+    If `since` is a datetime, only versions captured at or after that time are fetched.
+    '''
 
     params = DEFAULT_PARAMS.copy()
     params['url'] = url
+    if since is not None:
+        params['from'] = since.strftime(TIMESTAMP_FORMAT)
 
     # Flags for controlling paging and scanning results
     more_results = True
@@ -35,12 +79,13 @@ def get_history(url, fetch_index):
     while more_results:
 
         more_results = False
+        rate_limiter.wait()
         response = make_request(default_requests_session.get, ARCHIVE_URL, params=params)
-        time.sleep(REQUEST_DELAY)  # Pause so that we don't bombard the server with requests
 
         if response is None:
             break
         results = response.json()
+        records = []
 
         for result_index, result in enumerate(results):
 
@@ -64,61 +109,114 @@ def get_history(url, fetch_index):
 
             # If the code has made it this far, this record is a web
             # page version, and we want to save it.
-            data = dict(zip(field_names, result))
-            _save_record(url, data, fetch_index)
+            records.append(dict(zip(field_names, result)))
+
+        results_callback(records)
+
+
+def load_latest_timestamps():
+    ''' Get a map from each URL to the timestamp of its newest saved version. '''
+    latest_versions = (
+        WebPageVersion
+        .select(WebPageVersion.url, fn.Max(WebPageVersion.timestamp))
+        .group_by(WebPageVersion.url)
+        .tuples()
+    )
+    return {url: timestamp for url, timestamp in latest_versions}
+
+
+def load_saved_timestamps(url):
+    ''' Get the set of timestamps of all versions of a URL that have already been saved. '''
+    versions = (
+        WebPageVersion
+        .select(WebPageVersion.timestamp)
+        .where(WebPageVersion.url == url)
+        .tuples()
+    )
+    return set([timestamp for timestamp, in versions])
+
+
+def save_records(url, records, fetch_index, saved_timestamps):
+    '''
+    Save a page of CDX records for a URL in one transaction.  Records with a timestamp in
+    `saved_timestamps` are skipped, and the timestamps of new records are added to it.
+    '''
+
+    batch_inserter = BatchInserter(WebPageVersion, batch_size=max_batch_size(WebPageVersion))
+
+    with WebPageVersion._meta.database.atomic():
+        for record in records:
+            # We'll create a new record for the version only if it doesn't yet exist.
+            row = _make_row(url, record, fetch_index)
+            if row is None or row['timestamp'] in saved_timestamps:
+                continue
+            saved_timestamps.add(row['timestamp'])
+            batch_inserter.insert(row)
+
+        batch_inserter.flush()
 
 
-def _save_record(url, record, fetch_index):
+def _make_row(url, record, fetch_index):
 
     # Convert string for the timestamp into a proper datetime object
     try:
         timestamp_datetime = datetime.datetime.strptime(
             record['timestamp'],
-            '%Y%m%d%H%M%S',
+            TIMESTAMP_FORMAT,
         )
     except ValueError:
         logger.warn("Invalid timestamp '%s' for URL %s.  Skipping record", record['timestamp'], url)
-        return
+        return None
 
-    # We'll create a new record for the version only if it doesn't yet exist.
+    # In a few exceptional cases, I've found that the length has
+    # the value '-'.  We store a null length when we encounter '-'.
     try:
-        WebPageVersion.get(
-            url=url,
-            timestamp=timestamp_datetime,
-        )
-    except WebPageVersion.DoesNotExist:
-
-        # In a few exceptional cases, I've found that the length has
-        # the value '-'.  We store a null length when we encounter '-'.
-        try:
-            length = int(record['length'])
-        except ValueError:
-            logger.warn("Length '%s' is not an integer for URL %s", record['length'], url)
-            length = None
-
-        WebPageVersion.create(
-            fetch_index=fetch_index,
-            url=url,
-            url_key=record['urlkey'],
-            timestamp=timestamp_datetime,
-            original=record['original'],
-            mime_type=record['mimetype'],
-            status_code=record['statuscode'],
-            digest=record['digest'],
-            length=length,
-        )
+        length = int(record['length'])
+    except ValueError:
+        logger.warn("Length '%s' is not an integer for URL %s", record['length'], url)
+        length = None
+
+    return {
+        'fetch_index': fetch_index,
+        'url': url,
+        'url_key': record['urlkey'],
+        'timestamp': timestamp_datetime,
+        'original': record['original'],
+        'mime_type': record['mimetype'],
+        'status_code': record['statuscode'],
+        'digest': record['digest'],
+        'length': length,
+    }
 
 
 @lock_method(LOCK_FILENAME)
-def main(*args, **kwargs):
+def main(workers, requests_per_second, incremental, *args, **kwargs):
 
     # Create a new fetch index.
     last_fetch_index = WebPageVersion.select(fn.Max(WebPageVersion.fetch_index)).scalar() or 0
     fetch_index = last_fetch_index + 1
     search_results = SearchResult.select(SearchResult.url).distinct()
-    for search_result in search_results:
-        get_history(search_result.url, fetch_index)
+    urls = [search_result.url for search_result in search_results]
+    get_histories(urls, fetch_index, workers, requests_per_second, incremental)
 
 
 def configure_parser(parser):
     parser.description = "Get Internet Archive histories for all stored search results."
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of URLs to fetch histories for at once (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--requests-per-second',
+        type=float,
+        default=REQUESTS_PER_SECOND,
+        help="Maximum rate of requests to the Wayback Machine, across all workers " +
+             "(default: %(default).2f)."
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="Only download the captures of each URL made since its newest saved version."
+    )
@@ -4,22 +4,23 @@
 from __future__ import unicode_literals
 import logging
 from peewee import fn
-import functools
 import re
 from progressbar import ProgressBar, Percentage, Bar, ETA, Counter, RotatingMarker
 
-from fetch.api import github_get, GITHUB_API_URL
+from fetch.api import GITHUB_API_URL, WorkerPool
+from fetch._sync import get_sync_cursors, save_sync_cursor, fetch_changes
 from models import GitHubProject, Issue, IssueComment, BatchInserter
 from lock import lock_method
 
 
 logger = logging.getLogger('data')
 LOCK_FILENAME = '/tmp/issue-comments-fetcher.lock'
-issue_cache = {}
+DEFAULT_WORKERS = 4
+SYNC_RESOURCE = 'comments'
 batch_inserter = BatchInserter(IssueComment, batch_size=100)
 
 
-def get_issue_comments(show_progress):
+def get_issue_comments(show_progress, workers=DEFAULT_WORKERS, incremental=False):
 
     # Retrieve the list of all projects for which issue comments should be fetched.
     github_projects = (
@@ -42,27 +43,62 @@ def get_issue_comments(show_progress):
     fetch_index = last_fetch_index + 1
     issue_fetch_index = Issue.select(fn.Max(Issue.fetch_index)).scalar() or 0
 
-    for project_index, project in enumerate(github_projects, start=1):
-
-        # Wrap a callback that will save fetched comments
-        save_comments_callback = functools.partial(
-            save_comments,
-            project=project,
-            fetch_index=fetch_index,
-            issue_fetch_index=issue_fetch_index,
+    # In an incremental sync, we only ask for the comments that have changed since the
+    # last sync, with a conditional request (see the `issues` module for more details).
+    sync_cursors = get_sync_cursors(SYNC_RESOURCE) if incremental else {}
+    sync_results = {}
+    fetched_comment_ids = {}
+
+    # Comments are linked to issues through a map from issue numbers to the IDs of the latest
+    # versions of the issues.  The map for a project is loaded when its first comments arrive,
+    # and is discarded once all of its comments have been saved.
+    issue_indexes = {}
+
+    def get_issue_index(project):
+        project_key = (project.owner, project.repo)
+        if project_key not in issue_indexes:
+            issue_indexes[project_key] = load_issue_index(project, issue_fetch_index)
+        return issue_indexes[project_key]
+
+    # Fetch all comments for all issues for each project.  Several projects are fetched at once,
+    # and their comments are saved from this thread as they are handed back by the workers.
+    def fetch_comments(project, emit):
+        params = {'sort': 'updated', 'direction': 'asc'} if incremental else {}
+        sync_results[(project.owner, project.repo)] = fetch_changes(
+            GITHUB_API_URL + '/repos/' + project.owner + '/' + project.repo + '/issues/comments',
+            sync_cursors.get((project.owner, project.repo)), params,
+            results_callback=emit, incremental=incremental,
         )
 
-        # Fetch all comments for all issues for the project
-        github_get(
-            start_url=(
-                GITHUB_API_URL + '/repos/' + project.owner + '/' +
-                project.repo + '/issues/comments'
-            ),
-            results_callback=save_comments_callback,
-        )
+    def save_comments_callback(project, comments):
+        save_comments(comments, issue_index=get_issue_index(project), fetch_index=fetch_index)
+        project_key = (project.owner, project.repo)
+        fetched_comment_ids.setdefault(project_key, set()).update([c['id'] for c in comments])
+
+    def finish_project(project):
+
+        project_key = (project.owner, project.repo)
+        cursor = sync_cursors.get(project_key)
+        if cursor is not None:
+            carry_forward_comments(
+                project, cursor.fetch_index, fetch_index, get_issue_index(project),
+                fetched_comment_ids.get(project_key, set())
+            )
+        issue_indexes.pop(project_key, None)
+
+        # Only advance the cursor if all pages of comments were fetched.
+        response, since, etag = sync_results.get(project_key, (None, None, None))
+        if response is not None:
+            save_sync_cursor(
+                project.owner, project.repo, SYNC_RESOURCE, fetch_index, since=since, etag=etag)
 
         if show_progress:
-            progress_bar.update(project_index)
+            progress_bar.update(progress_bar.currval + 1)
+
+    worker_pool = WorkerPool(fetch_comments, workers)
+    for project in github_projects:
+        worker_pool.add_job(project)
+    worker_pool.run(results_callback=save_comments_callback, done_callback=finish_project)
 
     if show_progress:
         progress_bar.finish()
@@ -71,40 +107,32 @@ def get_issue_comments(show_progress):
     batch_inserter.flush()
 
 
-def save_comments(comments, project, fetch_index, issue_fetch_index):
+def load_issue_index(project, issue_fetch_index):
+    ''' Map the numbers of a project's issues to the IDs of the issues from one fetch. '''
+    issues = (
+        Issue
+        .select(Issue.number, Issue.id)
+        .join(GitHubProject)
+        .where(
+            GitHubProject.repo == project.repo,
+            GitHubProject.owner == project.owner,
+            Issue.fetch_index == issue_fetch_index,
+        )
+        .tuples()
+    )
+    return {number: issue_id for number, issue_id in issues}
 
-    # This inline function provides a unique key for caching issues based
-    # on the number of the issue and the project.
-    make_issue_key = lambda project, issue_number:\
-        project.owner + '/' + project.repo + '/' + str(issue_number)
+
+def save_comments(comments, issue_index, fetch_index):
 
     for comment in comments:
 
         # Get the number of the issue that is associated with this comment
-        issue_number = re.match('.*/issues/(\d+)$', comment['issue_url']).group(1)
-
-        # Check the cache for the associated issue.  If it's not present in the cache,
-        # fetch it and then store it in the cache.
-        # We query only for a specific version of the issue (fetched with a certain fetch index).
-        issue_key = make_issue_key(project, issue_number)
-        if issue_key not in issue_cache:
-            latest_issue_version = (
-                Issue
-                .select()
-                .join(GitHubProject)
-                .where(
-                    GitHubProject.repo == project.repo,
-                    GitHubProject.owner == project.owner,
-                    Issue.number == issue_number,
-                    Issue.fetch_index == issue_fetch_index,
-                )
-            )
-            issue_cache[issue_key] = latest_issue_version.first()\
-                if latest_issue_version.count() != 0 else None
+        issue_number = int(re.match('.*/issues/(\d+)$', comment['issue_url']).group(1))
 
-        # Retrive the issue from the cache.  If it is found, then create a comment
+        # Look up the issue in the project's index.  If it is found, then create a comment
         # associated with this issue.
-        issue = issue_cache[issue_key]
+        issue = issue_index.get(issue_number)
         if issue is not None:
             batch_inserter.insert({
                 'fetch_index': fetch_index,
@@ -117,9 +145,39 @@ def save_comments(comments, project, fetch_index, issue_fetch_index):
             })
 
 
+def carry_forward_comments(
+        project, previous_fetch_index, fetch_index, issue_index, fetched_comment_ids):
+    '''
+    Copy the comments for a project from an earlier fetch into the latest fetch, except for
+    the comments that were just fetched, so that the latest fetch is a full snapshot.
+    The copied comments are linked to the latest versions of their issues.
+    '''
+    previous_comments = (
+        IssueComment
+        .select(IssueComment, Issue.number)
+        .join(Issue)
+        .join(GitHubProject)
+        .where(
+            GitHubProject.owner == project.owner,
+            GitHubProject.repo == project.repo,
+            IssueComment.fetch_index == previous_fetch_index,
+        )
+        .dicts()
+    )
+    for comment in previous_comments:
+        if comment['github_id'] in fetched_comment_ids:
+            continue
+        issue = issue_index.get(comment.pop('number'))
+        if issue is not None:
+            del comment['id']
+            comment['fetch_index'] = fetch_index
+            comment['issue'] = issue
+            batch_inserter.insert(comment)
+
+
 @lock_method(LOCK_FILENAME)
-def main(show_progress, *args, **kwargs):
-    get_issue_comments(show_progress)
+def main(show_progress, workers, incremental, *args, **kwargs):
+    get_issue_comments(show_progress, workers, incremental)
 
 
 def configure_parser(parser):
@@ -129,3 +187,15 @@ def configure_parser(parser):
         action='store_true',
         help="Show progress of the number of projects for which issue comments have been saved."
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of projects to fetch comments for at once (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="Only download comments that have changed since the last fetch.  Comments that " +
+             "haven't changed are copied from the last fetch into this fetch."
+    )
@@ -4,21 +4,22 @@
 from __future__ import unicode_literals
 import logging
 from peewee import fn
-import functools
 from progressbar import ProgressBar, Percentage, Bar, ETA, Counter, RotatingMarker
 
-from fetch.api import github_get, GITHUB_API_URL
+from fetch.api import github_get, GITHUB_API_URL, WorkerPool
+from fetch._sync import get_sync_cursors, save_sync_cursor, make_conditional_request_args
 from models import GitHubProject, Issue, IssueEvent, BatchInserter
 from lock import lock_method
 
 
 logger = logging.getLogger('data')
 LOCK_FILENAME = '/tmp/issue-events-fetcher.lock'
-issue_cache = {}
+DEFAULT_WORKERS = 4
+SYNC_RESOURCE = 'events'
 batch_inserter = BatchInserter(IssueEvent, batch_size=100)
 
 
-def get_issue_events(show_progress):
+def get_issue_events(show_progress, workers=DEFAULT_WORKERS, incremental=False):
 
     # Retrieve the list of all projects for which issue events should be fetched.
     github_projects = (
@@ -41,27 +42,77 @@ def get_issue_events(show_progress):
     fetch_index = last_fetch_index + 1
     issue_fetch_index = Issue.select(fn.Max(Issue.fetch_index)).scalar() or 0
 
-    for project_index, project in enumerate(github_projects, start=1):
-
-        # Wrap a callback that will save fetched events
-        save_events_callback = functools.partial(
-            save_events,
-            project=project,
-            fetch_index=fetch_index,
-            issue_fetch_index=issue_fetch_index,
-        )
-
-        # Fetch all events for all issues for the project
-        github_get(
+    # The events endpoint has no 'since' parameter, though it lists the newest events first.
+    # So in an incremental sync, we stop paging through events once we reach an event we have
+    # already seen.  As for issues, the first request is conditional so that it costs nothing
+    # against our rate limit if there are no new events.
+    sync_cursors = get_sync_cursors(SYNC_RESOURCE) if incremental else {}
+    first_responses = {}
+    latest_ids = {}
+
+    # Events are linked to issues through a map from issues' GitHub IDs to the IDs of the latest
+    # versions of the issues.  The map for a project is loaded when its first events arrive,
+    # and is discarded once all of its events have been saved.
+    issue_indexes = {}
+
+    def get_issue_index(project):
+        project_key = (project.owner, project.repo)
+        if project_key not in issue_indexes:
+            issue_indexes[project_key] = load_issue_index(project, issue_fetch_index)
+        return issue_indexes[project_key]
+
+    # Fetch all events for all issues for each project.  Several projects are fetched at once,
+    # and their events are saved from this thread as they are handed back by the workers.
+    def fetch_events(project, emit):
+
+        cursor = sync_cursors.get((project.owner, project.repo))
+        last_id = cursor.last_id if cursor is not None else None
+
+        def emit_new_events(events):
+            new_events = [e for e in events if last_id is None or e['id'] > last_id]
+            emit(new_events)
+            return len(new_events) == len(events)
+
+        first_responses[(project.owner, project.repo)] = github_get(
             start_url=(
                 GITHUB_API_URL + '/repos/' + project.owner + '/' +
                 project.repo + '/issues/events'
             ),
-            results_callback=save_events_callback,
+            results_callback=emit_new_events,
+            **make_conditional_request_args(cursor, {})
         )
 
+    def save_events_callback(project, events):
+        save_events(events, issue_index=get_issue_index(project), fetch_index=fetch_index)
+        project_key = (project.owner, project.repo)
+        for event in events:
+            latest_ids[project_key] = max(latest_ids.get(project_key, 0), event['id'])
+
+    def finish_project(project):
+
+        project_key = (project.owner, project.repo)
+        cursor = sync_cursors.get(project_key)
+        if cursor is not None:
+            carry_forward_events(
+                project, cursor.fetch_index, fetch_index, get_issue_index(project))
+        issue_indexes.pop(project_key, None)
+
+        # Only advance the cursor if all pages of events were fetched.
+        response = first_responses.get(project_key)
+        if response is not None:
+            save_sync_cursor(
+                project.owner, project.repo, SYNC_RESOURCE, fetch_index,
+                last_id=latest_ids.get(project_key, cursor.last_id if cursor else None),
+                etag=response.headers.get('ETag') if incremental else None,
+            )
+
         if show_progress:
-            progress_bar.update(project_index)
+            progress_bar.update(progress_bar.currval + 1)
+
+    worker_pool = WorkerPool(fetch_events, workers)
+    for project in github_projects:
+        worker_pool.add_job(project)
+    worker_pool.run(results_callback=save_events_callback, done_callback=finish_project)
 
     if show_progress:
         progress_bar.finish()
@@ -70,7 +121,23 @@ def get_issue_events(show_progress):
     batch_inserter.flush()
 
 
-def save_events(events, project, fetch_index, issue_fetch_index):
+def load_issue_index(project, issue_fetch_index):
+    ''' Map the GitHub IDs of a project's issues to the IDs of the issues from one fetch. '''
+    issues = (
+        Issue
+        .select(Issue.github_id, Issue.id)
+        .join(GitHubProject)
+        .where(
+            GitHubProject.repo == project.repo,
+            GitHubProject.owner == project.owner,
+            Issue.fetch_index == issue_fetch_index,
+        )
+        .tuples()
+    )
+    return {github_id: issue_id for github_id, issue_id in issues}
+
+
+def save_events(events, issue_index, fetch_index):
 
     for event in events:
 
@@ -79,27 +146,9 @@ def save_events(events, project, fetch_index, issue_fetch_index):
         if event['issue'] is None:
             continue
 
-        # Get the ID of the issue that is associated with this event
-        issue_id = event['issue']['id']
-
-        # Check the cache for the associated issue.  If it's not present in the cache,
-        # fetch it and then store it in the cache.
-        # We query only for a specific version of the issue (fetched with a certain fetch index).
-        if issue_id not in issue_cache:
-            latest_issue_version = (
-                Issue
-                .select()
-                .where(
-                    Issue.github_id == issue_id,
-                    Issue.fetch_index == issue_fetch_index,
-                )
-            )
-            issue_cache[issue_id] = latest_issue_version.first()\
-                if latest_issue_version.count() != 0 else None
-
-        # Retrive the issue from the cache.  If it is found, then create a event
+        # Look up the issue in the project's index.  If it is found, then create an event
         # associated with this issue.
-        issue = issue_cache[issue_id]
+        issue = issue_index.get(event['issue']['id'])
         if issue is not None:
             batch_inserter.insert({
                 'fetch_index': fetch_index,
@@ -110,9 +159,36 @@ def save_events(events, project, fetch_index, issue_fetch_index):
             })
 
 
+def carry_forward_events(project, previous_fetch_index, fetch_index, issue_index):
+    '''
+    Copy the events for a project from an earlier fetch into the latest fetch, so that the
+    latest fetch is a full snapshot.  Events don't change once they are created, so all
+    events from the earlier fetch are copied, linked to the latest versions of their issues.
+    '''
+    previous_events = (
+        IssueEvent
+        .select(IssueEvent, Issue.github_id.alias('issue_github_id'))
+        .join(Issue)
+        .join(GitHubProject)
+        .where(
+            GitHubProject.owner == project.owner,
+            GitHubProject.repo == project.repo,
+            IssueEvent.fetch_index == previous_fetch_index,
+        )
+        .dicts()
+    )
+    for event in previous_events:
+        issue = issue_index.get(event.pop('issue_github_id'))
+        if issue is not None:
+            del event['id']
+            event['fetch_index'] = fetch_index
+            event['issue'] = issue
+            batch_inserter.insert(event)
+
+
 @lock_method(LOCK_FILENAME)
-def main(show_progress, *args, **kwargs):
-    get_issue_events(show_progress)
+def main(show_progress, workers, incremental, *args, **kwargs):
+    get_issue_events(show_progress, workers, incremental)
 
 
 def configure_parser(parser):
@@ -122,3 +198,15 @@ def configure_parser(parser):
         action='store_true',
         help="Show progress of the number of projects for which issue events have been saved."
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of projects to fetch events for at once (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="Only download events that are new since the last fetch.  Events from the " +
+             "last fetch are copied into this fetch."
+    )
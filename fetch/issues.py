@@ -5,11 +5,11 @@ from __future__ import unicode_literals
 import logging
 from peewee import fn
 import json
-import functools
 from progressbar import ProgressBar, Percentage, Bar, ETA, Counter, RotatingMarker
 
-from fetch.api import github_get, GITHUB_API_URL
-from models import GitHubProject, Issue
+from fetch.api import GITHUB_API_URL, WorkerPool
+from fetch._sync import get_sync_cursors, save_sync_cursor, fetch_changes
+from models import GitHubProject, Issue, BatchInserter, max_batch_size
 from lock import lock_method
 
 
@@ -17,9 +17,11 @@ logger = logging.getLogger('data')
 
 
 LOCK_FILENAME = '/tmp/issues-fetcher.lock'
+DEFAULT_WORKERS = 4
+SYNC_RESOURCE = 'issues'
 
 
-def get_issues_for_projects(projects, show_progress):
+def get_issues_for_projects(projects, show_progress, workers=DEFAULT_WORKERS, incremental=False):
 
     if show_progress:
         progress_bar = ProgressBar(maxval=len(projects), widgets=[
@@ -34,63 +36,128 @@ def get_issues_for_projects(projects, show_progress):
     last_fetch_index = GitHubProject.select(fn.Max(GitHubProject.fetch_index)).scalar() or 0
     fetch_index = last_fetch_index + 1
 
-    for project_index, project in enumerate(projects, start=1):
-
-        # Create a new record for the project based on the JSON specification
-        project = GitHubProject.create(
+    # Create records for all projects before fetching starts, so that projects are
+    # saved in the order they were listed no matter which order their fetches finish in.
+    project_records = []
+    for project in projects:
+        project_records.append(GitHubProject.create(
             fetch_index=fetch_index,
             name=project['name'],
             owner=project['owner'],
             repo=project['repo'],
+        ))
+
+    # In an incremental sync, we only ask for the issues of a project that have changed since
+    # the last sync.  We make this a conditional request, so if nothing has changed at all,
+    # GitHub responds with a "304 Not Modified" that doesn't count against our rate limit.
+    # Issues are sorted by update time so that if a fetch stops partway through, the latest
+    # update time we have seen still marks a point before which we have seen all changes.
+    sync_cursors = get_sync_cursors(SYNC_RESOURCE) if incremental else {}
+    sync_results = {}
+    fetched_issue_ids = {}
+
+    # Issues are held in memory until all pages for a project have been fetched.  Then
+    # they are saved in one transaction, so that a project's issues appear all at once.
+    fetched_issues = {}
+
+    # Fetch all issues for each project from GitHub.  Several projects are fetched at once.
+    # All issues are saved from this thread, as they are handed back by the workers.
+    def fetch_issues(project, emit):
+        params = {'state': 'all'}
+        if incremental:
+            params.update({'sort': 'updated', 'direction': 'asc'})
+        sync_results[project.id] = fetch_changes(
+            GITHUB_API_URL + '/repos/' + project.owner + '/' + project.repo + '/issues',
+            sync_cursors.get((project.owner, project.repo)), params,
+            results_callback=emit, incremental=incremental,
         )
 
-        # Wrap a callback that will save issues associated to this project and fetch index.
-        save_issues_callback = functools.partial(
-            save_issues,
-            project=project,
-            fetch_index=fetch_index,
-        )
+    def save_issues_callback(project, issues):
+        fetched_issues.setdefault(project.id, []).extend(issues)
+        fetched_issue_ids.setdefault(project.id, set()).update([i['id'] for i in issues])
 
-        # Fetch all issues for the project from GitHub
-        github_get(
-            start_url=GITHUB_API_URL + '/repos/' + project.owner + '/' + project.repo + '/issues',
-            results_callback=save_issues_callback,
-            params={
-                'state': 'all',
-            }
-        )
+    def finish_project(project):
+
+        cursor = sync_cursors.get((project.owner, project.repo))
+        with Issue._meta.database.atomic():
+            save_issues(fetched_issues.pop(project.id, []), project, fetch_index)
+            if cursor is not None:
+                carry_forward_issues(
+                    project, cursor.fetch_index, fetch_index,
+                    fetched_issue_ids.get(project.id, set())
+                )
+
+        # Only advance the cursor if all pages of issues were fetched.
+        response, since, etag = sync_results.get(project.id, (None, None, None))
+        if response is not None:
+            save_sync_cursor(
+                project.owner, project.repo, SYNC_RESOURCE, fetch_index, since=since, etag=etag)
 
         if show_progress:
-            progress_bar.update(project_index)
+            progress_bar.update(progress_bar.currval + 1)
+
+    worker_pool = WorkerPool(fetch_issues, workers)
+    for project in project_records:
+        worker_pool.add_job(project)
+    worker_pool.run(results_callback=save_issues_callback, done_callback=finish_project)
 
     if show_progress:
         progress_bar.finish()
 
 
+def carry_forward_issues(project, previous_fetch_index, fetch_index, fetched_issue_ids):
+    '''
+    Copy the issues for a project from an earlier fetch into the latest fetch, except
+    for the issues that were just fetched, so that the latest fetch is a full snapshot.
+    '''
+    batch_inserter = BatchInserter(Issue, batch_size=max_batch_size(Issue))
+    previous_issues = (
+        Issue
+        .select()
+        .join(GitHubProject)
+        .where(
+            GitHubProject.owner == project.owner,
+            GitHubProject.repo == project.repo,
+            Issue.fetch_index == previous_fetch_index,
+        )
+        .dicts()
+    )
+    for issue in previous_issues:
+        if issue['github_id'] in fetched_issue_ids:
+            continue
+        del issue['id']
+        issue['fetch_index'] = fetch_index
+        issue['project'] = project.id
+        batch_inserter.insert(issue)
+    batch_inserter.flush()
+
+
 def save_issues(issues, project, fetch_index):
+    batch_inserter = BatchInserter(Issue, batch_size=max_batch_size(Issue))
     for issue in issues:
-        Issue.create(
-            fetch_index=fetch_index,
-            github_id=issue['id'],
-            project=project,
-            number=issue['number'],
-            created_at=issue['created_at'],
-            updated_at=issue['updated_at'],
-            closed_at=issue['closed_at'],
-            state=issue['state'],
-            body=issue['body'],
-            comments=issue['comments'],
-            user_id=issue['user']['id'],
-        )
+        batch_inserter.insert({
+            'fetch_index': fetch_index,
+            'github_id': issue['id'],
+            'project': project,
+            'number': issue['number'],
+            'created_at': issue['created_at'],
+            'updated_at': issue['updated_at'],
+            'closed_at': issue['closed_at'],
+            'state': issue['state'],
+            'body': issue['body'],
+            'comments': issue['comments'],
+            'user_id': issue['user']['id'],
+        })
+    batch_inserter.flush()
 
 
 @lock_method(LOCK_FILENAME)
-def main(projects, show_progress, *args, **kwargs):
+def main(projects, show_progress, workers, incremental, *args, **kwargs):
 
     # Fetch autocomplete results
     with open(projects) as projects_file:
         project_list = json.load(projects_file)
-        get_issues_for_projects(project_list, show_progress)
+        get_issues_for_projects(project_list, show_progress, workers, incremental)
 
 
 def configure_parser(parser):
@@ -104,3 +171,15 @@ def configure_parser(parser):
         action='store_true',
         help="Show progress of the number of projects for which issues have been saved."
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of projects to fetch issues for at once (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="Only download issues that have changed since the last fetch.  Issues that " +
+             "haven't changed are copied from the last fetch into this fetch."
+    )
@@ -5,10 +5,8 @@ from __future__ import unicode_literals
 import logging
 from xml.etree import ElementTree
 from peewee import fn
-import time
 
-
-from fetch.api import make_request, default_requests_session
+from fetch.api import make_request, default_requests_session, RateLimiter, WorkerPool
 from models import Query, Seed
 from lock import lock_method
 
@@ -25,103 +23,312 @@ DEFAULT_PARAMS = {
 MAX_RESULTS = 10
 ALPHABET = " abcdefghijklmnopqrstuvwxyz0123456789.'-_"
 REQUEST_DELAY = 1.5
+REQUESTS_PER_SECOND = 1 / REQUEST_DELAY
+DEFAULT_WORKERS = 4
+PRUNING_POLICIES = ['none', 'prefix', 'overlap']
+OVERLAP_THRESHOLD = 0.8
 LOCK_FILENAME = '/tmp/query-fetcher.lock'
 
 
-def get_results_for_seeds(seeds, max_depth):
+def get_results_for_seeds(seeds, max_depth, workers=DEFAULT_WORKERS,
+                          requests_per_second=REQUESTS_PER_SECOND, prune='none',
+                          overlap_threshold=OVERLAP_THRESHOLD):
 
     # Create a new fetch index.
     last_fetch_index = Seed.select(fn.Max(Seed.fetch_index)).scalar() or 0
     fetch_index = last_fetch_index + 1
 
+    # Create a new seed record from the text of each seed
+    seed_records = []
     for seed_text in seeds:
-
-        # Create a new seed record from the text
-        seed = Seed.create(
+        seed_records.append(Seed.create(
             fetch_index=fetch_index,
             seed=seed_text,
             depth=0,
+        ))
+
+    crawl(seed_records, max_depth, workers, requests_per_second, prune, overlap_threshold)
+
+
+def resume_crawl(fetch_index, max_depth, workers=DEFAULT_WORKERS,
+                 requests_per_second=REQUESTS_PER_SECOND, prune='none',
+                 overlap_threshold=OVERLAP_THRESHOLD):
+    '''
+    Continue a crawl that was interrupted.  All seeds from the crawl's fetch index that
+    haven't been fetched yet (including seeds for which fetching failed) are crawled again.
+    '''
+    unfetched_seeds = (
+        Seed
+        .select()
+        .where(
+            Seed.fetch_index == fetch_index,
+            Seed.status != 'fetched',
         )
+        .order_by(Seed.depth, Seed.id)
+    )
+    logger.info("Resuming crawl %d with %d unfetched seeds.", fetch_index, unfetched_seeds.count())
+    crawl(
+        list(unfetched_seeds), max_depth, workers, requests_per_second,
+        prune, overlap_threshold
+    )
 
-        # Fetch the autocomplete results!
-        get_results(seed, max_depth)
 
+def crawl(seeds, max_depth, workers, requests_per_second, prune, overlap_threshold):
+
+    # Seeds are crawled from a queue rather than by recursion.  Each seed that yields a
+    # full set of results is expanded into new seeds, which are added to the back of the
+    # queue.  This visits seeds in breadth-first order.  Requests for several seeds are
+    # made at once, though the rate limiter enforces a pause between any two requests
+    # to be respectful to the API.
+    # As every seed is saved with its status, the seeds that haven't been fetched
+    # yet are the frontier of the crawl, from which it can be resumed.
+    rate_limiter = RateLimiter(requests_per_second)
+    pruned_seed_counts = []
+
+    def fetch_seed_suggestions(seed, emit):
+        rate_limiter.wait()
+        emit(fetch_suggestions(seed.seed))
+
+    def save_seed_suggestions(seed, suggestions):
+        if suggestions is None:
+            Seed.update(status='failed').where(Seed.id == seed.id).execute()
+            return
+        new_seeds = save_results(seed, suggestions, max_depth, prune, overlap_threshold)
+        for new_seed in new_seeds:
+            worker_pool.add_job(new_seed)
+        if should_expand(seed.depth, suggestions, max_depth):
+            pruned_seed_counts.append(
+                len(get_expansion_chars(seed.seed, seed.depth)) - len(new_seeds))
+
+    worker_pool = WorkerPool(fetch_seed_suggestions, workers)
+    for seed in seeds:
+        worker_pool.add_job(seed)
+
+    # Fetch the autocomplete results!
+    worker_pool.run(results_callback=save_seed_suggestions)
+
+    # Each seed that was pruned is at least one request that we didn't have to make
+    # (and more, as none of the seeds it would have been expanded into were requested).
+    if prune != 'none':
+        logger.info(
+            "Pruned %d seeds (policy: %s).  At least %d requests were saved versus full expansion.",
+            sum(pruned_seed_counts), prune, sum(pruned_seed_counts),
+        )
 
-def get_results(seed, max_depth):
 
-    fetch_index = seed.fetch_index
+def fetch_suggestions(seed_text):
+    ''' Get the list of autocomplete suggestions for a seed, or None if the request failed. '''
 
     # Request for autocomplete results
     params = DEFAULT_PARAMS.copy()
-    params['q'] = seed.seed
+    params['q'] = seed_text
     response = make_request(default_requests_session.get, URL, params=params)
-    time.sleep(REQUEST_DELAY)  # enforce a pause between each fetch to be respectful to API
 
     # Go no further if the call failed
     if not response:
-        return []
+        return None
 
-    # Store data from the fetched queries
     doc = ElementTree.fromstring(response.text.encode('utf-8'))
-    num_results = 0
-    rank = 1
-
+    suggestions = []
     for comp_sugg in doc.iterfind('CompleteSuggestion'):
         for suggestion in comp_sugg.iterfind('suggestion'):
+            suggestions.append(suggestion.attrib['data'])
+    return suggestions
+
+
+def should_expand(depth, suggestions, max_depth):
+    ''' Decide whether a seed could reveal more queries if it were extended. '''
+    return len(suggestions) == MAX_RESULTS and depth < max_depth
+
+
+def get_expansion_chars(seed_text, depth):
+    ''' Get all characters that a seed should be extended with to make new seeds. '''
+
+    chars = []
+    for char in ALPHABET:
+
+        # The initial query should be followed by a space.
+        if depth == 0 and char != ' ':
+            continue
+
+        # There shouldn't be any sequence of two spaces.
+        if char == ' ' and seed_text.endswith(' '):
+            continue
+
+        chars.append(char)
+
+    return chars
+
+
+def prune_expansion_chars(
+        chars, seed_text, suggestions, parent_suggestions, prune, overlap_threshold):
+    '''
+    Choose which of the characters a seed could be extended with are likely to reveal
+    new queries.  There are two policies for pruning:
+    * 'prefix': only keep characters that continue the seed in at least one of its suggestions.
+      This is aggressive: it assumes that a prefix that isn't among the top suggestions
+      for a seed won't lead to queries that are popular enough to be worth finding.
+    * 'overlap': if most of the seed's suggestions (a fraction of at least `overlap_threshold`)
+      were already suggested for its parent, the seed is narrowing in on the same set of
+      queries, so don't extend it at all.  Seeds that end with a space are never pruned this
+      way, as adding a space to a seed usually returns the same suggestions as the seed.
+    '''
+    if prune == 'prefix':
+        lowercase_suggestions = [s.lower() for s in suggestions]
+        return [
+            c for c in chars
+            if any([s.startswith((seed_text + c).lower()) for s in lowercase_suggestions])
+        ]
+    elif prune == 'overlap' and parent_suggestions is not None and len(suggestions) > 0:
+        if seed_text.endswith(' '):
+            return chars
+        overlap = len(set(suggestions) & set(parent_suggestions)) / float(len(suggestions))
+        return [] if overlap >= overlap_threshold else chars
+    return chars
+
+
+def evaluate_pruning(fetch_index, max_depth, prune, overlap_threshold=OVERLAP_THRESHOLD):
+    '''
+    Estimate how a pruning policy would have performed on a crawl that was already run
+    without pruning.  The crawl is replayed from the results saved in the database, without
+    making any requests.  Returns a tuple of the number of requests the pruned crawl would have
+    made, the number of requests made by the original crawl, and the recall of the pruned crawl
+    (the fraction of distinct queries from the original crawl that it would have found).
+    '''
+
+    # Load the tree of seeds and the results for each seed with two queries
+    seeds = list(
+        Seed
+        .select(Seed.id, Seed.parent, Seed.seed, Seed.depth)
+        .where(Seed.fetch_index == fetch_index, Seed.status == 'fetched')
+        .tuples()
+    )
+    children = {(parent_id, seed_text): seed_id for seed_id, parent_id, seed_text, _ in seeds}
+    suggestions = {}
+    queries = (
+        Query
+        .select(Query.seed, Query.query)
+        .where(Query.fetch_index == fetch_index)
+        .order_by(Query.seed, Query.rank)
+        .tuples()
+    )
+    for seed_id, query in queries:
+        suggestions.setdefault(seed_id, []).append(query)
+
+    # Replay the crawl, starting from the root seeds
+    queue = [(seed_id, None, seed_text, depth) for seed_id, parent_id, seed_text, depth in seeds
+             if parent_id is None]
+    found_queries = set()
+    request_count = 0
+    while len(queue) > 0:
+
+        seed_id, parent_id, seed_text, depth = queue.pop(0)
+        seed_suggestions = suggestions.get(seed_id, [])
+        found_queries.update(seed_suggestions)
+        request_count += 1
+
+        if not should_expand(depth, seed_suggestions, max_depth):
+            continue
+
+        chars = prune_expansion_chars(
+            get_expansion_chars(seed_text, depth), seed_text, seed_suggestions,
+            suggestions.get(parent_id), prune, overlap_threshold
+        )
+        for char in chars:
+            child_id = children.get((seed_id, seed_text + char))
+            if child_id is not None:
+                queue.append((child_id, seed_id, seed_text + char, depth + 1))
 
-            # Create a new query and add to the database
-            data = suggestion.attrib['data']
-
-            # In Fourney et al.'s implementation of CUTS, the returned queries were checked so that
-            # they started with the exactly the seed.  We relax this restriction here.
-            # We note that in some autocomplete entries use valuable synonyms for our
-            # queries, such as converting node -> js or rearranging the terms.  These modified
-            # prefixes yield interesting queries that we don't want to miss.
-            Query.create(
-                fetch_index=fetch_index,
-                seed=seed,
-                query=data,
-                rank=rank,
-                depth=seed.depth,
-            )
-
-            num_results += 1
-            rank += 1
+    all_queries = set([q for seed_queries in suggestions.values() for q in seed_queries])
+    recall = len(found_queries) / float(len(all_queries)) if len(all_queries) > 0 else 1.0
+    return request_count, len(seeds), recall
 
-    # Only expand this seed into new seeds if we got a full set of results and
-    # we have not yet descended to the maximum depth.
-    if num_results == MAX_RESULTS and seed.depth < max_depth:
 
-        for char in ALPHABET:
+def save_results(seed, suggestions, max_depth, prune='none', overlap_threshold=OVERLAP_THRESHOLD):
+    ''' Save the suggestions for a seed.  Returns the new seeds that it was expanded into. '''
 
-            # The initial query should be followed by a space.
-            if seed.depth == 0 and char != ' ':
-                continue
+    fetch_index = seed.fetch_index
+    new_seeds = []
+
+    with Seed._meta.database.atomic():
+
+        # Store data from the fetched queries.
+        # In Fourney et al.'s implementation of CUTS, the returned queries were checked so that
+        # they started with the exactly the seed.  We relax this restriction here.
+        # We note that in some autocomplete entries use valuable synonyms for our
+        # queries, such as converting node -> js or rearranging the terms.  These modified
+        # prefixes yield interesting queries that we don't want to miss.
+        if len(suggestions) > 0:
+            Query.insert_many([{
+                'fetch_index': fetch_index,
+                'seed': seed,
+                'query': suggestion,
+                'rank': rank,
+                'depth': seed.depth,
+            } for rank, suggestion in enumerate(suggestions, start=1)]).execute()
+
+        # Only expand this seed into new seeds if we got a full set of results and
+        # we have not yet descended to the maximum depth.
+        if should_expand(seed.depth, suggestions, max_depth):
+
+            # When pruning, we compare this seed's results to its parent's results.
+            parent_suggestions = None
+            if prune == 'overlap' and seed.parent_id is not None:
+                parent_suggestions = [
+                    q.query for q in Query.select(Query.query).where(Query.seed == seed.parent_id)
+                ]
+
+            expansion_chars = prune_expansion_chars(
+                get_expansion_chars(seed.seed, seed.depth),
+                seed.seed, suggestions, parent_suggestions, prune, overlap_threshold
+            )
+            for char in expansion_chars:
 
-            # There shouldn't be any sequence of two spaces.
-            if char == ' ' and seed.seed.endswith(' '):
-                continue
+                # Create and store new seed
+                new_seeds.append(Seed.create(
+                    fetch_index=fetch_index,
+                    parent=seed,
+                    seed=seed.seed + char,
+                    depth=seed.depth + 1,
+                ))
 
-            # Create and store new seed
-            new_seed_text = seed.seed + char
-            new_seed = Seed.create(
-                fetch_index=fetch_index,
-                parent=seed,
-                seed=new_seed_text,
-                depth=seed.depth + 1,
-            )
+        # The seed is marked as fetched in the same transaction that saves its results
+        # and its children, so that an interrupted crawl never loses or repeats a seed.
+        Seed.update(status='fetched').where(Seed.id == seed.id).execute()
 
-            # Fetch results for the new seed.
-            get_results(new_seed, max_depth)
+    return new_seeds
 
 
 @lock_method(LOCK_FILENAME)
-def main(seeds, depth_level, *args, **kwargs):
+def main(seeds, depth_level, workers, requests_per_second, resume, prune, overlap_threshold,
+         evaluate_pruning_on, *args, **kwargs):
+
+    # Replay an earlier crawl to see how much a pruning policy would save
+    if evaluate_pruning_on is not None:
+        pruned_requests, original_requests, recall = evaluate_pruning(
+            evaluate_pruning_on, depth_level, prune, overlap_threshold)
+        logger.info(
+            "Pruning policy '%s' makes %d of %d requests (%d saved) with a recall of %.3f.",
+            prune, pruned_requests, original_requests,
+            original_requests - pruned_requests, recall
+        )
+        return
+
+    # Continue an earlier crawl, if one was specified
+    if resume is not None:
+        resume_crawl(
+            resume, depth_level, workers, requests_per_second, prune, overlap_threshold)
+        return
+
+    if seeds is None:
+        logger.error("A file of seeds must be provided unless resuming a crawl.")
+        return
 
     # Fetch autocomplete results
     with open(seeds) as seeds_file:
         seeds = [l.strip() for l in seeds_file]
-        get_results_for_seeds(seeds, depth_level)
+        get_results_for_seeds(
+            seeds, depth_level, workers, requests_per_second, prune, overlap_threshold)
 
 
 def configure_parser(parser):
@@ -129,6 +336,7 @@ def configure_parser(parser):
     parser.add_argument(
         'seeds',
         type=str,
+        nargs='?',
         help="the name of a file containing a list of seed queries."
     )
     parser.add_argument(
@@ -141,3 +349,47 @@ def configure_parser(parser):
         # for seeds for very popular packages.
         default=5,
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of requests for autocomplete results that can be waiting at once " +
+             "(default: %(default)s)."
+    )
+    parser.add_argument(
+        '--requests-per-second',
+        type=float,
+        default=REQUESTS_PER_SECOND,
+        help="Maximum rate of requests for autocomplete results (default: %(default).2f)."
+    )
+    parser.add_argument(
+        '--resume',
+        type=int,
+        metavar='FETCH_INDEX',
+        help="Resume an interrupted crawl with this fetch index, fetching all seeds " +
+             "that it had not yet fetched.  Set the same --depth-level as for the " +
+             "original crawl.  No seeds file is needed."
+    )
+    parser.add_argument(
+        '--prune',
+        choices=PRUNING_POLICIES,
+        default='none',
+        help="Policy for skipping seeds that are unlikely to reveal new queries.  'prefix' " +
+             "only extends a seed with characters that continue one of its suggestions.  " +
+             "'overlap' stops extending a seed when its suggestions mostly repeat its " +
+             "parent's suggestions.  (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--overlap-threshold',
+        type=float,
+        default=OVERLAP_THRESHOLD,
+        help="For the 'overlap' pruning policy, the fraction of a seed's suggestions that " +
+             "must be shared with its parent for it to be pruned (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--evaluate-pruning-on',
+        type=int,
+        metavar='FETCH_INDEX',
+        help="Instead of crawling, replay the saved results of an unpruned crawl with this " +
+             "fetch index, and report the requests saved and the recall of the --prune policy."
+    )
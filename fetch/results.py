@@ -4,119 +4,269 @@
 from __future__ import unicode_literals
 import logging
 from peewee import fn
-from bs4 import BeautifulSoup
-import time
 import datetime
 import json
-import re
+import threading
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 
-from fetch.api import make_request, default_requests_session
+from fetch.api import make_request, default_requests_session, RateLimiter, WorkerPool
 from lock import lock_method
-from models import Search, SearchResult
+from models import Search, SearchResult, BatchInserter
 
 
 logger = logging.getLogger('data')
 SEARCH_URL = 'https://www.googleapis.com/customsearch/v1'
 REQUESTED_RESULT_COUNT = 10
+MAX_PAGES = 10  # the search API returns at most 100 results for a query
 DEFAULT_PARAMS = {
     'num': REQUESTED_RESULT_COUNT,  # we can request at maximum 10 search results
     'alt': 'atom',
 }
 REQUEST_DELAY = 1.5
+REQUESTS_PER_SECOND = 1 / REQUEST_DELAY
+DEFAULT_WORKERS = 4
+DAILY_QUOTA = 100  # the number of free queries per day for the Custom Search API
+# Namespaces of the elements in Atom responses, written as prefixes of element names
+ATOM_NAMESPACE = '{http://www.w3.org/2005/Atom}'
+CSE_NAMESPACE = '{http://schemas.google.com/cseapi/2010}'
+DATE_CACHE_SIZE = 10000
+_date_cache = {}
 LOCK_FILENAME = '/tmp/results-fetcher.lock'
 
 
-def get_results_for_queries(queries, include_stack_overflow, search_id, api_key):
+class QuotaBudget(object):
+    ''' A count of the requests that can still be made, shared by several threads. '''
 
-    # Create a new fetch index.
-    last_fetch_index = Search.select(fn.Max(Search.fetch_index)).scalar() or 0
-    fetch_index = last_fetch_index + 1
+    def __init__(self, remaining):
+        self.remaining = remaining
+        self.lock = threading.Lock()
 
+    def take(self):
+        ''' Take one request from the budget.  Returns False if the budget has run out. '''
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+def get_results_for_queries(queries, include_stack_overflow, search_id, api_key,
+                            workers=DEFAULT_WORKERS, requests_per_second=REQUESTS_PER_SECOND,
+                            daily_quota=DAILY_QUOTA, fetch_index=None, pages=1):
+    '''
+    Fetch up to `pages` pages of search results for each of a list of queries.
+    If `fetch_index` is given, the queries are added to an earlier fetch, skipping the
+    pages that were already fetched for each query in that fetch.
+    '''
+
+    # Create a new fetch index, unless we're resuming an earlier fetch.
+    if fetch_index is None:
+        last_fetch_index = Search.select(fn.Max(Search.fetch_index)).scalar() or 0
+        fetch_index = last_fetch_index + 1
+
+    # For each query (identified by its text and package), a map from the index of each
+    # page that has been saved in this fetch to the number of results on that page,
+    # and the set of URLs that have been saved for the query in this fetch.
+    saved_pages = {}
+    saved_urls = {}
+    for query, package, page_index, result_count in (
+            Search
+            .select(Search.query, Search.package, Search.page_index, Search.result_count_on_page)
+            .where(Search.fetch_index == fetch_index)
+            .tuples()):
+        saved_pages.setdefault((query, package), {})[page_index] = result_count
+    for query, package, url in (
+            SearchResult
+            .select(Search.query, Search.package, SearchResult.url)
+            .join(Search)
+            .where(Search.fetch_index == fetch_index)
+            .tuples()):
+        saved_urls.setdefault((query, package), set()).add(url)
+
+    # Several pages are searched at once, though all workers share a rate limit.
+    # Every search counts against the daily quota of the search API.  We have an
+    # idea of how much of the quota has been spent from the searches we've saved today.
+    # When the quota runs out, the fetch stops, and the rest of the queries can be
+    # searched later by resuming this fetch.
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    searches_today = Search.select().where(Search.date >= today).count()
+    budget = QuotaBudget(daily_quota - searches_today)
+    rate_limiter = RateLimiter(requests_per_second)
+
+    # When a page comes back with fewer results than we asked for, there are no more
+    # results for the query, so we skip all of its later pages that haven't been fetched.
+    exhausted_queries = set()
+
+    def fetch_page(job, emit):
+        query, page_index = job
+        if (query['query'], query['package']) in exhausted_queries:
+            return
+        if not budget.take():
+            worker_pool.stop()
+            return
+        rate_limiter.wait()
+        page = fetch_results_page(
+            query['query'], include_stack_overflow, search_id, api_key, page_index)
+        if page is not None:
+            emit(page)
+
+    def save_results_callback(job, page):
+        query, page_index = job
+        key = (query['query'], query['package'])
+        save_results(
+            query['query'], query['package'], fetch_index, page_index, page,
+            saved_urls.setdefault(key, set())
+        )
+        saved_pages.setdefault(key, {})[page_index] = len(page['entries'])
+        if len(page['entries']) < REQUESTED_RESULT_COUNT:
+            exhausted_queries.add(key)
+        # The first page is fetched on its own.  Only if it's full are all of the later
+        # pages fetched, which can then be fetched at the same time.
+        elif page_index == 0:
+            queue_later_pages(query)
+
+    def queue_later_pages(query):
+        query_saved_pages = saved_pages.get((query['query'], query['package']), {})
+        for page_index in range(1, pages):
+            if page_index not in query_saved_pages:
+                worker_pool.add_job((query, page_index))
+            elif query_saved_pages[page_index] < REQUESTED_RESULT_COUNT:
+                break
+
+    worker_pool = WorkerPool(fetch_page, workers)
     for query in queries:
-        get_results(
-            query['query'], query['package'], include_stack_overflow,
-            fetch_index, search_id, api_key)
+        query_saved_pages = saved_pages.get((query['query'], query['package']), {})
+        if 0 not in query_saved_pages:
+            worker_pool.add_job((query, 0))
+        elif query_saved_pages[0] == REQUESTED_RESULT_COUNT:
+            queue_later_pages(query)
+    logger.info("Searching for %d pages of results.", worker_pool.pending_jobs)
+    worker_pool.run(results_callback=save_results_callback)
+
+    if worker_pool.stopped:
+        logger.warn(
+            "The daily search quota has run out.  " +
+            "Resume fetch %d later to search for the remaining queries.", fetch_index
+        )
 
 
-def get_results(query, package, include_stack_overflow, fetch_index, search_id, api_key):
+def fetch_results_page(query, include_stack_overflow, search_id, api_key, page_index=0):
+    ''' Search for a query.  Returns the parsed page of results, or None if the search failed. '''
 
     # Make request for search results
     params = DEFAULT_PARAMS.copy()
     params['key'] = api_key
     params['cx'] = search_id
     params['q'] = query
+    if page_index > 0:
+        params['start'] = page_index * REQUESTED_RESULT_COUNT + 1  # result indexes start at 1
     if not include_stack_overflow:
         params['siteSearch'] = 'stackoverflow.com'
         params['siteSearchFilter'] = 'e'  # 'e' for 'exclude'
     response = make_request(default_requests_session.get, SEARCH_URL, params=params)
 
-    # Pause so that we don't bombard the server with requests
-    time.sleep(REQUEST_DELAY)
-
     # If request resulted in error, the response is null.  Skip over this query.
     if response is None:
-        return
-
-    # Parse search results
-    soup = BeautifulSoup(response.content, 'html.parser')
-    url = soup.find('opensearch:Url')
-    entry_count = len(soup.find_all('entry'))
-
-    # The Atom spec for the search API
-    # (https://developers.google.com/custom-search/json-api/v1/reference/cse/list#response)
-    # mentions that the estimated results count may be a long integer.
-    # To my knowledge, peewee (our ORM) doesn't support long integer fields.
-    # So, I cast this to an integer instead and cross my fingers there is no overflow.
-    search = Search.create(
-        fetch_index=fetch_index,
-        query=query,
-        page_index=0,
-        requested_count=REQUESTED_RESULT_COUNT,
-        result_count_on_page=entry_count,
-        estimated_results_count=int(
-            soup.find('cse:searchinformation').find('cse:totalresults').text),
-        package=package,
-    )
+        return None
+
+    return parse_results(response.content)
+
+
+def parse_results(content):
+    '''
+    Parse an Atom response from the search API into a dictionary with the estimated
+    number of results and a list of the results on the page, from first to last.
+    '''
+
+    feed = ElementTree.fromstring(content)
+    page = {
+        'estimated_results_count': feed.findtext(
+            CSE_NAMESPACE + 'searchInformation/' + CSE_NAMESPACE + 'totalResults'),
+        'entries': [],
+    }
 
-    # Fetch the first "entry" or search result
-    entry = soup.entry
+    # I assume that the search API is returning results in the order of
+    # decreasing relevance, such that rank increases (gets bigger) with each entry.
+    for entry in feed.findall(ATOM_NAMESPACE + 'entry'):
+        fields = {child.tag: child for child in entry}
+        summary = fields.get(ATOM_NAMESPACE + 'summary')
+        page['entries'].append({
+            'updated_date': parse_date(fields[ATOM_NAMESPACE + 'updated'].text),
+            'link': fields[ATOM_NAMESPACE + 'link'].get('href'),
+            'snippet': summary.text if summary is not None else None,
+            'title': fields[ATOM_NAMESPACE + 'title'].text or '',
+            'url': fields[ATOM_NAMESPACE + 'id'].text,
+        })
 
-    # Save all of the search results from first to last.
-    # Maintaining consistency with our query scraping, ranking starts at 1.
-    for rank in range(1, entry_count + 1):
+    return page
 
-        # Extract fields from the entry
-        updated_datetime_without_milliseconds = re.sub('\.\d\d\dZ', 'Z', entry.updated.text)
-        updated_datetime = datetime.datetime.strptime(
-            updated_datetime_without_milliseconds,
-            "%Y-%m-%dT%H:%M:%SZ"
+
+def parse_date(date_string):
+    '''
+    Parse a date like "2016-01-01T12:30:00.000Z" from the search API, ignoring milliseconds.
+    Many results share the same update times, so parsed dates are cached.
+    '''
+    if date_string not in _date_cache:
+        if len(_date_cache) >= DATE_CACHE_SIZE:
+            _date_cache.clear()
+        _date_cache[date_string] = datetime.datetime(
+            int(date_string[0:4]), int(date_string[5:7]), int(date_string[8:10]),
+            int(date_string[11:13]), int(date_string[14:16]), int(date_string[17:19]),
         )
-        link = entry.link['href']
-        snippet = entry.summary.string
-        title = entry.title.text
-        url = entry.id.text
-
-        # Create a record for this search result
-        SearchResult.create(
-            search=search,
-            title=title,
-            snippet=snippet,
-            link=link,
-            url=url,
-            updated_date=updated_datetime,
-            rank=rank,
+    return _date_cache[date_string]
+
+
+def save_results(query, package, fetch_index, page_index, page, saved_urls=None):
+    '''
+    Save a search and all of the results on its page in one transaction.  Results with a URL
+    in `saved_urls` are skipped, and the URLs of the saved results are added to it.
+    '''
+
+    saved_urls = saved_urls if saved_urls is not None else set()
+
+    with Search._meta.database.atomic():
+
+        # The Atom spec for the search API
+        # (https://developers.google.com/custom-search/json-api/v1/reference/cse/list#response)
+        # mentions that the estimated results count may be a long integer.
+        # To my knowledge, peewee (our ORM) doesn't support long integer fields.
+        # So, I cast this to an integer instead and cross my fingers there is no overflow.
+        search = Search.create(
+            fetch_index=fetch_index,
+            query=query,
+            page_index=page_index,
+            requested_count=REQUESTED_RESULT_COUNT,
+            result_count_on_page=len(page['entries']),
+            estimated_results_count=int(page['estimated_results_count']),
+            package=package,
         )
 
-        # To my knowledge, this is the only method for which it is strongly implied in
-        # the BeautifulSoup documentation that you are fetching the next result
-        # in the sequence.  I also assume that the search API is returning results
-        # in the order of decreasing relevance, such that rank increases (gets bigger)
-        # with each successive entry visited.
-        entry = entry.find_next('entry')
+        # Save all of the search results from first to last.
+        # Maintaining consistency with our query scraping, ranking starts at 1.
+        # A result keeps its rank on the page even if an earlier result was skipped.
+        batch_inserter = BatchInserter(SearchResult, batch_size=REQUESTED_RESULT_COUNT)
+        for rank, entry in enumerate(page['entries'], start=1):
+            if entry['url'] in saved_urls:
+                continue
+            saved_urls.add(entry['url'])
+            batch_inserter.insert({
+                'search': search.id,
+                'title': entry['title'],
+                'snippet': entry['snippet'],
+                'link': entry['link'],
+                'url': entry['url'],
+                'updated_date': entry['updated_date'],
+                'rank': rank,
+            })
+        batch_inserter.flush()
 
 
 @lock_method(LOCK_FILENAME)
-def main(queries, google_config, include_stack_overflow, *args, **kwargs):
+def main(queries, google_config, include_stack_overflow, workers, requests_per_second,
+         daily_quota, resume, pages, *args, **kwargs):
 
     with open(queries) as queries_file:
         query_list = json.load(queries_file)
@@ -126,9 +276,10 @@ def main(queries, google_config, include_stack_overflow, *args, **kwargs):
         search_id = config['search_id']
         api_key = config['api_key']
 
-    with open(queries) as queries_file:
-        queries = [l.strip() for l in queries_file]
-        get_results_for_queries(query_list, include_stack_overflow, search_id, api_key)
+    get_results_for_queries(
+        query_list, include_stack_overflow, search_id, api_key,
+        workers, requests_per_second, daily_quota, fetch_index=resume, pages=pages
+    )
 
 
 def configure_parser(parser):
@@ -152,3 +303,39 @@ def configure_parser(parser):
         action='store_true',
         help="Include results from the domain stackoverflow.com"
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of searches to make at once (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--requests-per-second',
+        type=float,
+        default=REQUESTS_PER_SECOND,
+        help="Maximum rate of searches, across all workers (default: %(default).2f)."
+    )
+    parser.add_argument(
+        '--daily-quota',
+        type=int,
+        default=DAILY_QUOTA,
+        help="Maximum number of searches to make in a day.  The fetch stops once this " +
+             "many searches have been saved today (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--resume',
+        metavar='FETCH_INDEX',
+        type=int,
+        help="Continue a fetch that was stopped (e.g., when the quota ran out), searching " +
+             "only for the queries that haven't yet been searched in that fetch."
+    )
+    parser.add_argument(
+        '--pages',
+        type=int,
+        default=1,
+        choices=range(1, MAX_PAGES + 1),
+        metavar='N',
+        help="Number of pages of results to fetch for each query (default: %(default)s).  " +
+             "Later pages are fetched only if the first page is full, and results with a " +
+             "URL already saved for a query in this fetch are skipped."
+    )
@@ -3,10 +3,9 @@
 
 from __future__ import unicode_literals
 import logging
-import time
 from peewee import JOIN_LEFT_OUTER
 
-from fetch.api import make_request, default_requests_session
+from fetch.api import make_request, default_requests_session, pause
 from models import Search, SearchResult, WebPageContent, SearchResultContent
 
 
@@ -73,7 +72,7 @@ def get_results_content(fetch_all, fetch_indexes, share_content):
 
         # Even though most of the pages will be from different domains, we pause between
         # fetching the content for each result to avoid spamming any specific domain with requests.
-        time.sleep(DELAY_TIME)
+        pause(DELAY_TIME)
 
 
 def main(fetch_all, fetch_indexes, no_share_content, *args, **kwargs):
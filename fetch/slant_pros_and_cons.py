@@ -4,11 +4,10 @@
 from __future__ import unicode_literals
 import logging
 from peewee import fn
-import time
 from progressbar import ProgressBar, Percentage, Bar, ETA, Counter, RotatingMarker
 
-from fetch.api import make_request, default_requests_session
-from models import Viewpoint, ViewpointSection
+from fetch.api import make_request, default_requests_session, HostRateLimiter, WorkerPool
+from models import Viewpoint, ViewpointSection, BatchInserter
 from lock import lock_method
 
 
@@ -18,9 +17,13 @@ logger = logging.getLogger('data')
 LOCK_FILENAME = '/tmp/slant-pros-and-cons-fetcher.lock'
 SLANT_URL = "https://www.slant.co"
 REQUEST_DELAY = 1
+REQUESTS_PER_SECOND = 1 / REQUEST_DELAY
+DEFAULT_WORKERS = 4
+INSERT_BATCH_SIZE = 100
 
 
-def get_slant_pros_and_cons(show_progress):
+def get_slant_pros_and_cons(show_progress, workers=DEFAULT_WORKERS,
+                            requests_per_second=REQUESTS_PER_SECOND):
 
     # Create a new fetch index
     last_fetch_index = ViewpointSection.select(fn.Max(ViewpointSection.fetch_index)).scalar() or 0
@@ -47,58 +50,79 @@ def get_slant_pros_and_cons(show_progress):
         ])
         progress_bar.start()
 
-    # For every viewpoint, fetch and save all pros and cons
-    for viewpoint_index, viewpoint in enumerate(latest_viewpoint_batch, start=1):
-
-        # Without the format=json parameter, the Slant server will return
-        # HTML for the viewpoint.  We get something resembling a JSON API
-        # response if we ask for JSON format.
-        response = make_request(
-            default_requests_session.get,
-            SLANT_URL + viewpoint.url_path,
-            params={'format': 'json'},
-        )
-
-        # Skip all missing responses
-        if response is None:
-            continue
-
-        results = response.json()
-
-        # If we have somehow ended up on an entry where it has an error field
-        # with the 404 code, something was probably wrong with the request.
-        # Just skip this entry and move on.
-        if 'error' in results and results['error'] == 404:
-            logger.warn("Got 404 when retrieving viewpoint with path %s.", viewpoint.url_path)
-            break
-
-        # Each 'section' for a view point is a pro or a con.  Save a record for each one.
-        for section in results['sections']['children']:
-
-            ViewpointSection.create(
-                fetch_index=fetch_index,
-                viewpoint=viewpoint,
-                section_index=section['id'],
-                title=section['revision']['title'],
-                text=section['revision']['text'],
-                is_con=section['isCon'],
-                upvotes=section['votes']['upvotes'],
-                downvotes=section['votes']['downvotes'],
-            )
+    # For every viewpoint, fetch and save all pros and cons.  Several viewpoints are
+    # fetched at once, though requests to each host are spaced out so that we don't
+    # bombard the server with requests.  The pros and cons are saved from this thread.
+    host_rate_limiter = HostRateLimiter(requests_per_second)
 
+    def fetch_viewpoint(viewpoint, emit):
+        sections = fetch_viewpoint_sections(viewpoint, host_rate_limiter)
+        if sections is not None:
+            emit(sections)
+
+    def save_sections_callback(viewpoint, sections):
+        save_viewpoint_sections(viewpoint, sections, fetch_index)
+
+    def finish_viewpoint(viewpoint):
         if show_progress:
-            progress_bar.update(viewpoint_index)
+            progress_bar.update(progress_bar.currval + 1)
 
-        # Pause so that we don't bombard the server with requests
-        time.sleep(REQUEST_DELAY)
+    worker_pool = WorkerPool(fetch_viewpoint, workers)
+    for viewpoint in latest_viewpoint_batch:
+        worker_pool.add_job(viewpoint)
+    worker_pool.run(results_callback=save_sections_callback, done_callback=finish_viewpoint)
 
     if show_progress:
         progress_bar.finish()
 
 
+def fetch_viewpoint_sections(viewpoint, host_rate_limiter):
+    ''' Fetch the pros and cons for a viewpoint.  Returns None if they couldn't be fetched. '''
+
+    # Without the format=json parameter, the Slant server will return
+    # HTML for the viewpoint.  We get something resembling a JSON API
+    # response if we ask for JSON format.
+    url = SLANT_URL + viewpoint.url_path
+    host_rate_limiter.wait(url)
+    response = make_request(default_requests_session.get, url, params={'format': 'json'})
+
+    # Skip all missing responses
+    if response is None:
+        return None
+
+    results = response.json()
+
+    # If we have somehow ended up on an entry where it has an error field
+    # with the 404 code, something was probably wrong with the request.
+    # Just skip this entry and move on.
+    if 'error' in results and results['error'] == 404:
+        logger.warn("Got 404 when retrieving viewpoint with path %s.", viewpoint.url_path)
+        return None
+
+    return results['sections']['children']
+
+
+def save_viewpoint_sections(viewpoint, sections, fetch_index):
+
+    # Each 'section' for a view point is a pro or a con.  Save a record for each one.
+    batch_inserter = BatchInserter(ViewpointSection, batch_size=INSERT_BATCH_SIZE)
+    for section in sections:
+        batch_inserter.insert({
+            'fetch_index': fetch_index,
+            'viewpoint': viewpoint.id,
+            'section_index': section['id'],
+            'title': section['revision']['title'],
+            'text': section['revision']['text'],
+            'is_con': section['isCon'],
+            'upvotes': section['votes']['upvotes'],
+            'downvotes': section['votes']['downvotes'],
+        })
+    batch_inserter.flush()
+
+
 @lock_method(LOCK_FILENAME)
-def main(show_progress, *args, **kwargs):
-    get_slant_pros_and_cons(show_progress)
+def main(show_progress, workers, requests_per_second, *args, **kwargs):
+    get_slant_pros_and_cons(show_progress, workers, requests_per_second)
 
 
 def configure_parser(parser):
@@ -112,3 +136,16 @@ def configure_parser(parser):
         action='store_true',
         help="Show progress of the number of viewpoints for which pros/cons have been fetched."
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of viewpoints to fetch pros and cons for at once (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--requests-per-second',
+        type=float,
+        default=REQUESTS_PER_SECOND,
+        help="Maximum rate of requests to each host, across all workers " +
+             "(default: %(default).2f)."
+    )
@@ -4,11 +4,11 @@
 from __future__ import unicode_literals
 import logging
 from peewee import fn
-import time
+import datetime
 from progressbar import ProgressBar, Percentage, Bar, ETA, Counter, RotatingMarker
 
-from fetch.api import make_request, default_requests_session
-from models import SlantTopic, Viewpoint
+from fetch.api import make_request, default_requests_session, pause, WorkerPool
+from models import SlantTopic, Viewpoint, BatchInserter, insert_many_returning_ids
 from lock import lock_method
 
 
@@ -25,6 +25,7 @@ DEFAULT_PARAMS = {
 SLANT_URL = "https://www.slant.co"
 SLANT_TOPICS_URL = SLANT_URL + "/topics"
 REQUEST_DELAY = 1
+INSERT_BATCH_SIZE = 100
 
 
 def get_slant_topics(show_progress):
@@ -33,10 +34,48 @@ def get_slant_topics(show_progress):
     last_fetch_index = SlantTopic.select(fn.Max(SlantTopic.fetch_index)).scalar() or 0
     fetch_index = last_fetch_index + 1
 
+    # Pages of topics are fetched on a separate thread, and handed back to this thread to be
+    # saved.  The fetching thread moves on to the next pages while this one saves a page,
+    # so that network and database work overlap.  It's only allowed to get a few pages
+    # ahead of the pages that have been saved.
+    progress = {'topic_count': 0}
+
+    def fetch_pages(_, emit):
+        fetch_topic_pages(emit)
+
+    def save_page_callback(_, results):
+
+        # If this is the first page, initialize the progress bar with
+        # the number of results retrieved from the results
+        if show_progress and 'progress_bar' not in progress:
+            progress['progress_bar'] = ProgressBar(maxval=results['count'], widgets=[
+                'Progress: ', Percentage(),
+                ' ', Bar(marker=RotatingMarker()),
+                ' ', ETA(),
+                ' Fetched ', Counter(), ' / ' + str(results['count']) + ' topics.'
+            ])
+            progress['progress_bar'].start()
+
+        save_topics(results['children'], fetch_index)
+        progress['topic_count'] += len(results['children'])
+
+        if show_progress:
+            progress['progress_bar'].update(progress['topic_count'])
+
+    worker_pool = WorkerPool(fetch_pages, num_workers=1)
+    worker_pool.add_job('topics')
+    worker_pool.run(results_callback=save_page_callback)
+
+    if show_progress and 'progress_bar' in progress:
+        progress['progress_bar'].finish()
+
+
+def fetch_topic_pages(results_callback):
+    ''' Fetch all pages of Slant topics, passing the results for each page to a callback. '''
+
     params = DEFAULT_PARAMS.copy()
     first_request = True
     next_url = None
-    count_of_processed_topics = 0
 
     # Loop through requests to the Slant server until we reach an empty
     # response or the end of the pages.
@@ -73,64 +112,62 @@ def get_slant_topics(show_progress):
         if 'error' in results and results['error'] == 404:
             break
 
-        # If this is the first request, initialize the progress bar with
-        # the number of results retrieved from the results
-        if first_request and show_progress:
-            progress_bar = ProgressBar(maxval=results['count'], widgets=[
-                'Progress: ', Percentage(),
-                ' ', Bar(marker=RotatingMarker()),
-                ' ', ETA(),
-                ' Fetched ', Counter(), ' / ' + str(results['count']) + ' topics.'
-            ])
-            progress_bar.start()
-
-        for topic in results['children']:
-
-            # Each child in the list is a topic.
-            # Save each of these as a new topic.
-            topic_record = SlantTopic.create(
-                fetch_index=fetch_index,
-                topic_id=topic['uuid'],
-                title=topic['revision']['title'],
-                url_path=topic['URL'],
-                owner_username=topic['createdEvent']['user']['username'],
-            )
-
-            # A topic on Slant has a number of "viewpoints" or alternatives.
-            # Save each one and a URL to the site where we can visit each one.
-            for viewpoint in topic['viewpoints']['children']:
-                Viewpoint.create(
-                    fetch_index=fetch_index,
-                    viewpoint_index=viewpoint['id'],
-                    title=viewpoint['revision']['title'],
-                    topic=topic_record,
-                    url_path=viewpoint['URL'],
-                )
-
-            count_of_processed_topics += 1
-
-        if show_progress:
-            progress_bar.update(count_of_processed_topics)
+        results_callback(results)
 
         # We are also finished looping through results when there is no longer a 'next'
         # page in the page properties.  It's just a guess on our part that this endpoint
         # will always report a next page when there is one, as there isn't an official
         # API and there isn't any documentation for it.
         if 'next' not in results['properties']['page']:
-            if show_progress:
-                progress_bar.finish()
             break
 
         next_page_path = results['properties']['page']['next']
         next_url = SLANT_URL + next_page_path
 
         # Pause so that we don't bombard the server with requests
-        time.sleep(REQUEST_DELAY)
+        pause(REQUEST_DELAY)
 
         # Reset the flag that cues us to take actions for the first request
         first_request = False
 
 
+def save_topics(topics, fetch_index):
+    ''' Save a page of topics and all of their viewpoints in bulk. '''
+
+    with SlantTopic._meta.database.atomic():
+
+        viewpoint_inserter = BatchInserter(Viewpoint, batch_size=INSERT_BATCH_SIZE)
+
+        for batch_start in range(0, len(topics), INSERT_BATCH_SIZE):
+
+            # Each child in the list is a topic.
+            # Save each of these as a new topic.
+            batch = topics[batch_start:batch_start + INSERT_BATCH_SIZE]
+            topic_ids = insert_many_returning_ids(SlantTopic, [{
+                'fetch_index': fetch_index,
+                'date': datetime.datetime.now(),
+                'topic_id': topic['uuid'],
+                'title': topic['revision']['title'],
+                'url_path': topic['URL'],
+                'owner_username': topic['createdEvent']['user']['username'],
+            } for topic in batch])
+
+            # A topic on Slant has a number of "viewpoints" or alternatives.
+            # Save each one and a URL to the site where we can visit each one.
+            for topic, topic_id in zip(batch, topic_ids):
+                for viewpoint in topic['viewpoints']['children']:
+                    viewpoint_inserter.insert({
+                        'fetch_index': fetch_index,
+                        'date': datetime.datetime.now(),
+                        'viewpoint_index': viewpoint['id'],
+                        'title': viewpoint['revision']['title'],
+                        'topic': topic_id,
+                        'url_path': viewpoint['URL'],
+                    })
+
+        viewpoint_inserter.flush()
+
+
 @lock_method(LOCK_FILENAME)
 def main(show_progress, *args, **kwargs):
     get_slant_topics(show_progress)
@@ -3,12 +3,13 @@
 
 from __future__ import unicode_literals
 import logging
-import time
 from peewee import fn
 import datetime
+import time
 
-from fetch.api import make_request, default_requests_session
-from models import QuestionSnapshot, Tag, QuestionSnapshotTag
+from fetch.api import stack_exchange_request, stack_exchange_throttle, WorkerPool
+from models import QuestionSnapshot, Tag, QuestionSnapshotTag, QuestionSnapshotCursor,\
+    BatchInserter, insert_many_returning_ids, max_batch_size
 
 
 logger = logging.getLogger('data')
@@ -21,11 +22,48 @@ DEFAULT_PARAMS = {
     'key': ')8bWqMwdZLM)87SK8n)LUA((',
     'page_size': 100,  # the maximum page size
 }
-REQUEST_DELAY = 0.1  # The Stack Exchange API requests you don't query more than 30 times / second
-tag_cache = {}  # We avoid querying for tags when we don't need to by keeping them in this cache.
+DEFAULT_WORKERS = 4
+tag_cache = {}  # A map from tag names to tag IDs, loaded once so we don't query for tags.
+
+
+def load_tag_cache():
+    ''' Load the IDs of all Stack Overflow tags into the tag cache. '''
+    tag_cache.clear()
+    for tag_id, tag_name in Tag.select(Tag.id, Tag.tag_name).tuples():
+        tag_cache[tag_name] = tag_id
+
+
+def save_questions(questions, fetch_index):
+    ''' Save snapshots of a page of questions, and link them to their tags, in bulk. '''
+
+    with QuestionSnapshot._meta.database.atomic():
+
+        tag_link_inserter = BatchInserter(
+            QuestionSnapshotTag, batch_size=max_batch_size(QuestionSnapshotTag))
+
+        # Snapshots have many fields, so they are inserted in batches small enough
+        # to stay under SQLite's limit on the number of variables in a query.
+        batch_size = max_batch_size(QuestionSnapshot)
+        for batch_start in range(0, len(questions), batch_size):
+            batch = questions[batch_start:batch_start + batch_size]
+            snapshot_ids = insert_many_returning_ids(
+                QuestionSnapshot,
+                [_make_snapshot_row(question, fetch_index) for question in batch]
+            )
 
+            # Link each snapshot to all of its tags that we know about
+            for question, snapshot_id in zip(batch, snapshot_ids):
+                for tag_name in question['tags']:
+                    if tag_name in tag_cache:
+                        tag_link_inserter.insert({
+                            'question_snapshot_id': snapshot_id,
+                            'tag_id': tag_cache[tag_name],
+                        })
 
-def _save_question(question, fetch_index):
+        tag_link_inserter.flush()
+
+
+def _make_snapshot_row(question, fetch_index):
 
     # It seems that the the ID of the owner is missing from some records.
     # This little bit of logic checks to see if it's missing.
@@ -41,50 +79,118 @@ def _save_question(question, fetch_index):
     # will also be in local time.
     timestamp_to_datetime = lambda ts: datetime.datetime.fromtimestamp(ts)
 
-    # Create a snapshot of this question
-    snapshot = QuestionSnapshot.create(
-        fetch_index=fetch_index,
-        question_id=question['question_id'],
-        owner_id=owner_id,
-        comment_count=question['comment_count'],
-        delete_vote_count=question['delete_vote_count'],
-        reopen_vote_count=question['reopen_vote_count'],
-        close_vote_count=question['close_vote_count'],
-        is_answered=question['is_answered'],
-        view_count=question['view_count'],
-        favorite_count=question['favorite_count'],
-        down_vote_count=question['down_vote_count'],
-        up_vote_count=question['up_vote_count'],
-        answer_count=question['answer_count'],
-        score=question['score'],
-        last_activity_date=timestamp_to_datetime(question['last_activity_date']),
-        creation_date=timestamp_to_datetime(question['creation_date']),
-        title=question['title'],
-        body=question['body'],
+    return {
+        'fetch_index': fetch_index,
+        'date': datetime.datetime.now(),
+        'question_id': question['question_id'],
+        'owner_id': owner_id,
+        'comment_count': question['comment_count'],
+        'delete_vote_count': question['delete_vote_count'],
+        'reopen_vote_count': question['reopen_vote_count'],
+        'close_vote_count': question['close_vote_count'],
+        'is_answered': question['is_answered'],
+        'view_count': question['view_count'],
+        'favorite_count': question['favorite_count'],
+        'down_vote_count': question['down_vote_count'],
+        'up_vote_count': question['up_vote_count'],
+        'answer_count': question['answer_count'],
+        'score': question['score'],
+        'last_activity_date': timestamp_to_datetime(question['last_activity_date']),
+        'creation_date': timestamp_to_datetime(question['creation_date']),
+        'title': question['title'],
+        'body': question['body'],
+    }
+
+
+def fetch_questions(tags, fetch_index, workers=DEFAULT_WORKERS, incremental=False):
+
+    # Questions for several tags are fetched at once.  All of the workers share one
+    # throttle, so together they stay within the Stack Exchange API's rate limits.
+    # Every page of questions is saved from this thread, as it is handed back by a worker.
+    start_time = time.time()
+    question_counts = {'total': 0}
+    load_tag_cache()
+
+    # In an incremental fetch, we only snapshot the questions for a tag that have had
+    # activity since the last fetch.  The latest snapshot of every other question is
+    # still current, and can be found with `QuestionSnapshot.select_latest`.
+    # Questions are listed from the oldest activity to the newest (even for tags that haven't
+    # been fetched before), so that if a fetch stops partway through, the latest activity we
+    # have seen still marks a point before which we have seen all changes.
+    cursors = {c.tag_name: c for c in QuestionSnapshotCursor.select()} if incremental else {}
+    completed_tags = set()
+    latest_activity = {}
+
+    def fetch_tag(tag, emit):
+        cursor = cursors.get(tag)
+        since = cursor.last_activity_date if cursor is not None else None
+        if fetch_questions_for_tag(tag, emit, since, by_activity=incremental):
+            completed_tags.add(tag)
+
+    def save_questions_callback(tag, questions):
+        save_questions(questions, fetch_index)
+        question_counts['total'] += len(questions)
+        question_counts[tag] = question_counts.get(tag, 0) + len(questions)
+        for question in questions:
+            latest_activity[tag] = max(
+                latest_activity.get(tag, 0), question['last_activity_date'])
+
+    def finish_tag(tag):
+
+        # In a full fetch, questions aren't in order of activity, so we can only know we have
+        # seen all activity up to the latest time if we have fetched all of them.
+        if tag in latest_activity and (incremental or tag in completed_tags):
+            save_cursor(tag, fetch_index, latest_activity.pop(tag))
+        elapsed = time.time() - start_time
+        logger.info(
+            "Fetched %d questions for tag '%s'.  %d questions so far (%.1f questions / sec).",
+            question_counts.get(tag, 0), tag, question_counts['total'],
+            question_counts['total'] / elapsed if elapsed > 0 else 0
+        )
+        # There's no use starting the next tags if none of their requests will succeed.
+        if stack_exchange_throttle.is_out_of_quota():
+            worker_pool.stop()
+
+    worker_pool = WorkerPool(fetch_tag, workers)
+    for tag in tags:
+        worker_pool.add_job(tag)
+    worker_pool.run(results_callback=save_questions_callback, done_callback=finish_tag)
+
+    logger.info(
+        "Fetched %d questions in %.1f seconds.  %s requests left in today's quota.",
+        question_counts['total'], time.time() - start_time,
+        str(stack_exchange_throttle.quota_remaining)
     )
 
-    # Link this snapshot to all tags related to it
-    for tag_name in question['tags']:
-
-        if tag_name in tag_cache:
-            tag = tag_cache[tag_name]
-        else:
-            try:
-                tag = Tag.get(tag_name=tag_name)
-            except Tag.DoesNotExist:
-                tag = None
-            tag_cache[tag_name] = tag
 
-        if tag is not None:
-            QuestionSnapshotTag.create(question_snapshot_id=snapshot.id, tag_id=tag.id)
+def save_cursor(tag_name, fetch_index, last_activity_date):
+    cursor, _ = QuestionSnapshotCursor.get_or_create(
+        tag_name=tag_name,
+        defaults={'fetch_index': fetch_index, 'last_activity_date': last_activity_date},
+    )
+    cursor.date = datetime.datetime.now()
+    cursor.fetch_index = fetch_index
+    cursor.last_activity_date = last_activity_date
+    cursor.save()
 
 
-def fetch_questions_for_tag(tag, fetch_index):
+def fetch_questions_for_tag(tag, results_callback, since=None, by_activity=False):
+    '''
+    Fetch all questions for a tag, passing each page of them to `results_callback`.
+    If `by_activity` is set, questions are fetched from the oldest activity to the newest.
+    If `since` is also set (in Unix epoch time), only questions with activity since then
+    are fetched.  Returns True if all pages were fetched.
+    '''
 
     # Prepare initial API query parameters
     params = DEFAULT_PARAMS.copy()
     params['tagged'] = tag
     params['page'] = 1  # paging for Stack Exchange API starts at 1
+    if by_activity:
+        params.update({'sort': 'activity', 'order': 'asc'})
+        if since is not None:
+            # 'min' filters on the field that questions are sorted by.
+            params['min'] = since
 
     # We intentionally choose to iterate until the results tell us there are 'no more'.
     # The Stack Exchange API documents tell us that requesting a 'total' from the API
@@ -92,20 +198,23 @@ def fetch_questions_for_tag(tag, fetch_index):
     more_results = True
     while more_results:
 
-        response = make_request(default_requests_session.get, API_URL, params=params)
+        # The request is retried a few times before it is given up on.  When a page
+        # can't be fetched, we stop fetching this tag, as we can't skip to the next page.
+        response_data = stack_exchange_request(API_URL, params)
+        if response_data is None:
+            logger.warn("Stopped fetching questions for tag '%s' at page %d", tag, params['page'])
+            return False
 
-        if response is not None:
-            response_data = response.json()
-            for question in response_data['items']:
-                _save_question(question, fetch_index)
+        results_callback(response_data['items'])
 
         # Advance the page if there are more results coming
-        more_results = response_data['has_more'] if response is not None else True
-        time.sleep(REQUEST_DELAY)
+        more_results = response_data['has_more']
         params['page'] += 1
 
+    return True
+
 
-def main(tags, *args, **kwargs):
+def main(tags, workers, incremental, *args, **kwargs):
 
     # Create a new fetch index.
     last_fetch_index = QuestionSnapshot.select(fn.Max(QuestionSnapshot.fetch_index)).scalar() or 0
@@ -114,8 +223,7 @@ def main(tags, *args, **kwargs):
     with open(tags) as tag_file:
         tag_list = [t.strip() for t in tag_file.readlines()]
 
-    for tag in tag_list:
-        fetch_questions_for_tag(tag, fetch_index)
+    fetch_questions(tag_list, fetch_index, workers, incremental)
 
 
 def configure_parser(parser):
@@ -125,3 +233,15 @@ def configure_parser(parser):
         help="the name of a file containing a list of Stack Overflow tags " +
              "for which to fetch question."
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of tags to fetch questions for at once (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="Only snapshot questions that have had activity since the last fetch for " +
+             "their tag.  Use the latest snapshot of each question to find its current state."
+    )
@@ -0,0 +1,19 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+from playhouse.migrate import migrate
+from peewee import TextField
+
+
+logger = logging.getLogger('data')
+
+
+def forward(migrator):
+    # Seeds that were saved before this migration were saved by crawls that
+    # could not be resumed, so we mark them as having been fetched.
+    migrate(
+        migrator.add_column('seed', 'status', TextField(default='fetched')),
+        migrator.add_index('seed', ('status',), False),
+    )
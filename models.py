@@ -7,13 +7,15 @@ import datetime
 import json
 import copy
 from peewee import Model, SqliteDatabase, Proxy, PostgresqlDatabase, \
-    CharField, IntegerField, ForeignKeyField, DateTimeField, TextField, BooleanField
+    CharField, IntegerField, ForeignKeyField, DateTimeField, TextField, BooleanField, fn
 
 
 logger = logging.getLogger('data')
 
 POSTGRES_CONFIG_NAME = 'postgres-credentials.json'
 DATABASE_NAME = 'fetcher'
+# Versions of SQLite before 3.32 allow at most this many variables in one query.
+SQLITE_MAX_VARIABLES = 999
 db_proxy = Proxy()
 
 
@@ -25,7 +27,7 @@ class BatchInserter(object):
     Make sure to call the `flush` method when you're finished using it
     to save any rows that haven't yet been saved.
 
-    Assumes all models have been initialized to connect to db_proxy.
+    Rows are saved to the database that the model is connected to.
     '''
     def __init__(self, ModelType, batch_size, fill_missing_fields=False):
         '''
@@ -50,9 +52,11 @@ class BatchInserter(object):
             self.flush()
 
     def flush(self):
+        if len(self.rows) == 0:
+            return
         if self.pad_data:
             self._pad_data(self.rows)
-        with db_proxy.atomic():
+        with self.ModelType._meta.database.atomic():
             self.ModelType.insert_many(self.rows).execute()
         self.rows = []
 
@@ -78,6 +82,35 @@ class BatchInserter(object):
             rows[i] = updated_data
 
 
+def max_batch_size(ModelType):
+    '''
+    Get the largest number of rows of a model that can be inserted with one query
+    without going over SQLite's limit on the number of variables in a query.
+    '''
+    return SQLITE_MAX_VARIABLES // len(ModelType._meta.sorted_fields)
+
+
+def insert_many_returning_ids(ModelType, rows):
+    '''
+    Save a list of rows with one INSERT statement, and return the IDs of the new records
+    in the same order as the rows.  Postgres returns the IDs from the INSERT itself.
+    SQLite can't, but it gives consecutive IDs to the rows inserted by one statement, so
+    we find them by counting back from the highest ID once the rows have been inserted.
+    '''
+    if len(rows) == 0:
+        return []
+
+    database = ModelType._meta.database
+    query = ModelType.insert_many(rows)
+    if database.insert_returning:
+        return list(query.return_id_list().execute())
+
+    with database.atomic():
+        query.execute()
+        last_id = ModelType.select(fn.Max(ModelType.id)).scalar()
+    return range(last_id - len(rows) + 1, last_id + 1)
+
+
 class ProxyModel(Model):
     ''' A peewee model that is connected to the proxy defined in this module. '''
 
@@ -86,11 +119,16 @@ class ProxyModel(Model):
 
 
 class Seed(ProxyModel):
-    ''' An initial query given by a user for which autocomplete results are shown. '''
+    '''
+    An initial query given by a user for which autocomplete results are shown.
+    The status of a seed is "pending" until its results have been saved, when it becomes
+    "fetched".  If the request for its results failed, its status is "failed".
+    '''
 
     # Fetch logistics
     fetch_index = IntegerField(index=True)
     date = DateTimeField(index=True, default=datetime.datetime.now)
+    status = TextField(index=True, default='pending')
 
     # Data about the query
     parent = ForeignKeyField('self', null=True, related_name='children')
@@ -231,6 +269,16 @@ class QuestionSnapshot(ProxyModel):
     title = TextField()
     body = TextField()
 
+    @classmethod
+    def select_latest(cls, *selection):
+        '''
+        Select the latest snapshot of each question.  Incremental fetches only snapshot
+        the questions that have changed, so the latest snapshot of a question may come
+        from any earlier fetch.  This selects the current version of every question.
+        '''
+        latest_ids = cls.select(fn.Max(cls.id)).group_by(cls.question_id)
+        return cls.select(*selection).where(cls.id << latest_ids)
+
 
 class QuestionSnapshotTag(ProxyModel):
     ''' A link between one snapshot of a Stack Overflow question and one of its tags. '''
@@ -239,6 +287,21 @@ class QuestionSnapshotTag(ProxyModel):
     tag_id = IntegerField(index=True)
 
 
+class QuestionSnapshotCursor(ProxyModel):
+    '''
+    The state of the last fetch of question snapshots for a Stack Overflow tag.
+    Incremental fetches use this to request only the questions that have had activity since.
+    'last_activity_date' is the latest activity time seen, in Unix epoch time as the
+    Stack Exchange API reports it.
+    '''
+
+    date = DateTimeField(index=True, default=datetime.datetime.now)
+
+    tag_name = TextField(unique=True)
+    fetch_index = IntegerField()
+    last_activity_date = IntegerField()
+
+
 class Post(ProxyModel):
     '''
     A post from Stack Overflow.
@@ -501,6 +564,32 @@ class IssueComment(ProxyModel):
     user_id = IntegerField(index=True, null=True, default=None)
 
 
+class GitHubSyncCursor(ProxyModel):
+    '''
+    The state of the last sync of one type of data (e.g., "issues") for a GitHub project.
+    Incremental fetches use this to request only the data that has changed since the last sync.
+    'fetch_index' is the fetch index of the latest complete snapshot of the data.
+    'since' is the latest 'updated_at' time seen, for endpoints that accept a 'since' parameter.
+    'last_id' is the largest ID seen, for endpoints that list the newest records first.
+    'etag' is the ETag of the last response, for making conditional requests.
+    '''
+
+    date = DateTimeField(index=True, default=datetime.datetime.now)
+
+    owner = TextField()
+    repo = TextField()
+    resource = TextField()
+    fetch_index = IntegerField()
+    since = TextField(null=True)
+    last_id = IntegerField(null=True)
+    etag = TextField(null=True)
+
+    class Meta:
+        indexes = (
+            (('owner', 'repo', 'resource'), True),
+        )
+
+
 class SlantTopic(ProxyModel):
     ''' A topic of discussion on the Slant website. '''
 
@@ -581,6 +670,7 @@ def create_tables():
         WebPageVersion,
         QuestionSnapshot,
         QuestionSnapshotTag,
+        QuestionSnapshotCursor,
         Post,
         Tag,
         PostHistory,
@@ -602,6 +692,7 @@ def create_tables():
         Issue,
         IssueComment,
         IssueEvent,
+        GitHubSyncCursor,
         SlantTopic,
         Viewpoint,
         ViewpointSection,
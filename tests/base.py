@@ -4,6 +4,7 @@
 from __future__ import unicode_literals
 import logging
 from abc import ABCMeta
+from contextlib import contextmanager
 import unittest
 from peewee import SqliteDatabase
 from playhouse.test_utils import test_database
@@ -29,3 +30,23 @@ class TestCase(unittest.TestCase):
     def run(self, result=None):
         with test_database(test_db, self.models):
             super(TestCase, self).run(result)
+
+
+@contextmanager
+def record_queries():
+    '''
+    Record the SQL and parameters of each query that is run on the test database.
+    Yields a list to which a (sql, params) tuple is appended for each query.
+    '''
+    queries = []
+    execute_sql = test_db.execute_sql
+
+    def execute_and_record_sql(sql, params=None, *args, **kwargs):
+        queries.append((sql, params))
+        return execute_sql(sql, params, *args, **kwargs)
+
+    test_db.execute_sql = execute_and_record_sql
+    try:
+        yield queries
+    finally:
+        del test_db.execute_sql
@@ -0,0 +1,249 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import os
+import glob
+import json
+import shutil
+import tempfile
+import datetime
+import gzip
+import unittest
+
+from tests.base import TestCase
+from dump.dump import dump_json, dump_csv, dump_columnar, stream_query, CompressingWriter
+from models import Seed
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+class DumpTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(DumpTest, self).__init__([Seed], *args, **kwargs)
+
+    def setUp(self):
+        # Dumps are written to a 'data/' directory under the working directory.
+        self.working_dir = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        os.chdir(self.temp_dir)
+        for index in range(5):
+            Seed.create(fetch_index=1, seed='seed' + str(index), depth=index)
+
+    def tearDown(self):
+        os.chdir(self.working_dir)
+        shutil.rmtree(self.temp_dir)
+
+    def _read_dump(self, load=json.load):
+        dump_paths = glob.glob(os.path.join('data', '*'))
+        self.assertEqual(len(dump_paths), 1)
+        with open(dump_paths[0]) as dump_file:
+            return load(dump_file)
+
+    def test_stream_query_reads_all_rows_in_chunks(self):
+        query = Seed.select(Seed.seed, Seed.depth).order_by(Seed.depth).dicts()
+        rows = list(stream_query(query, chunk_size=2))
+        self.assertEqual([r['depth'] for r in rows], [0, 1, 2, 3, 4])
+        self.assertEqual(rows[0]['seed'], 'seed0')
+
+    def test_stream_query_makes_models(self):
+        seeds = list(stream_query(Seed.select().order_by(Seed.depth), chunk_size=3))
+        self.assertEqual(len(seeds), 5)
+        self.assertIsInstance(seeds[4], Seed)
+        self.assertEqual(seeds[4].seed, 'seed4')
+
+    def test_dump_query_rows_as_json(self):
+
+        @dump_json('seeds')
+        def harvest():
+            yield Seed.select(Seed.seed).where(Seed.depth < 2).order_by(Seed.depth).dicts()
+            yield [{'seed': 'listed'}]
+
+        harvest()
+        self.assertEqual(
+            self._read_dump(),
+            [{'seed': 'seed0'}, {'seed': 'seed1'}, {'seed': 'listed'}]
+        )
+
+    def test_dump_dates_and_unicode_as_json(self):
+
+        @dump_json('seeds')
+        def harvest():
+            yield [{'seed': 'caf\xe9 \u2603', 'date': datetime.datetime(2016, 1, 2, 3, 4, 5)}]
+
+        harvest()
+        self.assertEqual(
+            self._read_dump(),
+            [{'seed': 'caf\xe9 \u2603', 'date': '2016-01-02T03:04:05'}]
+        )
+
+    def test_dump_generator_values_as_json_lists(self):
+
+        @dump_json('seeds')
+        def harvest():
+            query = Seed.select(Seed.seed).order_by(Seed.depth).tuples()
+            yield [{
+                'name': 'all',
+                'seeds': (seed for (seed,) in stream_query(query)),
+                'depths': (depth for depth in range(2)),
+            }]
+
+        harvest()
+        record = self._read_dump()[0]
+        self.assertEqual(record['name'], 'all')
+        self.assertEqual(record['seeds'], ['seed0', 'seed1', 'seed2', 'seed3', 'seed4'])
+        self.assertEqual(record['depths'], [0, 1])
+
+    def test_dump_values_that_cannot_be_encoded_raises_type_error(self):
+
+        @dump_json('seeds')
+        def harvest():
+            yield [['seed0', object()]]
+
+        with self.assertRaises(TypeError):
+            harvest()
+
+    def test_dump_modified_rows_of_query_that_was_already_run(self):
+
+        @dump_json('seeds')
+        def harvest():
+            query = Seed.select(Seed.seed).where(Seed.depth == 0).dicts()
+            for record in query:
+                record['tag_name'] = 'tag'
+            yield query
+
+        harvest()
+        self.assertEqual(self._read_dump(), [{'seed': 'seed0', 'tag_name': 'tag'}])
+
+    def test_dump_query_rows_as_csv(self):
+
+        @dump_csv('seeds', ['seed', 'depth'])
+        def harvest():
+            yield (
+                Seed.select(Seed.seed, Seed.depth)
+                .where(Seed.depth < 2).order_by(Seed.depth)
+                .tuples()
+            )
+
+        harvest()
+        lines = self._read_dump(load=lambda f: f.read().splitlines())
+        self.assertEqual(lines, ['"seed","depth"', '"seed0",0', '"seed1",1'])
+
+    def _harvest_seeds(self, **kwargs):
+
+        @dump_json('seeds')
+        def harvest(**kwargs):
+            yield Seed.select(Seed.seed).where(Seed.depth < 2).order_by(Seed.depth).dicts()
+
+        harvest(**kwargs)
+
+    def test_dump_json_lines(self):
+        self._harvest_seeds(json_lines=True)
+        self.assertEqual(glob.glob(os.path.join('data', '*'))[0][-6:], '.jsonl')
+        lines = self._read_dump(load=lambda f: f.read().splitlines())
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [{'seed': 'seed0'}, {'seed': 'seed1'}]
+        )
+
+    def test_dump_compressed_with_gzip(self):
+        self._harvest_seeds(compression='gzip')
+        dump_path = glob.glob(os.path.join('data', '*'))[0]
+        self.assertTrue(dump_path.endswith('.json.gz'))
+        with gzip.open(dump_path) as dump_file:
+            self.assertEqual(json.load(dump_file), [{'seed': 'seed0'}, {'seed': 'seed1'}])
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_dump_compressed_with_zstd(self):
+        self._harvest_seeds(compression='zstd')
+        dump_path = glob.glob(os.path.join('data', '*'))[0]
+        self.assertTrue(dump_path.endswith('.json.zst'))
+        with open(dump_path, 'rb') as dump_file:
+            content = zstandard.ZstdDecompressor().stream_reader(dump_file).read()
+        self.assertEqual(json.loads(content), [{'seed': 'seed0'}, {'seed': 'seed1'}])
+
+    def test_dump_to_named_output(self):
+        self._harvest_seeds(output='seeds.json')
+        self.assertFalse(os.path.exists('data'))
+        with open('seeds.json') as dump_file:
+            self.assertEqual(json.load(dump_file), [{'seed': 'seed0'}, {'seed': 'seed1'}])
+
+    def test_dump_to_standard_output(self):
+
+        # Point standard output at a file while the dump is written.
+        stdout_fd = os.dup(1)
+        with open('stdout', 'wb') as stdout_file:
+            os.dup2(stdout_file.fileno(), 1)
+            try:
+                self._harvest_seeds(output='-', json_lines=True)
+            finally:
+                os.dup2(stdout_fd, 1)
+                os.close(stdout_fd)
+
+        with open('stdout') as stdout_file:
+            self.assertEqual(stdout_file.read(), '{"seed":"seed0"}\n{"seed":"seed1"}\n')
+
+    def test_compressing_writer_raises_errors_from_its_thread(self):
+
+        class FailingCompressor(object):
+            def compress(self, data):
+                raise IOError("Compression failed")
+
+        with self.assertRaises(IOError):
+            with CompressingWriter(open('dump', 'wb'), FailingCompressor(), 4) as writer:
+                for _ in range(100):
+                    writer.write(b'data')
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_dump_query_rows_to_parquet_in_row_groups(self):
+
+        @dump_columnar('seeds', ['seed', 'depth'], file_format='parquet', row_group_size=2)
+        def harvest():
+            yield Seed.select(Seed.seed, Seed.depth).order_by(Seed.depth).tuples()
+
+        harvest()
+        dump_path = glob.glob(os.path.join('data', '*.parquet'))[0]
+        parquet_file = pyarrow.parquet.ParquetFile(dump_path)
+        self.assertEqual(parquet_file.num_row_groups, 3)
+        self.assertEqual(
+            parquet_file.read().to_pydict(),
+            {'seed': ['seed0', 'seed1', 'seed2', 'seed3', 'seed4'], 'depth': [0, 1, 2, 3, 4]}
+        )
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_dump_records_to_memory_mappable_arrow_file(self):
+
+        @dump_columnar('seeds', ['seed', 'date'], file_format='arrow')
+        def harvest():
+            yield [{'seed': 'seed0', 'date': datetime.datetime(2016, 1, 2)}]
+
+        harvest()
+        dump_path = glob.glob(os.path.join('data', '*.arrow'))[0]
+        with pyarrow.memory_map(dump_path) as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+        self.assertEqual(table.column_names, ['seed', 'date'])
+        self.assertEqual(table.to_pydict()['date'], [datetime.datetime(2016, 1, 2)])
+
+    @unittest.skipIf(pyarrow is not None, "pyarrow is installed")
+    def test_columnar_dump_without_pyarrow_makes_no_file(self):
+
+        @dump_columnar('seeds', ['seed'])
+        def harvest():
+            yield [{'seed': 'seed0'}]
+
+        with self.assertRaises(ImportError):
+            harvest()
+        self.assertEqual(glob.glob(os.path.join('data', '*')), [])
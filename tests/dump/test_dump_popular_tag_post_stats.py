@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+
+from tests.base import TestCase
+from tests.modelfactory import create_post, create_tag
+from dump.popular_tag_post_stats import harvest_post_stats
+from models import Post, PostTag, Tag
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+class DumpPopularTagPostStatsTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(DumpPopularTagPostStatsTest, self).__init__(
+            [Post, PostTag, Tag],
+            *args, **kwargs
+        )
+
+    def _create_posts(self, tag_name, post_count, tag_count=None):
+        # The tag's count on Stack Overflow is the same as its number of posts, unless given.
+        tag = create_tag(tag_name=tag_name, count=tag_count or post_count)
+        for index in range(post_count):
+            post = create_post(title=tag_name + " post " + str(index), score=index)
+            PostTag.create(post_id=post.id, tag_id=tag.id)
+
+    def _harvest(self, sample_size, random_seed=1):
+        return [
+            record
+            for record_list in harvest_post_stats(sample_size, random_seed=random_seed)
+            for record in record_list
+        ]
+
+    def test_sample_posts_for_each_tag_in_one_dump(self):
+        self._create_posts('python', 200)
+        self._create_posts('javascript', 200)
+        self._create_posts('irrelevant-tag', 10)
+        records = self._harvest(sample_size=20)
+
+        # Records are ordered by the tags' order in the list of tags.
+        self.assertEqual([r['tag_name'] for r in records], ['javascript'] * 20 + ['python'] * 20)
+        python_titles = [r['title'] for r in records if r['tag_name'] == 'python']
+        self.assertEqual(len(set(python_titles)), 20)
+        self.assertTrue(all(title.startswith("python post") for title in python_titles))
+        self.assertEqual(
+            sorted(records[0].keys()),
+            sorted([
+                'tag_name', 'title', 'creation_date', 'answer_count', 'comment_count',
+                'favorite_count', 'score', 'view_count',
+            ])
+        )
+
+    def test_dump_all_posts_for_tag_smaller_than_sample(self):
+        self._create_posts('python', 5)
+        records = self._harvest(sample_size=20)
+        self.assertEqual(sorted([r['score'] for r in records]), [0, 1, 2, 3, 4])
+
+    def test_sample_size_depends_on_posts_in_database_not_tag_count(self):
+        self._create_posts('python', 200, tag_count=10000)
+        self._create_posts('javascript', 200, tag_count=10)
+        records = self._harvest(sample_size=20)
+        self.assertEqual(len([r for r in records if r['tag_name'] == 'python']), 20)
+        self.assertEqual(len([r for r in records if r['tag_name'] == 'javascript']), 20)
+
+    def test_same_seed_samples_same_posts(self):
+        self._create_posts('python', 100)
+        first_titles = [r['title'] for r in self._harvest(sample_size=10, random_seed=7)]
+        second_titles = [r['title'] for r in self._harvest(sample_size=10, random_seed=7)]
+        other_titles = [r['title'] for r in self._harvest(sample_size=10, random_seed=8)]
+        self.assertEqual(first_titles, second_titles)
+        self.assertNotEqual(set(first_titles), set(other_titles))
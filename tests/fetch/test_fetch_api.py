@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import unittest
+import tempfile
+import shutil
+import os
+import time
+
+from tests.mockserver import MockServer
+import fetch.api
+from fetch.api import make_request, default_requests_session, use_cassette, ResponseCassette,\
+    HostRateLimiter, GitHubRateLimiter, github_request, _send_request
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+class CassetteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'cassette')
+        self.responses = {'/page': 'first'}
+        # Responses are keyed by URL, so all requests in a test are made to one server.
+        self.server = MockServer(self._respond).__enter__()
+
+    def tearDown(self):
+        self.server.__exit__()
+        use_cassette(None)
+        shutil.rmtree(self.directory)
+
+    def _respond(self, path, params, headers):
+        if path not in self.responses:
+            return (404, {}, '')
+        etag = '"' + self.responses[path] + '"'
+        if headers.get('If-None-Match') == etag:
+            return (304, {'ETag': etag}, '')
+        return (200, {'Content-Type': 'text/plain', 'ETag': etag}, self.responses[path])
+
+    def _fetch(self, path, mode, params=None, headers=None, request=make_request):
+        use_cassette(self.filename, mode)
+        self.server.requests = []
+        response = request(
+            default_requests_session.get, self.server.url + path, params=params,
+            headers=headers)
+        return response, self.server.requests
+
+    def test_record_then_replay_without_network(self):
+        self._fetch('/page', 'record', params={'q': 'query'})
+        self.responses['/page'] = 'second'
+        response, requests = self._fetch('/page', 'replay', params={'q': 'query'})
+        self.assertEqual(requests, [])
+        self.assertEqual(response.text, 'first')
+        self.assertEqual(response.headers['content-type'], 'text/plain')
+
+    def test_responses_keyed_by_params(self):
+        self._fetch('/page', 'record', params={'q': 'query'})
+        response, requests = self._fetch('/page', 'replay', params={'q': 'other'})
+        self.assertIsNone(response)
+        response, requests = self._fetch('/page', 'record', params={'q': 'other'})
+        self.assertEqual(len(requests), 1)
+
+    def test_responses_keyed_by_conditional_headers(self):
+
+        # Like requests to the GitHub API, these accept "304 Not Modified" responses.
+        def fetch_page(mode, headers=None):
+            return self._fetch('/page', mode, headers=headers, request=_send_request)
+
+        response, _ = fetch_page('record', headers={'If-None-Match': '"first"'})
+        self.assertEqual(response.status_code, 304)
+
+        # The "Not Modified" response to the conditional request isn't replayed for an
+        # unconditional request, which needs the full content.
+        response, _ = fetch_page('replay')
+        self.assertIsNone(response)
+        response, requests = fetch_page('record')
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(response.text, 'first')
+        response, _ = fetch_page('replay', headers={'If-None-Match': '"first"'})
+        self.assertEqual(response.status_code, 304)
+
+    def test_failed_responses_not_recorded(self):
+        self._fetch('/missing', 'record')
+        _, requests = self._fetch('/missing', 'record')
+        self.assertEqual(len(requests), 1)
+
+    def test_refresh_replaces_recorded_response(self):
+        self._fetch('/page', 'record')
+        self.responses['/page'] = 'second'
+        response, requests = self._fetch('/page', 'refresh')
+        self.assertEqual(len(requests), 1)
+        response, _ = self._fetch('/page', 'replay')
+        self.assertEqual(response.text, 'second')
+
+    def test_compact_keeps_latest_responses(self):
+
+        use_cassette(self.filename, 'refresh')
+        for i in range(3):
+            self.responses['/page'] = 'version ' + str(i)
+            make_request(default_requests_session.get, self.server.url + '/page')
+        use_cassette(None)
+
+        # Most lines in the cassette are now stale, so it is compacted when opened.
+        cassette = ResponseCassette(self.filename, 'replay')
+        with open(self.filename) as cassette_file:
+            self.assertEqual(len(cassette_file.readlines()), 1)
+        self.assertEqual(cassette.get(cassette.offsets.keys()[0]).text, 'version 2')
+        cassette.close()
+
+    def test_replay_skips_pauses(self):
+        use_cassette(self.filename, 'replay')
+        self.assertIsNotNone(fetch.api.cassette)
+        fetch.api.pause(100)
+
+
+class FakeClock(object):
+    '''
+    Stands in for the `time` module in `fetch.api`.  The clock only moves when something
+    sleeps, and sleeps are recorded and skip the clock ahead instead of blocking.
+    '''
+
+    def __init__(self):
+        self.now = time.time()
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class HostRateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        fetch.api.time = self.clock
+
+    def tearDown(self):
+        fetch.api.time = time
+
+    def test_requests_to_different_hosts_do_not_wait_for_each_other(self):
+        rate_limiter = HostRateLimiter(rate=5)
+        for host in ['a.com', 'b.com', 'c.com']:
+            rate_limiter.wait('http://' + host + '/page')
+        self.assertEqual(self.clock.sleeps, [])
+        rate_limiter.wait('http://a.com/other-page')
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertAlmostEqual(self.clock.sleeps[0], .2)
+
+
+class GitHubRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rate_limiter = fetch.api.github_rate_limiter
+        self.clock = FakeClock()
+        fetch.api.time = self.clock
+        fetch.api.github_rate_limiter = GitHubRateLimiter(['token a', 'token b'])
+        # Each credential reports how many requests it has left.  A test can instead
+        # provide a list of responses to return to all requests, one after the other.
+        self.quotas = {'token a': 5000, 'token b': 5000}
+        self.reset_time = int(self.clock.time()) + 30
+        self.responses = []
+        self.auths = []
+        self.server = MockServer(self._respond).__enter__()
+
+    def tearDown(self):
+        self.server.__exit__()
+        fetch.api.time = time
+        fetch.api.github_rate_limiter = self.rate_limiter
+
+    def _respond(self, path, params, headers):
+
+        if len(self.responses) > 0:
+            return self.responses.pop(0)
+
+        auth = headers.get('Authorization')
+        rate_limit_headers = {'X-RateLimit-Reset': str(self.reset_time)}
+        if self.quotas[auth] == 0:
+            rate_limit_headers['X-RateLimit-Remaining'] = '0'
+            return (403, rate_limit_headers, {'message': "API rate limit exceeded"})
+
+        self.quotas[auth] -= 1
+        rate_limit_headers['X-RateLimit-Remaining'] = str(self.quotas[auth])
+        return (200, rate_limit_headers, [])
+
+    def _request(self, count=1):
+        self.server.requests = []
+        for _ in range(count):
+            response = github_request(self.server.url + '/repos/owner/repo/issues')
+            self.auths.append(response.request.headers['Authorization'] if response else None)
+        return response
+
+    def test_request_uses_credential_with_most_quota(self):
+        self.quotas = {'token a': 5, 'token b': 10}
+        self._request(count=4)
+        # Until the quota for both credentials is known, each is tried once.
+        self.assertEqual(set(self.auths[:2]), set(['token a', 'token b']))
+        self.assertEqual(self.auths[2:], ['token b', 'token b'])
+
+    def test_requests_rotate_through_credentials(self):
+        self.quotas = {'token a': 3, 'token b': 3}
+        self._request(count=6)
+        self.assertEqual(self.auths.count('token a'), 3)
+        self.assertEqual(self.auths.count('token b'), 3)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_wait_for_reset_only_when_all_credentials_run_out(self):
+
+        self.quotas = {'token a': 1, 'token b': 1}
+        self._request(count=2)
+        self.assertEqual(self.clock.sleeps, [])
+
+        # Once the quota is refreshed, the request that waited for it is sent.
+        self.quotas = {'token a': 5000, 'token b': 5000}
+        response = self._request()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertAlmostEqual(self.clock.sleeps[0], 31, delta=1)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_pause_for_retry_after(self):
+        self.responses = [(429, {'Retry-After': '7'}, {'message': "Too many requests"})]
+        response = self._request()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertAlmostEqual(self.clock.sleeps[0], 8, delta=1)
+
+    def test_pause_for_secondary_rate_limit(self):
+        self.responses = [(
+            403, {'X-RateLimit-Remaining': '4999'},
+            {'message': "You have exceeded a secondary rate limit."}
+        )]
+        response = self._request()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertAlmostEqual(
+            self.clock.sleeps[0], fetch.api.GITHUB_SECONDARY_LIMIT_DELAY + 1, delta=1)
+
+    def test_give_up_after_repeated_rate_limits(self):
+        self.responses = [
+            (429, {'Retry-After': '1'}, {'message': "Too many requests"})
+            for _ in range(fetch.api.GITHUB_RATE_LIMIT_ATTEMPTS + 1)
+        ]
+        response = self._request()
+        self.assertIsNone(response)
+        self.assertEqual(len(self.server.requests), fetch.api.GITHUB_RATE_LIMIT_ATTEMPTS)
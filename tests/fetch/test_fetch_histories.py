@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import datetime
+import time
+
+from tests.base import TestCase, record_queries
+from tests.mockserver import MockServer
+import fetch.histories
+from fetch.histories import get_histories, load_saved_timestamps, save_records
+from models import WebPageVersion, SQLITE_MAX_VARIABLES
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+FIELD_NAMES = ['urlkey', 'timestamp', 'original', 'mimetype', 'statuscode', 'digest', 'length']
+
+
+def _make_capture(url, day):
+    return [
+        'key', '201601%02d000000' % day, url, 'text/html', '200', 'digest' + str(day), '100']
+
+
+class MockCDX(object):
+    '''
+    Serves pages of captures for URLs from a Wayback Machine CDX server.
+    The resume key that follows each page is the index of the first capture on the next page.
+    '''
+
+    def __init__(self, urls, captures_per_url):
+        self.captures = {
+            url: [_make_capture(url, day) for day in range(1, captures_per_url + 1)]
+            for url in urls
+        }
+
+    def respond(self, path, params, headers):
+
+        captures = self.captures[params['url']]
+        if 'from' in params:
+            captures = [c for c in captures if c[1] >= params['from']]
+        start = int(params.get('resumeKey', 0))
+        end = start + int(params['limit'])
+
+        rows = [FIELD_NAMES] + captures[start:end]
+        if end < len(captures):
+            rows += [[], [str(end)]]
+        return (200, {}, rows)
+
+
+class FetchHistoriesTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FetchHistoriesTest, self).__init__(
+            [WebPageVersion],
+            *args, **kwargs
+        )
+
+    def setUp(self):
+        self.archive_url = fetch.histories.ARCHIVE_URL
+        self.page_size = fetch.histories.DEFAULT_PARAMS['limit']
+        fetch.histories.DEFAULT_PARAMS['limit'] = 2
+
+    def tearDown(self):
+        fetch.histories.ARCHIVE_URL = self.archive_url
+        fetch.histories.DEFAULT_PARAMS['limit'] = self.page_size
+
+    def _fetch(self, mock_cdx, fetch_index=1, workers=2, latency=0, incremental=False):
+        with MockServer(mock_cdx.respond, latency=latency) as server:
+            fetch.histories.ARCHIVE_URL = server.url + '/cdx/search/cdx'
+            get_histories(
+                mock_cdx.captures.keys(), fetch_index, workers=workers, requests_per_second=1000,
+                incremental=incremental
+            )
+            return server.requests
+
+    def test_fetch_all_pages_of_captures_for_all_urls(self):
+        requests = self._fetch(MockCDX(['http://a.com', 'http://b.com'], captures_per_url=5))
+        self.assertEqual(len(requests), 6)
+        self.assertEqual(WebPageVersion.select().count(), 10)
+        version = WebPageVersion.get(
+            WebPageVersion.url == 'http://a.com', WebPageVersion.digest == 'digest3')
+        self.assertEqual(version.timestamp.day, 3)
+        self.assertEqual(version.length, 100)
+        self.assertEqual(version.fetch_index, 1)
+
+    def test_existing_versions_not_saved_again(self):
+        mock_cdx = MockCDX(['http://a.com'], captures_per_url=3)
+        self._fetch(mock_cdx, fetch_index=1)
+        self._fetch(mock_cdx, fetch_index=2)
+        self.assertEqual(WebPageVersion.select().count(), 3)
+
+    def test_concurrent_fetching_scales_with_workers(self):
+
+        urls = ['http://site' + str(i) + '.com' for i in range(4)]
+
+        start_time = time.time()
+        self._fetch(MockCDX(urls, captures_per_url=4), workers=1, latency=.05)
+        serial_time = time.time() - start_time
+
+        start_time = time.time()
+        self._fetch(MockCDX(urls, captures_per_url=4), fetch_index=2, workers=4, latency=.05)
+        concurrent_time = time.time() - start_time
+
+        self.assertLess(concurrent_time, serial_time / 2)
+
+    def test_save_records_skips_saved_and_repeated_timestamps(self):
+
+        self._fetch(MockCDX(['http://a.com'], captures_per_url=2))
+        saved_timestamps = load_saved_timestamps('http://a.com')
+        self.assertEqual(len(saved_timestamps), 2)
+
+        records = [
+            dict(zip(FIELD_NAMES, _make_capture('http://a.com', day)))
+            for day in [1, 3, 3]
+        ]
+        save_records('http://a.com', records, 2, saved_timestamps)
+
+        self.assertEqual(WebPageVersion.select().count(), 3)
+        self.assertEqual(WebPageVersion.select().where(WebPageVersion.fetch_index == 2).count(), 1)
+        self.assertEqual(len(saved_timestamps), 3)
+
+    def test_save_records_in_batches_within_sqlite_variable_limit(self):
+
+        start_time = datetime.datetime(2016, 1, 1)
+        records = []
+        for hour in range(250):
+            capture = _make_capture('http://a.com', 1)
+            capture[1] = (start_time + datetime.timedelta(hours=hour)).strftime('%Y%m%d%H%M%S')
+            records.append(dict(zip(FIELD_NAMES, capture)))
+
+        with record_queries() as queries:
+            save_records('http://a.com', records, 1, set())
+
+        inserts = [params for (sql, params) in queries if sql.startswith('INSERT')]
+        self.assertGreater(len(inserts), 1)
+        for params in inserts:
+            self.assertLessEqual(len(params), SQLITE_MAX_VARIABLES)
+        self.assertEqual(WebPageVersion.select().count(), 250)
+
+    def test_incremental_fetch_requests_only_new_captures(self):
+
+        mock_cdx = MockCDX(['http://a.com', 'http://b.com'], captures_per_url=3)
+        self._fetch(mock_cdx, fetch_index=1)
+        mock_cdx.captures['http://a.com'].extend(
+            [_make_capture('http://a.com', day) for day in [4, 5]])
+        requests = self._fetch(mock_cdx, fetch_index=2, incremental=True)
+
+        # The newest saved capture for each URL is fetched again, as 'from' is inclusive.
+        # That makes 3 captures (2 pages) for the first URL and 1 for the second, instead of
+        # the 5 pages needed to fetch both full histories.
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(
+            set([params['from'] for _, params in requests]), set(['20160103000000']))
+        self.assertEqual(WebPageVersion.select().count(), 8)
+        new_versions = WebPageVersion.select().where(WebPageVersion.fetch_index == 2)
+        self.assertEqual(sorted([v.timestamp.day for v in new_versions]), [4, 5])
@@ -0,0 +1,218 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import json
+import hashlib
+import urllib
+
+from tests.base import TestCase
+from tests.mockserver import MockServer
+import fetch.issue_comments
+from fetch.issue_comments import load_issue_index, save_comments, batch_inserter,\
+    get_issue_comments
+from models import GitHubProject, Issue, IssueComment, GitHubSyncCursor
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+PAGE_SIZE = 2
+
+
+def _make_comment(comment_id, issue_number, updated_at='2016-01-02T00:00:00Z', body="Comment"):
+    return {
+        'id': comment_id,
+        'issue_url': 'https://api.github.com/repos/owner/repo/issues/' + str(issue_number),
+        'created_at': '2016-01-01T00:00:00Z',
+        'updated_at': updated_at,
+        'body': body,
+        'user': {'id': 1},
+    }
+
+
+class MockGitHub(object):
+    '''
+    Serves pages of comments on the issues of the repository "owner/repo".
+    Supports the 'since' parameter and conditional requests with ETags.
+    The pages listed in `failing_pages` fail with a server error.
+    '''
+
+    def __init__(self, comments):
+        self.url = None
+        self.comments = comments
+        self.failing_pages = []
+
+    def respond(self, path, params, headers):
+
+        if path != '/repos/owner/repo/issues/comments':
+            return (404, {}, {'message': "Not Found"})
+
+        comments = self.comments
+        if 'since' in params:
+            comments = [c for c in comments if c['updated_at'] >= params['since']]
+        if params.get('sort') == 'updated':
+            comments = sorted(comments, key=lambda c: c['updated_at'])
+
+        page = int(params.get('page', 1))
+        if page in self.failing_pages:
+            return (500, {}, {'message': "Server Error"})
+
+        page_comments = comments[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+        etag = '"' + hashlib.md5(json.dumps(page_comments)).hexdigest() + '"'
+        if headers.get('If-None-Match') == etag:
+            return (304, {'ETag': etag}, '')
+
+        response_headers = {'ETag': etag}
+        if page * PAGE_SIZE < len(comments):
+            next_params = dict(params, page=page + 1)
+            response_headers['Link'] = (
+                '<' + self.url + path + '?' + urllib.urlencode(next_params) + '>; rel="next", ' +
+                '<' + self.url + path + '?page=99>; rel="last"'
+            )
+        return (200, response_headers, page_comments)
+
+
+class SaveIssueCommentsTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(SaveIssueCommentsTest, self).__init__(
+            [GitHubProject, Issue, IssueComment],
+            *args, **kwargs
+        )
+
+    def _create_issue(self, project, number, fetch_index):
+        return Issue.create(
+            fetch_index=fetch_index,
+            github_id=number,
+            project=project,
+            number=number,
+            created_at='2016-01-01T00:00:00Z',
+            updated_at='2016-01-01T00:00:00Z',
+            state='open',
+            comments=1,
+        )
+
+    def test_index_includes_only_issues_from_fetch_index_and_project(self):
+        project = GitHubProject.create(fetch_index=2, name='p', owner='owner', repo='repo')
+        other_project = GitHubProject.create(fetch_index=2, name='o', owner='owner', repo='other')
+        old_project = GitHubProject.create(fetch_index=1, name='p', owner='owner', repo='repo')
+        issue = self._create_issue(project, 1, fetch_index=2)
+        self._create_issue(other_project, 2, fetch_index=2)
+        self._create_issue(old_project, 3, fetch_index=1)
+        self.assertEqual(load_issue_index(project, 2), {1: issue.id})
+
+    def test_save_comments_links_comments_to_indexed_issues(self):
+        project = GitHubProject.create(fetch_index=1, name='p', owner='owner', repo='repo')
+        issue = self._create_issue(project, 1, fetch_index=1)
+        save_comments(
+            [_make_comment(10, 1), _make_comment(11, 2)],
+            issue_index=load_issue_index(project, 1),
+            fetch_index=1,
+        )
+        batch_inserter.flush()
+
+        # The comment on issue 2 is skipped, as this issue wasn't fetched.
+        comments = IssueComment.select()
+        self.assertEqual(len(comments), 1)
+        self.assertEqual(comments[0].github_id, 10)
+        self.assertEqual(comments[0].issue.id, issue.id)
+
+
+class FetchIssueCommentsTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FetchIssueCommentsTest, self).__init__(
+            [GitHubProject, Issue, IssueComment, GitHubSyncCursor],
+            *args, **kwargs
+        )
+
+    def setUp(self):
+        self.api_url = fetch.issue_comments.GITHUB_API_URL
+
+    def tearDown(self):
+        fetch.issue_comments.GITHUB_API_URL = self.api_url
+
+    def _create_issues(self, fetch_index, issue_count=2):
+        # Issues are fetched again in each fetch, so they get new IDs each time.
+        project = GitHubProject.create(
+            fetch_index=fetch_index, name='project', owner='owner', repo='repo')
+        for number in range(1, issue_count + 1):
+            Issue.create(
+                fetch_index=fetch_index,
+                github_id=number,
+                project=project,
+                number=number,
+                created_at='2016-01-01T00:00:00Z',
+                updated_at='2016-01-01T00:00:00Z',
+                state='open',
+                comments=2,
+            )
+
+    def _fetch_from(self, mock_github, incremental=False):
+        with MockServer(mock_github.respond) as server:
+            mock_github.url = server.url
+            fetch.issue_comments.GITHUB_API_URL = server.url
+            get_issue_comments(show_progress=False, workers=1, incremental=incremental)
+            return server.requests
+
+    def _make_mock_github(self):
+        # Comments 1 and 2 are on issue 1, and comments 3 and 4 are on issue 2.
+        return MockGitHub([
+            _make_comment(
+                comment_id, issue_number=(comment_id + 1) / 2,
+                updated_at='2016-01-%02dT00:00:00Z' % comment_id
+            )
+            for comment_id in range(1, 5)
+        ])
+
+    def test_incremental_fetch_carries_forward_comments_to_latest_issues(self):
+
+        self._create_issues(fetch_index=1)
+        mock_github = self._make_mock_github()
+        self._fetch_from(mock_github)
+
+        self._create_issues(fetch_index=2)
+        mock_github.comments[2] = _make_comment(
+            3, issue_number=2, updated_at='2016-02-01T00:00:00Z', body="Edited")
+        requests = self._fetch_from(mock_github, incremental=True)
+
+        # Only comments updated since the last fetch are requested, though the new fetch
+        # still has all comments.  The ones carried forward link to the new issues.
+        self.assertEqual(requests[0][1]['since'], '2016-01-04T00:00:00Z')
+        # After the changes are fetched, the ETag for the next sync's request is fetched.
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[1][1]['since'], '2016-02-01T00:00:00Z')
+        comments = IssueComment.select().where(IssueComment.fetch_index == 2)
+        self.assertEqual(len(comments), 4)
+        self.assertEqual(set([c.issue.fetch_index for c in comments]), set([2]))
+        self.assertEqual(
+            {c.github_id: c.issue.number for c in comments}, {1: 1, 2: 1, 3: 2, 4: 2})
+        self.assertEqual(
+            IssueComment.get(IssueComment.fetch_index == 2, IssueComment.github_id == 3).body,
+            "Edited"
+        )
+
+    def test_cursor_not_advanced_after_failed_page(self):
+
+        self._create_issues(fetch_index=1)
+        mock_github = self._make_mock_github()
+        self._fetch_from(mock_github)
+
+        for comment_id in [1, 3]:
+            mock_github.comments[comment_id - 1] = _make_comment(
+                comment_id, issue_number=(comment_id + 1) / 2, updated_at='2016-02-01T00:00:00Z')
+        mock_github.failing_pages = [2]
+        self._fetch_from(mock_github, incremental=True)
+
+        cursor = GitHubSyncCursor.get(GitHubSyncCursor.resource == 'comments')
+        self.assertEqual(cursor.fetch_index, 1)
+        self.assertEqual(cursor.since, '2016-01-04T00:00:00Z')
+
+        # The next fetch picks up from the same cursor, and requests all of the changes again.
+        mock_github.failing_pages = []
+        requests = self._fetch_from(mock_github, incremental=True)
+        self.assertEqual(requests[0][1]['since'], '2016-01-04T00:00:00Z')
+        self.assertEqual(IssueComment.select().where(IssueComment.fetch_index == 3).count(), 4)
+        cursor = GitHubSyncCursor.get(GitHubSyncCursor.resource == 'comments')
+        self.assertEqual(cursor.fetch_index, 3)
+        self.assertEqual(cursor.since, '2016-02-01T00:00:00Z')
@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import json
+import hashlib
+import urllib
+
+from tests.base import TestCase
+from tests.mockserver import MockServer
+import fetch.issue_events
+from fetch.issue_events import get_issue_events
+from models import GitHubProject, Issue, IssueEvent, GitHubSyncCursor
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+PAGE_SIZE = 2
+
+
+def _make_event(event_id, issue_id):
+    return {
+        'id': event_id,
+        'issue': {'id': issue_id},
+        'event': 'labeled',
+        'created_at': '2016-01-%02dT00:00:00Z' % event_id,
+    }
+
+
+class MockGitHub(object):
+    '''
+    Serves pages of events on the issues of the repository "owner/repo", newest first.
+    Supports conditional requests with ETags.
+    The pages listed in `failing_pages` fail with a server error.
+    '''
+
+    def __init__(self, events):
+        self.url = None
+        self.events = events
+        self.failing_pages = []
+
+    def respond(self, path, params, headers):
+
+        if path != '/repos/owner/repo/issues/events':
+            return (404, {}, {'message': "Not Found"})
+
+        events = sorted(self.events, key=lambda e: e['id'], reverse=True)
+        page = int(params.get('page', 1))
+        if page in self.failing_pages:
+            return (500, {}, {'message': "Server Error"})
+
+        page_events = events[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+        etag = '"' + hashlib.md5(json.dumps(page_events)).hexdigest() + '"'
+        if headers.get('If-None-Match') == etag:
+            return (304, {'ETag': etag}, '')
+
+        response_headers = {'ETag': etag}
+        if page * PAGE_SIZE < len(events):
+            next_params = dict(params, page=page + 1)
+            response_headers['Link'] = (
+                '<' + self.url + path + '?' + urllib.urlencode(next_params) + '>; rel="next", ' +
+                '<' + self.url + path + '?page=99>; rel="last"'
+            )
+        return (200, response_headers, page_events)
+
+
+class FetchIssueEventsTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FetchIssueEventsTest, self).__init__(
+            [GitHubProject, Issue, IssueEvent, GitHubSyncCursor],
+            *args, **kwargs
+        )
+
+    def setUp(self):
+        self.api_url = fetch.issue_events.GITHUB_API_URL
+
+    def tearDown(self):
+        fetch.issue_events.GITHUB_API_URL = self.api_url
+
+    def _create_issues(self, fetch_index, issue_count=2):
+        # Issues are fetched again in each fetch, so they get new IDs each time.
+        project = GitHubProject.create(
+            fetch_index=fetch_index, name='project', owner='owner', repo='repo')
+        for number in range(1, issue_count + 1):
+            Issue.create(
+                fetch_index=fetch_index,
+                github_id=number * 100,
+                project=project,
+                number=number,
+                created_at='2016-01-01T00:00:00Z',
+                updated_at='2016-01-01T00:00:00Z',
+                state='open',
+                comments=0,
+            )
+
+    def _fetch_from(self, mock_github, incremental=False):
+        with MockServer(mock_github.respond) as server:
+            mock_github.url = server.url
+            fetch.issue_events.GITHUB_API_URL = server.url
+            get_issue_events(show_progress=False, workers=1, incremental=incremental)
+            return server.requests
+
+    def _make_mock_github(self):
+        # Events 1 and 2 are on issue 1, and events 3 and 4 are on issue 2.
+        return MockGitHub([
+            _make_event(event_id, issue_id=(event_id + 1) / 2 * 100)
+            for event_id in range(1, 5)
+        ])
+
+    def test_incremental_fetch_stops_paging_at_last_seen_event(self):
+
+        self._create_issues(fetch_index=1)
+        mock_github = self._make_mock_github()
+        self._fetch_from(mock_github)
+        self.assertEqual(GitHubSyncCursor.get(GitHubSyncCursor.resource == 'events').last_id, 4)
+
+        # The first page of events is new, and the second page starts with an event we have
+        # seen.  No pages after that are requested.
+        mock_github.events.extend([_make_event(event_id, issue_id=100) for event_id in [5, 6, 7]])
+        requests = self._fetch_from(mock_github, incremental=True)
+        self.assertEqual(len(requests), 2)
+
+        events = IssueEvent.select().where(IssueEvent.fetch_index == 2)
+        self.assertEqual(sorted([e.github_id for e in events]), [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(GitHubSyncCursor.get(GitHubSyncCursor.resource == 'events').last_id, 7)
+
+    def test_incremental_fetch_carries_forward_events_to_latest_issues(self):
+
+        self._create_issues(fetch_index=1)
+        mock_github = self._make_mock_github()
+        self._fetch_from(mock_github)
+
+        self._create_issues(fetch_index=2)
+        mock_github.events.append(_make_event(5, issue_id=200))
+        self._fetch_from(mock_github, incremental=True)
+
+        events = IssueEvent.select().where(IssueEvent.fetch_index == 2)
+        self.assertEqual(len(events), 5)
+        self.assertEqual(set([e.issue.fetch_index for e in events]), set([2]))
+        self.assertEqual(
+            {e.github_id: e.issue.number for e in events}, {1: 1, 2: 1, 3: 2, 4: 2, 5: 2})
+
+    def test_cursor_not_advanced_after_failed_page(self):
+
+        self._create_issues(fetch_index=1)
+        mock_github = self._make_mock_github()
+        self._fetch_from(mock_github)
+
+        mock_github.events.extend([_make_event(event_id, issue_id=100) for event_id in [5, 6, 7]])
+        mock_github.failing_pages = [2]
+        self._fetch_from(mock_github, incremental=True)
+
+        cursor = GitHubSyncCursor.get(GitHubSyncCursor.resource == 'events')
+        self.assertEqual(cursor.fetch_index, 1)
+        self.assertEqual(cursor.last_id, 4)
+
+        # The next fetch starts from the same cursor, and fetches all of the new events again.
+        mock_github.failing_pages = []
+        self._fetch_from(mock_github, incremental=True)
+        events = IssueEvent.select().where(IssueEvent.fetch_index == 3)
+        self.assertEqual(sorted([e.github_id for e in events]), [1, 2, 3, 4, 5, 6, 7])
+        cursor = GitHubSyncCursor.get(GitHubSyncCursor.resource == 'events')
+        self.assertEqual(cursor.fetch_index, 3)
+        self.assertEqual(cursor.last_id, 7)
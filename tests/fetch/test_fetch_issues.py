@@ -0,0 +1,245 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import re
+import threading
+import json
+import hashlib
+import urllib
+
+from tests.base import TestCase, record_queries
+from tests.mockserver import MockServer
+import fetch.issues
+from fetch.issues import get_issues_for_projects
+from models import GitHubProject, Issue, GitHubSyncCursor, SQLITE_MAX_VARIABLES
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+PAGE_SIZE = 2
+
+
+def _make_issue(project_index, number, updated_at='2016-01-02T00:00:00Z', state='open'):
+    return {
+        'id': project_index * 1000 + number,
+        'number': number,
+        'created_at': '2016-01-01T00:00:00Z',
+        'updated_at': updated_at,
+        'closed_at': None,
+        'state': state,
+        'body': "Issue body",
+        'comments': 0,
+        'user': {'id': 1},
+    }
+
+
+class MockGitHub(object):
+    '''
+    Serves pages of issues for repositories named "repo0", "repo1", and so on.
+    Supports the 'since' parameter and conditional requests with ETags.
+    The status code of each response is recorded in `statuses`.
+    '''
+
+    def __init__(self, project_count, issues_per_project):
+        self.url = None
+        self.issues = {
+            project_index: [
+                _make_issue(project_index, number)
+                for number in range(1, issues_per_project + 1)
+            ] for project_index in range(project_count)
+        }
+        self.statuses = []
+
+    def respond(self, path, params, headers):
+        response = self._respond(path, params, headers)
+        self.statuses.append(response[0])
+        return response
+
+    def _respond(self, path, params, headers):
+
+        match = re.match('^/repos/([^/]+)/repo(\d+)/issues$', path)
+        if match is None:
+            return (404, {}, {'message': "Not Found"})
+
+        issues = self.issues[int(match.group(2))]
+        if 'since' in params:
+            issues = [i for i in issues if i['updated_at'] >= params['since']]
+        if params.get('sort') == 'updated':
+            issues = sorted(issues, key=lambda i: i['updated_at'])
+
+        page = int(params.get('page', 1))
+        page_issues = issues[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+        etag = '"' + hashlib.md5(json.dumps(page_issues)).hexdigest() + '"'
+        if headers.get('If-None-Match') == etag:
+            return (304, {'ETag': etag}, '')
+
+        response_headers = {'ETag': etag}
+        if page * PAGE_SIZE < len(issues):
+            next_params = dict(params, page=page + 1)
+            response_headers['Link'] = (
+                '<' + self.url + path + '?' + urllib.urlencode(next_params) + '>; rel="next", ' +
+                '<' + self.url + path + '?page=99>; rel="last"'
+            )
+        return (200, response_headers, page_issues)
+
+
+class FetchIssuesTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FetchIssuesTest, self).__init__(
+            [GitHubProject, Issue, GitHubSyncCursor],
+            *args, **kwargs
+        )
+
+    def setUp(self):
+        self.api_url = fetch.issues.GITHUB_API_URL
+
+    def tearDown(self):
+        fetch.issues.GITHUB_API_URL = self.api_url
+
+    def _fetch(self, project_count, issues_per_project, workers, latency=0):
+        mock_github = MockGitHub(project_count, issues_per_project)
+        self._fetch_from(mock_github, workers=workers, latency=latency)
+        return mock_github
+
+    def _fetch_from(self, mock_github, workers=1, latency=0, incremental=False):
+        with MockServer(mock_github.respond, latency=latency) as server:
+            mock_github.url = server.url
+            fetch.issues.GITHUB_API_URL = server.url
+            projects = [
+                {'name': 'project' + str(i), 'owner': 'owner', 'repo': 'repo' + str(i)}
+                for i in range(len(mock_github.issues))
+            ]
+            get_issues_for_projects(
+                projects, show_progress=False, workers=workers, incremental=incremental)
+            return server.requests
+
+    def test_fetch_all_pages_of_issues_for_all_projects(self):
+        self._fetch(project_count=3, issues_per_project=5, workers=2)
+        self.assertEqual(Issue.select().count(), 15)
+        for project in GitHubProject.select():
+            self.assertEqual(Issue.select().where(Issue.project == project).count(), 5)
+
+    def test_projects_saved_in_listed_order_with_one_fetch_index(self):
+        self._fetch(project_count=4, issues_per_project=1, workers=4)
+        projects = GitHubProject.select().order_by(GitHubProject.id)
+        self.assertEqual(
+            [p.name for p in projects], ['project0', 'project1', 'project2', 'project3'])
+        self.assertEqual(set([p.fetch_index for p in projects]), set([1]))
+
+    def test_issues_linked_to_fetch_index_of_projects(self):
+        self._fetch(project_count=1, issues_per_project=1, workers=1)
+        self._fetch(project_count=1, issues_per_project=1, workers=1)
+        self.assertEqual(Issue.select().where(Issue.fetch_index == 2).count(), 1)
+        issue = Issue.select().where(Issue.fetch_index == 2).first()
+        self.assertEqual(issue.project.fetch_index, 2)
+
+    def test_project_issues_saved_in_batches_in_one_transaction(self):
+
+        with record_queries() as queries:
+            self._fetch(project_count=1, issues_per_project=100, workers=1)
+        self.assertEqual(Issue.select().count(), 100)
+
+        # The issues should be split into batches small enough for SQLite, and
+        # all batches should be inserted within the same transaction.
+        statements = [sql for (sql, params) in queries]
+        insert_indexes = [
+            i for (i, sql) in enumerate(statements) if sql.startswith('INSERT INTO "issue"')]
+        self.assertGreater(len(insert_indexes), 1)
+        for index in insert_indexes:
+            self.assertLessEqual(len(queries[index][1]), SQLITE_MAX_VARIABLES)
+        self.assertTrue(any(
+            sql.startswith('BEGIN') for sql in statements[:insert_indexes[0]]
+        ))
+        self.assertFalse(any(
+            sql.startswith('BEGIN')
+            for sql in statements[insert_indexes[0]:insert_indexes[-1]]
+        ))
+
+    def _count_requests_in_flight(self, mock_github, workers):
+        '''
+        Make the mock API record the peak number of requests it is handling at once.
+        Responses are held until `workers` requests are in flight (or a timeout passes), so
+        that the peak doesn't depend on how quickly the workers happen to send requests.
+        '''
+        in_flight = {'count': 0, 'peak': 0}
+        lock = threading.Lock()
+        all_in_flight = threading.Event()
+        respond = mock_github.respond
+
+        def respond_once_all_in_flight(path, params, headers):
+            with lock:
+                in_flight['count'] += 1
+                in_flight['peak'] = max(in_flight['peak'], in_flight['count'])
+                if in_flight['count'] >= workers:
+                    all_in_flight.set()
+            # If the workers never all send requests at once, only the first response waits.
+            if not all_in_flight.wait(timeout=5):
+                all_in_flight.set()
+            with lock:
+                in_flight['count'] -= 1
+            return respond(path, params, headers)
+
+        mock_github.respond = respond_once_all_in_flight
+        return in_flight
+
+    def test_concurrent_fetching_uses_all_workers(self):
+
+        # This fetch has 4 projects with 3 pages of issues each.
+        mock_github = MockGitHub(project_count=4, issues_per_project=6)
+        in_flight = self._count_requests_in_flight(mock_github, workers=4)
+        self._fetch_from(mock_github, workers=4)
+
+        self.assertEqual(in_flight['peak'], 4)
+        self.assertEqual(Issue.select().count(), 24)
+
+    def test_serial_fetching_sends_one_request_at_a_time(self):
+        mock_github = MockGitHub(project_count=2, issues_per_project=4)
+        in_flight = self._count_requests_in_flight(mock_github, workers=1)
+        self._fetch_from(mock_github, workers=1, latency=.01)
+        self.assertEqual(in_flight['peak'], 1)
+
+    def test_incremental_fetch_carries_forward_unchanged_issues(self):
+
+        mock_github = self._fetch(project_count=1, issues_per_project=5, workers=1)
+        mock_github.issues[0][2] = _make_issue(
+            0, 3, updated_at='2016-02-01T00:00:00Z', state='closed')
+        requests = self._fetch_from(mock_github, incremental=True)
+
+        # Only the issues updated since the last fetch should have been requested,
+        # though the new fetch should still contain every issue.
+        self.assertEqual(requests[0][1]['since'], '2016-01-02T00:00:00Z')
+        self.assertEqual(Issue.select().where(Issue.fetch_index == 2).count(), 5)
+        updated_issue = Issue.get(Issue.fetch_index == 2, Issue.number == 3)
+        self.assertEqual(updated_issue.state, 'closed')
+        self.assertEqual(updated_issue.project.fetch_index, 2)
+
+    def test_unchanged_project_not_modified_in_first_incremental_fetch_after_change(self):
+
+        mock_github = self._fetch(project_count=1, issues_per_project=3, workers=1)
+        mock_github.issues[0][1] = _make_issue(0, 2, updated_at='2016-02-01T00:00:00Z')
+        self._fetch_from(mock_github, incremental=True)
+
+        # The changed issue moved the cursor forward, and the request for changes since
+        # then gets a "304 Not Modified" as nothing has changed since.
+        mock_github.statuses = []
+        requests = self._fetch_from(mock_github, incremental=True)
+        self.assertEqual(requests[0][1]['since'], '2016-02-01T00:00:00Z')
+        self.assertEqual(mock_github.statuses, [304])
+        self.assertEqual(Issue.select().where(Issue.fetch_index == 3).count(), 3)
+        updated_issue = Issue.get(Issue.fetch_index == 3, Issue.number == 2)
+        self.assertEqual(updated_issue.updated_at, '2016-02-01T00:00:00Z')
+
+    def test_incremental_fetch_makes_conditional_request(self):
+
+        mock_github = self._fetch(project_count=1, issues_per_project=3, workers=1)
+        self._fetch_from(mock_github, incremental=True)
+        requests = self._fetch_from(mock_github, incremental=True)
+
+        # After the first incremental fetch, the fetcher knows the ETag for unchanged results.
+        # It makes only one request, and copies all issues from the last fetch.
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(Issue.select().where(Issue.fetch_index == 3).count(), 3)
+        cursor = GitHubSyncCursor.get(GitHubSyncCursor.repo == 'repo0')
+        self.assertEqual(cursor.fetch_index, 3)
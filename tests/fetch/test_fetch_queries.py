@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+from xml.sax.saxutils import quoteattr
+
+from tests.base import TestCase
+from tests.mockserver import MockServer
+import fetch.queries
+from fetch.queries import get_results_for_seeds, resume_crawl, prune_expansion_chars,\
+    evaluate_pruning
+from models import Query, Seed
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def _make_toolbar_response(suggestions):
+    return '\n'.join(
+        ['<?xml version="1.0"?>', '<toplevel>'] +
+        [
+            '<CompleteSuggestion><suggestion data=' + quoteattr(s) + '/></CompleteSuggestion>'
+            for s in suggestions
+        ] +
+        ['</toplevel>']
+    )
+
+
+class MockAutocomplete(object):
+    '''
+    Suggests 10 queries for any seed shorter than `full_length` characters.
+    Longer seeds have only one suggestion, so they aren't expanded further.
+    '''
+
+    def __init__(self, full_length, failing_seeds=()):
+        self.full_length = full_length
+        self.failing_seeds = failing_seeds
+
+    def respond(self, path, params, headers):
+        seed = params['q']
+        if seed in self.failing_seeds:
+            return (500, {}, '')
+        if len(seed) < self.full_length:
+            suggestions = [seed + ' suggestion ' + str(i) for i in range(10)]
+        else:
+            suggestions = [seed + ' suggestion']
+        return (200, {}, _make_toolbar_response(suggestions))
+
+
+class MockCorpusAutocomplete(object):
+    ''' Suggests the first 10 queries from a list of popular queries that start with a seed. '''
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def respond(self, path, params, headers):
+        suggestions = [q for q in self.corpus if q.startswith(params['q'])][:10]
+        return (200, {}, _make_toolbar_response(suggestions))
+
+
+class FetchQueriesTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FetchQueriesTest, self).__init__(
+            [Query, Seed],
+            *args, **kwargs
+        )
+
+    def setUp(self):
+        self.url = fetch.queries.URL
+
+    def tearDown(self):
+        fetch.queries.URL = self.url
+
+    def _fetch(self, seeds, max_depth, full_length, workers=4, failing_seeds=(), resume=None):
+        mock_autocomplete = MockAutocomplete(full_length, failing_seeds)
+        return self._fetch_from(mock_autocomplete, seeds, max_depth, workers, resume=resume)
+
+    def _fetch_from(self, mock_autocomplete, seeds, max_depth, workers=4, resume=None, **kwargs):
+        with MockServer(mock_autocomplete.respond) as server:
+            fetch.queries.URL = server.url + '/complete/search'
+            if resume is not None:
+                resume_crawl(
+                    resume, max_depth, workers=workers, requests_per_second=1000, **kwargs)
+            else:
+                get_results_for_seeds(
+                    seeds, max_depth, workers=workers, requests_per_second=1000, **kwargs)
+            return server.requests
+
+    def _make_corpus(self):
+        # Queries for "seed a..." are more popular than all others, and
+        # there are more than 10 of them, so they fill up the top suggestions.
+        return (
+            ['seed a' + str(i) for i in range(12)] +
+            ['seed b' + str(i) for i in range(12)] +
+            ['seed c' + str(i) for i in range(3)]
+        )
+
+    def test_save_queries_for_seed(self):
+        self._fetch(['seed'], max_depth=0, full_length=100)
+        queries = Query.select().order_by(Query.rank)
+        self.assertEqual(len(queries), 10)
+        self.assertEqual(queries[0].query, "seed suggestion 0")
+        self.assertEqual(queries[0].rank, 1)
+        self.assertEqual(queries[0].seed.seed, "seed")
+
+    def test_expand_seed_with_full_results_to_max_depth(self):
+        requests = self._fetch(['seed'], max_depth=2, full_length=100)
+        # The root seed is only expanded by a space.  Its child ends with a space, so it is
+        # expanded with every character in the alphabet except for another space.
+        self.assertEqual(len(requests), 1 + 1 + (len(fetch.queries.ALPHABET) - 1))
+        self.assertEqual(
+            Seed.select().where(Seed.depth == 2).count(), len(fetch.queries.ALPHABET) - 1)
+        self.assertEqual(Seed.get(Seed.seed == 'seed a').parent.seed, 'seed ')
+
+    def test_do_not_expand_seed_without_full_results(self):
+        requests = self._fetch(['seed'], max_depth=3, full_length=5)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(Seed.select().count(), 2)
+
+    def test_crawl_seeds_in_breadth_first_order(self):
+        requests = self._fetch(['seed'], max_depth=2, full_length=100, workers=1)
+        depths = [len(params['q']) - len('seed') for _, params in requests]
+        self.assertEqual(depths, sorted(depths))
+
+    def test_mark_seeds_fetched_or_failed(self):
+        self._fetch(['seed'], max_depth=1, full_length=100, failing_seeds=['seed '])
+        self.assertEqual(Seed.get(Seed.seed == 'seed').status, 'fetched')
+        self.assertEqual(Seed.get(Seed.seed == 'seed ').status, 'failed')
+
+    def test_resume_crawl_fetches_only_unfetched_seeds(self):
+
+        # Simulate a crawl that was interrupted after the root seed was fetched
+        root = Seed.create(fetch_index=1, seed='seed', depth=0, status='fetched')
+        Seed.create(fetch_index=1, seed='seed ', depth=1, parent=root)
+        requests = self._fetch([], max_depth=2, full_length=100, resume=1)
+
+        self.assertNotIn('seed', [params['q'] for _, params in requests])
+        self.assertEqual(len(requests), 1 + (len(fetch.queries.ALPHABET) - 1))
+        self.assertEqual(Seed.select().where(Seed.status != 'fetched').count(), 0)
+        self.assertEqual(set([s.fetch_index for s in Seed.select()]), set([1]))
+
+    def test_resume_crawl_retries_failed_seeds(self):
+        self._fetch(['seed'], max_depth=1, full_length=100, failing_seeds=['seed '])
+        requests = self._fetch([], max_depth=1, full_length=100, resume=1)
+        self.assertEqual([params['q'] for _, params in requests], ['seed '])
+        self.assertEqual(Seed.get(Seed.seed == 'seed ').status, 'fetched')
+
+    def test_prune_chars_that_no_suggestion_continues_with(self):
+        chars = prune_expansion_chars(
+            ['a', 'b', 'c'], 'seed ', ['seed a1', 'Seed C2'], None, 'prefix', 0.8)
+        self.assertEqual(chars, ['a', 'c'])
+
+    def test_prune_all_chars_when_suggestions_overlap_with_parent(self):
+        suggestions = ['q' + str(i) for i in range(10)]
+        mostly_same = suggestions[:8] + ['other1', 'other2']
+        mostly_new = suggestions[:7] + ['other1', 'other2', 'other3']
+        self.assertEqual(
+            prune_expansion_chars(['a'], 's', suggestions, mostly_same, 'overlap', .8), [])
+        self.assertEqual(
+            prune_expansion_chars(['a'], 's', suggestions, mostly_new, 'overlap', .8), ['a'])
+
+    def test_prefix_pruning_skips_requests(self):
+        mock_autocomplete = MockCorpusAutocomplete(self._make_corpus())
+        full_requests = self._fetch_from(mock_autocomplete, ['seed'], max_depth=2)
+        pruned_requests = self._fetch_from(
+            mock_autocomplete, ['seed'], max_depth=2, prune='prefix')
+        self.assertEqual(len(full_requests), 2 + len(fetch.queries.ALPHABET) - 1)
+        # Only "seed a" is requested at the last level, as the top suggestions for "seed "
+        # only continue with the letter "a".
+        self.assertEqual(len(pruned_requests), 3)
+
+    def test_evaluate_pruning_by_replaying_crawl(self):
+        self._fetch_from(MockCorpusAutocomplete(self._make_corpus()), ['seed'], max_depth=2)
+        pruned_requests, original_requests, recall = evaluate_pruning(1, 2, 'prefix')
+        self.assertEqual(original_requests, 2 + len(fetch.queries.ALPHABET) - 1)
+        self.assertEqual(pruned_requests, 3)
+        # The full crawl found 10 queries for each of "seed a" and "seed b", and 3 for "seed c".
+        # The pruned crawl misses the queries that start with "seed b" and "seed c".
+        self.assertAlmostEqual(recall, 10 / 23.0)
+
+    def test_evaluate_no_pruning_has_full_recall(self):
+        self._fetch_from(MockCorpusAutocomplete(self._make_corpus()), ['seed'], max_depth=2)
+        pruned_requests, original_requests, recall = evaluate_pruning(1, 2, 'none')
+        self.assertEqual(pruned_requests, original_requests)
+        self.assertEqual(recall, 1.0)
@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import datetime
+from xml.sax.saxutils import escape
+
+from tests.base import TestCase
+from tests.mockserver import MockServer
+import fetch.results
+from fetch.results import get_results_for_queries, parse_date
+from models import Search, SearchResult
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def make_atom_response(urls, total_results=1000):
+    ''' Make an Atom response from the Custom Search API with a result for each URL. '''
+    return '\n'.join([
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<feed gd:kind="customsearch#search" xmlns="http://www.w3.org/2005/Atom" ' +
+        'xmlns:cse="http://schemas.google.com/cseapi/2010" ' +
+        'xmlns:gd="http://schemas.google.com/g/2005" ' +
+        'xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">',
+        '<title>Google Custom Search</title>',
+        '<id>tag:www.googleapis.com,2010:customsearch</id>',
+        '<updated>2016-01-01T00:00:00Z</updated>',
+        '<opensearch:Url type="application/atom+xml" template="https://www.googleapis.com"/>',
+        '<opensearch:totalResults>' + str(total_results) + '</opensearch:totalResults>',
+        '<cse:searchInformation>',
+        '<cse:searchTime>0.2</cse:searchTime>',
+        '<cse:totalResults>' + str(total_results) + '</cse:totalResults>',
+        '</cse:searchInformation>',
+    ] + [
+        '\n'.join([
+            '<entry gd:kind="customsearch#result">',
+            '<id>' + escape(url) + '</id>',
+            '<updated>2016-01-0' + str(i % 9 + 1) + 'T12:30:00.000Z</updated>',
+            '<title type="html">Result &lt;b&gt;' + str(i) + '&lt;/b&gt;</title>',
+            '<link href="' + escape(url) + '" title="example.com"/>',
+            '<summary type="html">Snippet for result ' + str(i) + '</summary>',
+            '<cse:displayLink>example.com</cse:displayLink>',
+            '</entry>',
+        ]) for i, url in enumerate(urls)
+    ] + ['</feed>'])
+
+
+class MockCustomSearch(object):
+    '''
+    Serves pages of results for every query, except for the queries in `failing_queries`.
+    Each query has `result_count` results in total.  If `repeat_results` is set, each page
+    after the first repeats half of the results from the page before it.
+    '''
+
+    def __init__(self, failing_queries=(), result_count=10, repeat_results=False):
+        self.failing_queries = failing_queries
+        self.result_count = result_count
+        self.repeat_results = repeat_results
+
+    def respond(self, path, params, headers):
+        query = params['q']
+        if query in self.failing_queries:
+            return (500, {}, '')
+        start = int(params.get('start', 1)) - 1
+        if self.repeat_results and start > 0:
+            start -= 5
+        indexes = range(start, min(start + 10, self.result_count))
+        urls = ['http://example.com/' + query.replace(' ', '-') + '/' + str(i) for i in indexes]
+        return (200, {}, make_atom_response(urls))
+
+
+class FetchResultsTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FetchResultsTest, self).__init__(
+            [Search, SearchResult],
+            *args, **kwargs
+        )
+
+    def setUp(self):
+        self.search_url = fetch.results.SEARCH_URL
+
+    def tearDown(self):
+        fetch.results.SEARCH_URL = self.search_url
+
+    def _make_queries(self, count):
+        return [{'query': 'query ' + str(i), 'package': 'package'} for i in range(count)]
+
+    def _fetch(self, mock_search, queries, workers=2, daily_quota=100, fetch_index=None,
+               pages=1):
+        with MockServer(mock_search.respond) as server:
+            fetch.results.SEARCH_URL = server.url + '/customsearch/v1'
+            get_results_for_queries(
+                queries, include_stack_overflow=False, search_id='id', api_key='key',
+                workers=workers, requests_per_second=1000, daily_quota=daily_quota,
+                fetch_index=fetch_index, pages=pages
+            )
+            return server.requests
+
+    def test_save_results_for_all_queries(self):
+        self._fetch(MockCustomSearch(), self._make_queries(3))
+        self.assertEqual(Search.select().count(), 3)
+        self.assertEqual(SearchResult.select().count(), 30)
+
+        search = Search.get(Search.query == 'query 1')
+        self.assertEqual(search.fetch_index, 1)
+        self.assertEqual(search.page_index, 0)
+        self.assertEqual(search.result_count_on_page, 10)
+        self.assertEqual(search.estimated_results_count, 1000)
+
+        result = SearchResult.get(SearchResult.search == search, SearchResult.rank == 3)
+        self.assertEqual(result.url, 'http://example.com/query-1/2')
+        self.assertEqual(result.link, 'http://example.com/query-1/2')
+        self.assertEqual(result.title, "Result <b>2</b>")
+        self.assertEqual(result.snippet, "Snippet for result 2")
+        self.assertEqual(result.updated_date.day, 3)
+        self.assertEqual(result.updated_date.hour, 12)
+
+    def test_stop_when_daily_quota_runs_out_and_resume_later(self):
+
+        queries = self._make_queries(4)
+        requests = self._fetch(MockCustomSearch(), queries, workers=1, daily_quota=2)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(Search.select().count(), 2)
+
+        # Two searches have already been made today, so a quota of 4 leaves two more.
+        requests = self._fetch(MockCustomSearch(), queries, daily_quota=4, fetch_index=1)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(
+            set([s.query for s in Search.select()]), set([q['query'] for q in queries]))
+        self.assertEqual(set([s.fetch_index for s in Search.select()]), set([1]))
+
+    def test_resume_retries_failed_queries(self):
+        queries = self._make_queries(3)
+        self._fetch(MockCustomSearch(failing_queries=['query 1']), queries)
+        requests = self._fetch(MockCustomSearch(), queries, fetch_index=1)
+        self.assertEqual([params['q'] for _, params in requests], ['query 1'])
+        self.assertEqual(Search.select().count(), 3)
+
+    def test_fetch_later_pages_until_a_short_page(self):
+        requests = self._fetch(
+            MockCustomSearch(result_count=24), self._make_queries(2), workers=4, pages=5)
+        # For each query, pages 1 and 2 are full, and page 3 is short.  Page 4 isn't requested
+        # unless it was started before the short page came back.
+        self.assertGreaterEqual(len(requests), 6)
+        self.assertEqual(SearchResult.select().count(), 48)
+        search = Search.get(Search.query == 'query 1', Search.page_index == 2)
+        self.assertEqual(search.result_count_on_page, 4)
+        first_result = SearchResult.get(SearchResult.search == search, SearchResult.rank == 1)
+        self.assertEqual(first_result.url, 'http://example.com/query-1/20')
+
+    def test_no_later_pages_fetched_after_short_first_page(self):
+        requests = self._fetch(MockCustomSearch(result_count=7), self._make_queries(1), pages=3)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(SearchResult.select().count(), 7)
+
+    def test_skip_results_already_saved_for_query(self):
+        self._fetch(
+            MockCustomSearch(result_count=100, repeat_results=True), self._make_queries(1),
+            pages=2
+        )
+        # Half of the results on the second page were also on the first page.
+        search = Search.get(Search.page_index == 1)
+        self.assertEqual(search.result_count_on_page, 10)
+        ranks = [r.rank for r in SearchResult.select().where(SearchResult.search == search)]
+        self.assertEqual(sorted(ranks), [6, 7, 8, 9, 10])
+
+    def test_resume_fetches_missing_later_pages(self):
+        queries = self._make_queries(1)
+        self._fetch(MockCustomSearch(result_count=30), queries, pages=1)
+        requests = self._fetch(MockCustomSearch(result_count=30), queries, pages=3, fetch_index=1)
+        self.assertEqual(sorted([params['start'] for _, params in requests]), ['11', '21'])
+        self.assertEqual(SearchResult.select().count(), 30)
+
+    def test_parse_dates_with_and_without_milliseconds(self):
+        self.assertEqual(
+            parse_date('2016-02-03T04:05:06.789Z'), datetime.datetime(2016, 2, 3, 4, 5, 6))
+        self.assertEqual(
+            parse_date('2016-02-03T04:05:06Z'), datetime.datetime(2016, 2, 3, 4, 5, 6))
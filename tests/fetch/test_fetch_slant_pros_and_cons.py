@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import re
+
+from tests.base import TestCase
+from tests.mockserver import MockServer
+import fetch.slant_pros_and_cons
+from fetch.slant_pros_and_cons import get_slant_pros_and_cons
+from models import SlantTopic, Viewpoint, ViewpointSection
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def _make_section(section_id, is_con):
+    return {
+        'id': section_id,
+        'revision': {'title': "Section " + str(section_id), 'text': "Text"},
+        'isCon': is_con,
+        'votes': {'upvotes': 2, 'downvotes': 1},
+    }
+
+
+class MockSlant(object):
+    '''
+    Serves two pros and a con for each viewpoint at a path like '/viewpoints/1'.
+    Viewpoints in `missing_viewpoints` are reported as missing with a 404 error,
+    and viewpoints in `failing_viewpoints` can't be fetched at all.
+    '''
+
+    def __init__(self, missing_viewpoints=(), failing_viewpoints=()):
+        self.missing_viewpoints = missing_viewpoints
+        self.failing_viewpoints = failing_viewpoints
+
+    def respond(self, path, params, headers):
+        viewpoint_index = int(re.match('^/viewpoints/(\d+)$', path).group(1))
+        if viewpoint_index in self.failing_viewpoints:
+            return (500, {}, '')
+        if viewpoint_index in self.missing_viewpoints:
+            return (200, {}, {'error': 404})
+        return (200, {}, {'sections': {'children': [
+            _make_section(viewpoint_index * 10 + 1, False),
+            _make_section(viewpoint_index * 10 + 2, False),
+            _make_section(viewpoint_index * 10 + 3, True),
+        ]}})
+
+
+class FetchSlantProsAndConsTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FetchSlantProsAndConsTest, self).__init__(
+            [SlantTopic, Viewpoint, ViewpointSection],
+            *args, **kwargs
+        )
+
+    def setUp(self):
+        self.slant_url = fetch.slant_pros_and_cons.SLANT_URL
+        topic = SlantTopic.create(
+            fetch_index=1, topic_id=1, title="Topic", url_path='/topics/1', owner_username='u')
+        for viewpoint_index in range(1, 6):
+            Viewpoint.create(
+                fetch_index=1, topic=topic, viewpoint_index=viewpoint_index,
+                title="Viewpoint", url_path='/viewpoints/' + str(viewpoint_index)
+            )
+
+    def tearDown(self):
+        fetch.slant_pros_and_cons.SLANT_URL = self.slant_url
+
+    def _fetch(self, mock_slant):
+        with MockServer(mock_slant.respond) as server:
+            fetch.slant_pros_and_cons.SLANT_URL = server.url
+            get_slant_pros_and_cons(show_progress=False, workers=2, requests_per_second=1000)
+            return server.requests
+
+    def test_fetch_pros_and_cons_for_all_viewpoints(self):
+        self._fetch(MockSlant())
+        self.assertEqual(ViewpointSection.select().count(), 15)
+        section = ViewpointSection.get(ViewpointSection.section_index == 23)
+        self.assertEqual(section.viewpoint.viewpoint_index, 2)
+        self.assertTrue(section.is_con)
+        self.assertEqual(section.fetch_index, 1)
+
+    def test_skip_missing_and_failing_viewpoints(self):
+        self._fetch(MockSlant(missing_viewpoints=[2], failing_viewpoints=[4]))
+        # The viewpoints after the missing and failing ones are still fetched.
+        viewpoint_indexes = set([s.viewpoint.viewpoint_index for s in ViewpointSection.select()])
+        self.assertEqual(viewpoint_indexes, set([1, 3, 5]))
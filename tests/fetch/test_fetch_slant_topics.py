@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import threading
+
+from tests.base import TestCase
+from tests.mockserver import MockServer
+import fetch.slant_topics
+from fetch.slant_topics import get_slant_topics
+from models import SlantTopic, Viewpoint
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def _make_topic(topic_id, viewpoint_count):
+    return {
+        'uuid': topic_id,
+        'revision': {'title': "Topic " + str(topic_id)},
+        'URL': '/topics/' + str(topic_id),
+        'createdEvent': {'user': {'username': 'user'}},
+        'viewpoints': {'children': [
+            {
+                'id': topic_id * 100 + i,
+                'revision': {'title': "Viewpoint " + str(i)},
+                'URL': '/viewpoints/' + str(topic_id * 100 + i),
+            } for i in range(viewpoint_count)
+        ]},
+    }
+
+
+class MockSlantTopics(object):
+    ''' Serves pages of topics, where page N links to page N + 1 until the last page. '''
+
+    def __init__(self, page_count, topics_per_page):
+        self.page_count = page_count
+        self.topics_per_page = topics_per_page
+
+    def respond(self, path, params, headers):
+        page = int(params.get('page', 0))
+        first_topic_id = page * self.topics_per_page + 1
+        page_properties = {}
+        if page + 1 < self.page_count:
+            page_properties['next'] = '/topics?page=' + str(page + 1)
+        return (200, {}, {
+            'count': self.page_count * self.topics_per_page,
+            'children': [
+                _make_topic(topic_id, viewpoint_count=topic_id % 3 + 1)
+                for topic_id in range(first_topic_id, first_topic_id + self.topics_per_page)
+            ],
+            'properties': {'page': page_properties},
+        })
+
+
+class FetchSlantTopicsTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FetchSlantTopicsTest, self).__init__(
+            [SlantTopic, Viewpoint],
+            *args, **kwargs
+        )
+
+    def setUp(self):
+        self.slant_url = fetch.slant_topics.SLANT_URL
+        self.request_delay = fetch.slant_topics.REQUEST_DELAY
+        self.save_topics = fetch.slant_topics.save_topics
+        fetch.slant_topics.REQUEST_DELAY = 0
+
+    def tearDown(self):
+        fetch.slant_topics.SLANT_URL = self.slant_url
+        fetch.slant_topics.SLANT_TOPICS_URL = self.slant_url + '/topics'
+        fetch.slant_topics.REQUEST_DELAY = self.request_delay
+        fetch.slant_topics.save_topics = self.save_topics
+
+    def _fetch(self, mock_slant, latency=0):
+        with MockServer(mock_slant.respond, latency=latency) as server:
+            fetch.slant_topics.SLANT_URL = server.url
+            fetch.slant_topics.SLANT_TOPICS_URL = server.url + '/topics'
+            get_slant_topics(show_progress=False)
+            return server.requests
+
+    def test_fetch_topics_and_viewpoints_from_all_pages(self):
+        requests = self._fetch(MockSlantTopics(page_count=3, topics_per_page=4))
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(SlantTopic.select().count(), 12)
+        # Topics have 1, 2, or 3 viewpoints depending on their ID
+        self.assertEqual(Viewpoint.select().count(), 24)
+        for viewpoint in Viewpoint.select():
+            self.assertEqual(viewpoint.viewpoint_index // 100, viewpoint.topic.topic_id)
+
+    def test_next_page_fetched_while_page_is_saved(self):
+
+        page_count = 4
+        mock_slant = MockSlantTopics(page_count=page_count, topics_per_page=1)
+        events = []
+        pages_requested = [threading.Event() for _ in range(page_count)]
+        respond = mock_slant.respond
+
+        def record_request(path, params, headers):
+            page = int(params.get('page', 0))
+            events.append(('requested', page))
+            pages_requested[page].set()
+            return respond(path, params, headers)
+        mock_slant.respond = record_request
+
+        # Each save waits a while for the next page to be requested, so whether the
+        # request comes first doesn't depend on how quickly pages are fetched.
+        def save_topics_after_next_request(topics, fetch_index):
+            page = topics[0]['uuid'] - 1
+            if page + 1 < page_count:
+                pages_requested[page + 1].wait(timeout=5)
+            self.save_topics(topics, fetch_index)
+            events.append(('saved', page))
+        fetch.slant_topics.save_topics = save_topics_after_next_request
+
+        self._fetch(mock_slant)
+        self.assertEqual(SlantTopic.select().count(), page_count)
+        for page in range(page_count - 1):
+            self.assertLess(events.index(('requested', page + 1)), events.index(('saved', page)))
@@ -0,0 +1,223 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import time
+
+from tests.base import TestCase
+from tests.mockserver import MockServer
+import fetch.api
+import fetch.stack_overflow_questions
+from fetch.api import stack_exchange_throttle, StackExchangeThrottle, RateLimiter
+from fetch.stack_overflow_questions import fetch_questions, save_questions, load_tag_cache
+from models import QuestionSnapshot, Tag, QuestionSnapshotTag, QuestionSnapshotCursor,\
+    max_batch_size
+
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+PAGE_SIZE = 2
+
+
+def _make_question(question_id, tags, last_activity_date=1451606400):
+    return {
+        'question_id': question_id,
+        'owner': {'user_id': 1},
+        'comment_count': 0,
+        'delete_vote_count': 0,
+        'reopen_vote_count': 0,
+        'close_vote_count': 0,
+        'is_answered': False,
+        'view_count': 10,
+        'favorite_count': 0,
+        'down_vote_count': 0,
+        'up_vote_count': 1,
+        'answer_count': 0,
+        'score': 1,
+        'last_activity_date': last_activity_date,
+        'creation_date': 1451606400,
+        'title': "Question " + str(question_id),
+        'body': "Body",
+        'tags': tags,
+    }
+
+
+class MockStackExchange(object):
+    '''
+    Serves pages of questions for tags from the Stack Exchange advanced search API.
+    Requests for tags in `failing_tags` always fail, as do requests for pages in
+    `failing_pages`.  Like the API, questions are sorted by activity, from newest to oldest
+    unless ascending order is requested.  Supports a minimum activity date.
+    '''
+
+    def __init__(self, questions_per_tag, failing_tags=(), quota=10000, failing_pages=()):
+        self.questions_per_tag = questions_per_tag
+        self.failing_tags = failing_tags
+        self.failing_pages = failing_pages
+        self.quota = quota
+        self.questions = {}
+
+    def get_questions(self, tag):
+        if tag not in self.questions:
+            self.questions[tag] = [
+                _make_question(
+                    (hash(tag) % 1000) * 1000 + i, [tag, 'other-tag'],
+                    last_activity_date=1451606400 + i
+                )
+                for i in range(self.questions_per_tag)
+            ]
+        return self.questions[tag]
+
+    def respond(self, path, params, headers):
+
+        tag = params['tagged']
+        page = int(params['page'])
+        if tag in self.failing_tags or page in self.failing_pages:
+            return (500, {}, {'error_id': 500, 'error_name': 'internal_error'})
+
+        self.quota -= 1
+        questions = sorted(
+            [q for q in self.get_questions(tag)
+             if q['last_activity_date'] >= int(params.get('min', 0))],
+            key=lambda q: q['last_activity_date'],
+            reverse=params.get('order') != 'asc',
+        )
+        return (200, {}, {
+            'items': questions[(page - 1) * PAGE_SIZE:page * PAGE_SIZE],
+            'has_more': page * PAGE_SIZE < len(questions),
+            'quota_remaining': self.quota,
+        })
+
+
+class FetchStackOverflowQuestionsTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FetchStackOverflowQuestionsTest, self).__init__(
+            [QuestionSnapshot, Tag, QuestionSnapshotTag, QuestionSnapshotCursor],
+            *args, **kwargs
+        )
+
+    def setUp(self):
+        self.api_url = fetch.stack_overflow_questions.API_URL
+        self.page_size = fetch.stack_overflow_questions.DEFAULT_PARAMS['page_size']
+        self.retry_delay = fetch.api.STACK_EXCHANGE_RETRY_DELAY
+        fetch.stack_overflow_questions.DEFAULT_PARAMS['page_size'] = PAGE_SIZE
+        fetch.api.STACK_EXCHANGE_RETRY_DELAY = 0
+        fetch.stack_overflow_questions.tag_cache.clear()
+        stack_exchange_throttle.rate_limiter = RateLimiter(1000)
+        stack_exchange_throttle.quota_remaining = None
+        stack_exchange_throttle.pause_until = 0
+
+    def tearDown(self):
+        fetch.stack_overflow_questions.API_URL = self.api_url
+        fetch.stack_overflow_questions.DEFAULT_PARAMS['page_size'] = self.page_size
+        fetch.api.STACK_EXCHANGE_RETRY_DELAY = self.retry_delay
+        fetch.stack_overflow_questions.tag_cache.clear()
+        stack_exchange_throttle.rate_limiter = RateLimiter(
+            fetch.api.STACK_EXCHANGE_REQUESTS_PER_SECOND)
+        stack_exchange_throttle.quota_remaining = None
+
+    def _fetch(self, mock_stack_exchange, tags, fetch_index=1, workers=2, incremental=False):
+        with MockServer(mock_stack_exchange.respond) as server:
+            fetch.stack_overflow_questions.API_URL = server.url + '/2.2/search/advanced'
+            fetch_questions(tags, fetch_index, workers=workers, incremental=incremental)
+            return server.requests
+
+    def test_fetch_all_pages_of_questions_for_all_tags(self):
+        self._fetch(MockStackExchange(questions_per_tag=5), ['tag1', 'tag2', 'tag3'])
+        self.assertEqual(QuestionSnapshot.select().count(), 15)
+        self.assertEqual(
+            QuestionSnapshot.select().where(QuestionSnapshot.fetch_index == 1).count(), 15)
+
+    def test_link_snapshots_to_saved_tags(self):
+        tag = Tag.create(tag_name='tag1', count=1)
+        self._fetch(MockStackExchange(questions_per_tag=3), ['tag1'])
+        # No tag has been saved with the name "other-tag", so only one link is made per snapshot.
+        self.assertEqual(QuestionSnapshotTag.select().count(), 3)
+        self.assertEqual(
+            set([link.tag_id for link in QuestionSnapshotTag.select()]), set([tag.id]))
+
+    def test_failing_page_retried_a_bounded_number_of_times(self):
+        requests = self._fetch(
+            MockStackExchange(questions_per_tag=3, failing_tags=['broken']), ['broken', 'tag1'])
+        broken_requests = [r for r in requests if r[1]['tagged'] == 'broken']
+        self.assertEqual(len(broken_requests), fetch.api.STACK_EXCHANGE_MAX_ATTEMPTS)
+        self.assertEqual(QuestionSnapshot.select().count(), 3)
+
+    def test_stop_fetching_when_quota_runs_out(self):
+        requests = self._fetch(
+            MockStackExchange(questions_per_tag=5, quota=1), ['tag1', 'tag2'], workers=1)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(QuestionSnapshot.select().count(), 2)
+
+    def test_save_questions_links_each_snapshot_to_its_own_tags(self):
+
+        Tag.create(tag_name='even', count=1)
+        Tag.create(tag_name='odd', count=1)
+        load_tag_cache()
+        # Save an earlier snapshot so that the IDs of the new snapshots don't start at 1
+        save_questions([_make_question(1, ['odd'])], fetch_index=1)
+
+        # This page is larger than one batch of snapshots
+        page_size = max_batch_size(QuestionSnapshot) + 10
+        save_questions(
+            [_make_question(i, ['even' if i % 2 == 0 else 'odd']) for i in range(page_size)],
+            fetch_index=2
+        )
+
+        self.assertEqual(QuestionSnapshot.select().count(), page_size + 1)
+        self.assertEqual(QuestionSnapshotTag.select().count(), page_size + 1)
+        for link in QuestionSnapshotTag.select():
+            snapshot = QuestionSnapshot.get(QuestionSnapshot.id == link.question_snapshot_id)
+            tag = Tag.get(Tag.id == link.tag_id)
+            self.assertEqual(tag.tag_name, 'even' if snapshot.question_id % 2 == 0 else 'odd')
+
+    def test_incremental_fetch_snapshots_only_active_questions(self):
+
+        mock_stack_exchange = MockStackExchange(questions_per_tag=5)
+        self._fetch(mock_stack_exchange, ['tag1'], fetch_index=1)
+        cursor = QuestionSnapshotCursor.get(QuestionSnapshotCursor.tag_name == 'tag1')
+        self.assertEqual(cursor.last_activity_date, 1451606404)
+
+        active_question = mock_stack_exchange.questions['tag1'][1]
+        active_question['last_activity_date'] = 1451700000
+        active_question['score'] = 10
+        requests = self._fetch(mock_stack_exchange, ['tag1'], fetch_index=2, incremental=True)
+
+        # The 'min' filter is inclusive, so the question with the latest activity from the
+        # last fetch is snapshotted again, along with the question that had new activity.
+        self.assertEqual(requests[0][1]['min'], '1451606404')
+        self.assertEqual(
+            QuestionSnapshot.select().where(QuestionSnapshot.fetch_index == 2).count(), 2)
+        self.assertEqual(
+            QuestionSnapshotCursor.get(QuestionSnapshotCursor.tag_name == 'tag1')
+            .last_activity_date, 1451700000
+        )
+
+        # The latest snapshots include one snapshot of every question
+        latest_snapshots = list(QuestionSnapshot.select_latest())
+        self.assertEqual(len(latest_snapshots), 5)
+        latest_active_snapshot = [
+            s for s in latest_snapshots if s.question_id == active_question['question_id']][0]
+        self.assertEqual(latest_active_snapshot.fetch_index, 2)
+        self.assertEqual(latest_active_snapshot.score, 10)
+
+    def test_interrupted_first_incremental_fetch_resumes_from_oldest_activity(self):
+
+        # The first fetch of the tag is incremental, and stops after the first page.
+        mock_stack_exchange = MockStackExchange(questions_per_tag=6, failing_pages=[2])
+        requests = self._fetch(mock_stack_exchange, ['tag1'], fetch_index=1, incremental=True)
+        self.assertEqual(requests[0][1]['order'], 'asc')
+        cursor = QuestionSnapshotCursor.get(QuestionSnapshotCursor.tag_name == 'tag1')
+        self.assertEqual(cursor.last_activity_date, 1451606401)
+
+        # The next incremental fetch picks up where the first one stopped.
+        mock_stack_exchange.failing_pages = []
+        self._fetch(mock_stack_exchange, ['tag1'], fetch_index=2, incremental=True)
+        self.assertEqual(len(list(QuestionSnapshot.select_latest())), 6)
+
+    def test_throttle_obeys_backoff(self):
+        throttle = StackExchangeThrottle()
+        throttle.update({'backoff': 5, 'quota_remaining': 100})
+        self.assertGreater(throttle.pause_until, time.time() + 4)
+        self.assertEqual(throttle.quota_remaining, 100)
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import json
+import time
+import threading
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+logger = logging.getLogger('data')
+
+
+'''
+A local HTTP server that stands in for the web APIs that the fetchers query.
+Tests provide a `respond` function that takes the path of a request and a dictionary
+of its query parameters and headers, and returns a tuple of
+(status code, dictionary of headers, body).  If the body isn't a string, it is sent as JSON.
+The server can also add a delay before each response to simulate network latency.
+'''
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MockServer(object):
+
+    def __init__(self, respond, latency=0):
+        self.respond = respond
+        self.latency = latency
+        self.requests = []
+        self.lock = threading.Lock()
+
+        mock_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+
+                url = urlparse.urlparse(self.path)
+                params = {key: values[0] for key, values in urlparse.parse_qs(url.query).items()}
+                with mock_server.lock:
+                    mock_server.requests.append((url.path, params))
+
+                time.sleep(mock_server.latency)
+                status, headers, body = mock_server.respond(url.path, params, self.headers)
+                if not isinstance(body, basestring):
+                    body = json.dumps(body)
+
+                self.send_response(status)
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+
+            def log_message(self, *args, **kwargs):
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()